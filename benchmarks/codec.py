@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the size, and the time to encode and decode, of menu trees
+pickled as `MenuItem` instances (with their site, as `select_related`
+leaves them) against `menuhin.codec`, with and without zlib.
+
+    python benchmarks/codec.py --sizes 1000 10000 100000
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+
+def setup():
+    import test_settings
+    settings.configure(**dict((x, getattr(test_settings, x))
+                              for x in dir(test_settings) if x.isupper()))
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+def make_items(count):
+    from django.contrib.sites.models import Site
+    from menuhin.models import MenuItem
+    site = Site(pk=1, domain='example.com', name='example.com')
+    now = datetime.now()
+    items = []
+    for index in range(count):
+        # a root for every hundred items, the rest two levels below.
+        depth = 1 if index % 100 == 0 else (2 if index % 10 == 0 else 3)
+        item = MenuItem(pk=index + 1, path='{0:012d}'.format(index),
+                        depth=depth, numchild=0 if depth == 3 else 10,
+                        site_id=site.pk,
+                        uri='/section/page-{0}/'.format(index),
+                        title='Page number {0}'.format(index),
+                        menu_slug='page-{0}'.format(index),
+                        is_published=True, created=now, modified=now)
+        item.site = site
+        items.append(item)
+    return items
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def measure(name, encode, decode, repeat):
+    data = encode()
+    return {
+        'name': name,
+        'kb': len(data) / 1024.0,
+        'encode_ms': 1000 * best_of(encode, repeat),
+        'decode_ms': 1000 * best_of(lambda: decode(data), repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    options = parser.parse_args()
+    setup()
+    from menuhin.codec import encode_tree, decode_tree
+
+    print("{0:>8} {1:>14} {2:>12} {3:>12} {4:>12}".format(
+        'nodes', 'format', 'size', 'encode', 'decode'))
+    for size in options.sizes:
+        items = make_items(size)
+        rows = [(x.pk, x.depth, x.numchild, x.is_published, x.path, x.uri,
+                 x.title, x.menu_slug) for x in items]
+        results = (
+            measure('pickle', lambda: pickle.dumps(
+                items, pickle.HIGHEST_PROTOCOL), pickle.loads,
+                options.repeat),
+            measure('codec', lambda: encode_tree(rows), decode_tree,
+                    options.repeat),
+            measure('codec+zlib', lambda: encode_tree(rows, compress=True),
+                    decode_tree, options.repeat),
+        )
+        for result in results:
+            print("{0:>8} {name:>14} {kb:>10.1f}KB {encode_ms:>10.1f}ms "
+                  "{decode_ms:>10.1f}ms".format(size, **result))
+
+
+if __name__ == '__main__':
+    main()
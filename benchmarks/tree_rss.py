@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the memory of forked workers which each hold a site's tree in
+objects of their own, against workers mapping a shared tree file.
+
+    python benchmarks/tree_rss.py --nodes 300000 --workers 16
+
+Linux only, as it reads /proc/<pid>/smaps_rollup (or smaps). PSS counts
+shared pages divided between the processes sharing them, so its total is
+what the workers really cost together. The load time is how long the
+slowest worker took to have its tree ready, before walking every node.
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from django.conf import settings  # noqa
+if not settings.configured:
+    settings.configure()
+
+from menuhin.codec import encode_tree  # noqa
+from menuhin.treefiles import MappedTree  # noqa
+
+
+def make_rows(count, fanout=10, max_depth=5):
+    """
+    (pk, depth, numchild, is_published, path, uri, title, menu_slug) rows
+    for a tree of `count` nodes, `fanout` children to a node, in path
+    order.
+    """
+    rows = []
+
+    def add(path, depth):
+        index = len(rows)
+        row = [index + 1, depth, 0, True, path,
+               '/section-{0}/page-{1}/'.format(depth, index),
+               'Page number {0}'.format(index), None]
+        rows.append(row)
+        if depth == max_depth:
+            return
+        for child in range(fanout):
+            if len(rows) >= count:
+                break
+            row[2] += 1
+            add(path + '{0:04d}'.format(child), depth + 1)
+
+    root = 0
+    while len(rows) < count:
+        add('{0:04d}'.format(root), 1)
+        root += 1
+    return [tuple(x) for x in rows]
+
+
+def memory_kb(pid):
+    totals = {'Rss': 0, 'Pss': 0}
+    path = '/proc/{0}/smaps_rollup'.format(pid)
+    if not os.path.exists(path):
+        path = '/proc/{0}/smaps'.format(pid)
+    with open(path) as handle:
+        for line in handle:
+            name, _, value = line.partition(':')
+            if name in totals:
+                totals[name] += int(value.split()[0])
+    return totals
+
+
+def hold_objects(rows):
+    # what each worker has after loading its own copy from the database or
+    # the cache.
+    return [dict(zip(('pk', 'depth', 'numchild', 'is_published', 'path',
+                      'uri', 'title', 'menu_slug'), row)) for row in rows]
+
+
+def walk(held):
+    # touch every node, as rendering the whole tree would.
+    for node in held:
+        pass
+
+
+def run(mode, workers, rows, path):
+    started = time.time()
+    pids, ready_pipes, exit_pipes = [], [], []
+    for worker in range(workers):
+        ready_read, ready_write = os.pipe()
+        exit_read, exit_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            os.close(exit_write)
+            loaded_at = time.time()
+            if mode == 'objects':
+                held = hold_objects(rows)
+            else:
+                held = MappedTree(path)
+            load_time = time.time() - loaded_at
+            walk(held)
+            os.write(ready_write, '{0:.6f}\n'.format(load_time).encode())
+            # stay alive until every worker has been measured.
+            os.read(exit_read, 1)
+            del held
+            os._exit(0)
+        os.close(ready_write)
+        os.close(exit_read)
+        pids.append(pid)
+        ready_pipes.append(ready_read)
+        exit_pipes.append(exit_write)
+
+    load_times = [float(os.read(x, 64).decode()) for x in ready_pipes]
+    usage = [memory_kb(pid) for pid in pids]
+    for pipe in exit_pipes:
+        os.write(pipe, b'x')
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return {
+        'mode': mode,
+        'rss_mb': sum(x['Rss'] for x in usage) / 1024.0,
+        'pss_mb': sum(x['Pss'] for x in usage) / 1024.0,
+        'load_ms': 1000 * max(load_times),
+        'seconds': time.time() - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--nodes', type=int, default=300000)
+    parser.add_argument('--workers', type=int, default=16)
+    options = parser.parse_args()
+
+    rows = make_rows(options.nodes)
+    handle, path = tempfile.mkstemp(suffix='.bin')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            output.write(encode_tree(rows, site_id=1))
+        print("{0} nodes, tree file of {1:.1f}MB, {2} workers".format(
+            len(rows), os.path.getsize(path) / 1048576.0, options.workers))
+        print("{0:>8} {1:>12} {2:>12} {3:>14}".format(
+            'mode', 'total RSS', 'total PSS', 'slowest load'))
+        for mode in ('objects', 'mapped'):
+            result = run(mode, options.workers, rows, path)
+            print("{mode:>8} {rss_mb:>10.1f}MB {pss_mb:>10.1f}MB "
+                  "{load_ms:>12.1f}ms".format(**result))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
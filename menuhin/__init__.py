@@ -3,6 +3,8 @@ __version_info__ = '0.1.0'  # pragma: no cover
 __version__ = '0.1.0'  # pragma: no cover
 version = '0.1.0'  # pragma: no cover
 
+default_app_config = 'menuhin.apps.MenuhinConfig'
+
 
 def get_version():
     return '0.1.0'
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 from functools import update_wrapper
 from django.core.exceptions import PermissionDenied
@@ -10,13 +11,20 @@ try:
 except ImportError:  # pragma: no cover
     from django.utils.encoding import force_unicode as force_text
 from django.contrib.admin.templatetags.admin_urls import admin_urlname
+from django.contrib.admin.views.main import ChangeList
 from django.template.response import TemplateResponse
 from django.shortcuts import redirect
-from django.http import HttpResponseForbidden
-from .models import MenuItem
+from django.http import (HttpResponseForbidden, HttpResponse,
+                         HttpResponseBadRequest, Http404)
+from django.core.paginator import Paginator, InvalidPage
+from django.core.urlresolvers import reverse
+from django.conf import settings
+from .models import MenuItem, ImportJob
 from .forms import MenuItemTreeForm, ImportMenusForm
-from .utils import (ensure_default_for_site, change_published_status,
-                    find_missing)
+from .jobs import start_import_job
+from .utils import (ensure_default_exists, change_published_status,
+                    publish_subtree, unpublish_subtree, search_menu_items,
+                    depth_label)
 
 try:
     from .checks import MenuhinAdminChecks
@@ -27,6 +35,47 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+def _model_name(model):
+    if hasattr(model._meta, 'model_name'):
+        return model._meta.model_name
+    return model._meta.module_name  # pragma: no cover (Django < 1.6)
+
+
+#: the changelist querystring parameter for only showing a node's children.
+CHILDREN_VAR = '_children'
+
+
+class MenuItemChangeList(ChangeList):
+    """
+    Shows only the top of the tree (see MenuItemAdmin.get_changelist_depth)
+    unless searching, or the children of a single node for the admin's
+    children view.
+    """
+    def get_queryset(self, request):
+        # must go before the lookups are taken from the params.
+        self.children_of = self.params.pop(CHILDREN_VAR, None)
+        parent = super(MenuItemChangeList, self)
+        get_queryset = getattr(parent, 'get_queryset', None)
+        if get_queryset is None:  # pragma: no cover (Django < 1.6)
+            get_queryset = parent.get_query_set
+        queryset = get_queryset(request)
+        if self.children_of is not None:
+            depth = len(self.children_of) // self.model.steplen
+            return queryset.filter(path__startswith=self.children_of,
+                                   depth=depth + 1)
+        max_depth = self.model_admin.get_changelist_depth(request)
+        if max_depth and not self.query:
+            queryset = queryset.filter(depth__lte=max_depth)
+        return queryset
+    get_query_set = get_queryset
+
+    def get_results(self, request):
+        super(MenuItemChangeList, self).get_results(request)
+        # treebeard looks up each row's parent; searches show all ancestors.
+        self.result_list = self.model.prefetch_ancestors(
+            self.result_list, parents_only=not self.query)
+
+
 class MenuItemAdmin(TreeAdmin):
     list_display = ('title', 'uri', 'site', 'menu_slug', 'is_published')
     list_display_links = ('title',)
@@ -34,7 +83,8 @@ class MenuItemAdmin(TreeAdmin):
     search_fields = ('title', 'menu_slug', 'uri')
     readonly_fields = ('menu_slug', 'created', 'modified')
     form = MenuItemTreeForm
-    actions = [change_published_status]
+    actions = [change_published_status, publish_subtree,
+               unpublish_subtree]
     fieldsets = [
         ('dates', {
             'classes': ('collapse',),
@@ -53,10 +103,37 @@ class MenuItemAdmin(TreeAdmin):
     ]
     change_list_template = 'admin/menuhin/menuitem/tree_change_list.html'
     checks_class = MenuhinAdminChecks
+    changelist_depth = None
+
+    def get_changelist(self, request, **kwargs):
+        return MenuItemChangeList
+
+    def get_changelist_depth(self, request):
+        """
+        How deep into the tree the changelist goes before children are
+        loaded on demand; MENUHIN_ADMIN_CHANGELIST_DEPTH (1) by default,
+        and None for the whole tree.
+        """
+        if self.changelist_depth is not None:
+            return self.changelist_depth
+        return getattr(settings, 'MENUHIN_ADMIN_CHANGELIST_DEPTH', 1)
+
+    def get_list_display(self, request):
+        list_display = super(MenuItemAdmin, self).get_list_display(request)
+        if request.GET.get('q'):
+            list_display = tuple(list_display) + ('ancestry',)
+        return list_display
+
+    def ancestry(self, obj):
+        ancestors = getattr(obj, 'prefetched_ancestors', None)
+        if ancestors is None:
+            ancestors = obj.get_ancestors()
+        return ' > '.join(force_text(x.title) for x in ancestors)
+    ancestry.short_description = _('within')
 
     @property
     def media(self):
-        obj, created = ensure_default_for_site(model=self.model)
+        ensure_default_exists(model=self.model)
         return super(MenuItemAdmin, self).media
 
     def get_urls(self):
@@ -68,14 +145,81 @@ class MenuItemAdmin(TreeAdmin):
             return update_wrapper(wrapper, view)
 
         app_label = self.model._meta.app_label
-        if hasattr(self.model._meta, 'model_name'):
-            model_name = self.model._meta.model_name
-        else:
-            model_name = self.model._meta.module_name
+        model_name = _model_name(self.model)
         import_url = url(regex=r'^import/$',
                          view=wrap(self.import_view),
                          name='%s_%s_import' % (app_label, model_name))
-        return patterns('', import_url) + super(MenuItemAdmin, self).get_urls()
+        search_url = url(regex=r'^search/$',
+                         view=wrap(self.search_view),
+                         name='%s_%s_search' % (app_label, model_name))
+        children_url = url(regex=r'^children/$',
+                           view=wrap(self.children_view),
+                           name='%s_%s_children' % (app_label, model_name))
+        status_url = url(regex=r'^import/(?P<pk>\d+)/$',
+                         view=wrap(self.import_status_view),
+                         name='%s_%s_import_status' % (app_label,
+                                                       model_name))
+        missing_url = url(regex=r'^import/(?P<pk>\d+)/missing/$',
+                          view=wrap(self.import_missing_view),
+                          name='%s_%s_import_missing' % (app_label,
+                                                         model_name))
+        return (patterns('', import_url, search_url, children_url,
+                         status_url, missing_url) +
+                super(MenuItemAdmin, self).get_urls())
+
+    def children_view(self, request):
+        """
+        JSON with the changelist rows for the children of the node whose
+        `path` is given, for expanding the tree on demand.
+        """
+        path = request.GET.get('path', '')
+        steplen = self.model.steplen
+        if not path or not path.isalnum() or len(path) % steplen != 0:
+            return HttpResponseBadRequest("Invalid path")
+
+        params = request.GET.copy()
+        del params['path']
+        params[CHILDREN_VAR] = path
+        request.GET = params
+        response = self.changelist_view(request)
+        if not hasattr(response, 'context_data'):
+            # a redirect, or denied.
+            return response
+        cl = response.context_data['cl']
+        response.template_name = (
+            'admin/menuhin/menuitem/tree_change_list_rows.html')
+        response.render()
+        next_page = None
+        if cl.multi_page and cl.page_num + 1 < cl.paginator.num_pages:
+            next_page = cl.page_num + 1
+        data = {'path': path, 'count': cl.result_count,
+                'next_page': next_page,
+                'html': response.content.decode('utf-8')}
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    def search_view(self, request):
+        """
+        JSON for the remote mode of `menuhin.widgets.MenuItemSelect`;
+        published items for the current site whose title or URL start with
+        `q`, a page (of MENUHIN_WIDGET_PAGE_SIZE) at a time.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied("Cannot search menu items")
+
+        page_size = getattr(settings, 'MENUHIN_WIDGET_PAGE_SIZE', 20)
+        try:
+            page = max(1, int(request.GET.get('page', 1)))
+        except ValueError:
+            page = 1
+        start = (page - 1) * page_size
+        items = list(search_menu_items(model=self.model,
+                                       term=request.GET.get('q', ''))
+                     [start:start + page_size + 1])
+        results = [{'value': x['uri'], 'pk': x['pk'], 'depth': x['depth'],
+                    'label': depth_label(x['title'], x['depth'])}
+                   for x in items[:page_size]]
+        data = {'results': results, 'more': len(items) > page_size}
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
     def import_view(self, request):
         if not self.has_add_permission(request):
@@ -84,44 +228,32 @@ class MenuItemAdmin(TreeAdmin):
         form = ImportMenusForm(data=request.POST or None, files=None)
 
         app_label = self.model._meta.app_label
-        if hasattr(self.model._meta, 'model_name'):
-            model_name = self.model._meta.model_name
-        else:
-            model_name = self.model._meta.module_name
+        model_name = _model_name(self.model)
 
         do_ajax = request.method == 'POST' and request.is_ajax()
         do_post = request.method == 'POST' and not request.is_ajax()
 
         if do_ajax:
             if form.is_valid():
-                urls = form._menu_class_instance_from_cleaned_data().get_urls()
-                missing = find_missing(model=self.model, urls=tuple(urls))
-                if missing is not None:
-                    missing = tuple(missing)
-                templates = (
-                    "admin/{0}/{1}/missing_ajax.html".format(app_label,
-                                                             model_name),
-                    "admin/{0}/missing_ajax.html".format(app_label)
-                )
-                status_code = 200
-                if missing is None or len(missing) == 0:
-                    status_code = 202
-                return TemplateResponse(request, templates,
-                                        {'missing': missing},
-                                        status=status_code,
-                                        current_app=self.admin_site.name)
+                job = form.create_job(kind=ImportJob.PREVIEW)
+                start_import_job(job)
+                return self._import_job_response(job, status=202)
             else:
                 return HttpResponseForbidden("Invalid form data")
 
         if do_post and form.is_valid():
-            result = form.save()
-            if result is None:
-                self.message_user(request, "No items imported",
-                                  level=messages.ERROR)
-            else:
-                msg = "Imported {count} successfully".format(count=len(result))
-                self.message_user(request, msg, level=messages.SUCCESS)
-            return redirect(admin_urlname(self.model._meta, 'changelist'))
+            job = form.create_job(kind=ImportJob.IMPORT)
+            start_import_job(job)
+            self.message_user(request, "Import started",
+                              level=messages.INFO)
+            return redirect('{url}?job={pk}'.format(
+                url=reverse(admin_urlname(self.model._meta, 'import')),
+                pk=job.pk))
+
+        job = None
+        job_pk = request.GET.get('job', '')
+        if job_pk.isdigit():
+            job = self.get_import_job(job_pk)
 
         templates = (
             "admin/{0}/{1}/import_form.html".format(app_label, model_name),
@@ -140,9 +272,68 @@ class MenuItemAdmin(TreeAdmin):
             'has_delete_permission': False,
             'has_add_permission': False,
             'has_change_permission': False,
+            'job': job,
         }
         return TemplateResponse(request, templates, context,
                                 current_app=self.admin_site.name)
 
+    def get_import_job(self, pk):
+        try:
+            return ImportJob.objects.get(pk=pk)
+        except ImportJob.DoesNotExist:
+            return None
+
+    def _import_job_response(self, job, status=200):
+        data = job.as_dict()
+        opts = self.model._meta
+        data.update(
+            status_url=reverse(admin_urlname(opts, 'import_status'),
+                               kwargs={'pk': job.pk}),
+            missing_url=reverse(admin_urlname(opts, 'import_missing'),
+                                kwargs={'pk': job.pk}))
+        return HttpResponse(json.dumps(data), status=status,
+                            content_type='application/json')
+
+    def import_status_view(self, request, pk):
+        """
+        JSON describing an import job's progress, for polling.
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied("Cannot add new menu items")
+        job = self.get_import_job(pk)
+        if job is None:
+            raise Http404("No such import")
+        return self._import_job_response(job)
+
+    def import_missing_view(self, request, pk):
+        """
+        A page (of MENUHIN_IMPORT_PREVIEW_PAGE_SIZE) of the URLs a finished
+        preview found missing. As before, the response is a 202 if there
+        were none.
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied("Cannot add new menu items")
+        job = self.get_import_job(pk)
+        if job is None:
+            raise Http404("No such import")
+        missing = job.get_missing()
+        paginator = Paginator(missing, getattr(
+            settings, 'MENUHIN_IMPORT_PREVIEW_PAGE_SIZE', 100))
+        try:
+            page = paginator.page(request.GET.get('page', 1))
+        except InvalidPage:
+            raise Http404("No such page")
+        info = self.model._meta.app_label, _model_name(self.model)
+        templates = (
+            "admin/{0}/{1}/missing_ajax.html".format(*info),
+            "admin/{0}/missing_ajax.html".format(info[0])
+        )
+        status_code = 200 if missing else 202
+        return TemplateResponse(request, templates,
+                                {'missing': page.object_list, 'page': page,
+                                 'job': job},
+                                status=status_code,
+                                current_app=self.admin_site.name)
+
 
 admin.site.register(MenuItem, MenuItemAdmin)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class MenuhinConfig(AppConfig):
+    name = 'menuhin'
+
+    def ready(self):
+        from .utils import menu_registry
+        # a missing setting is reported by the checks framework instead.
+        if getattr(settings, 'MENUHIN_MENU_HANDLERS', None) is not None:
+            menu_registry.populate()
+        if getattr(settings, 'MENUHIN_WARM_ON_STARTUP', False):
+            from .warming import warm_on_startup
+            warm_on_startup()
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from django.conf import settings
+
+try:
+    from importlib import import_module
+except ImportError:  # pragma: no cover
+    from django.utils.importlib import import_module
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # pragma: no cover (Django < 1.8)
+    from django.test.signals import setting_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_message(token, site_ids):
+    if site_ids is None:
+        return '{0} *'.format(token)
+    return ' '.join([token] + [str(x) for x in site_ids])
+
+
+def decode_message(line):
+    parts = line.split()
+    if not parts:
+        return None
+    if parts[1:] == ['*']:
+        return parts[0], None
+    return parts[0], tuple(int(x) for x in parts[1:])
+
+
+class LocalTransport(object):
+    """
+    Nothing leaves the process; fine for tests, and single process servers.
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def start(self, deliver):
+        pass
+
+    def publish(self, token, site_ids):
+        pass
+
+    def poll(self):
+        return ()
+
+
+class FileTransport(object):
+    """
+    Messages are appended to `path` (by default, `menuhin-invalidations` in
+    the temporary directory), which must be shared by every process. A poll
+    is a stat() unless the file has changed.
+
+    Once the file is over `max_size` bytes (by default, 1MB), it's replaced
+    with a new one, starting with a line which tells every process that
+    anything may have changed. Each process remembers the first line of the
+    file it's reading, so notices the replacement even if the new file
+    reuses the old one's inode.
+    """
+    def __init__(self, path=None, max_size=1024 * 1024, **options):
+        if path is None:
+            path = os.path.join(tempfile.gettempdir(),
+                                'menuhin-invalidations')
+        self.path = path
+        self.max_size = max_size
+        self.offset = 0
+        self.first_line = None
+        self.seen = None
+        self.lock = threading.Lock()
+
+    def start(self, deliver):
+        # only what's published from now on is of interest.
+        try:
+            with open(self.path, 'r') as handle:
+                self.first_line = self.read_first_line(handle)
+                handle.seek(0, os.SEEK_END)
+                self.offset = handle.tell()
+        except (IOError, OSError):
+            self.offset, self.first_line = 0, None
+
+    def read_first_line(self, handle):
+        line = handle.readline()
+        # one still being written can't tell files apart yet.
+        return line if line.endswith('\n') else None
+
+    def publish(self, token, site_ids):
+        line = encode_message(token, site_ids) + '\n'
+        # a single small write in append mode isn't interleaved with other
+        # processes' writes.
+        with open(self.path, 'a') as handle:
+            handle.write(line)
+            size = handle.tell()
+        if self.max_size and size > self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        """
+        Renames a new file into place, holding only a message saying that
+        anything may have changed.
+        """
+        handle, temporary = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or None,
+            prefix='.menuhin-invalidations-')
+        try:
+            with os.fdopen(handle, 'w') as output:
+                output.write(encode_message(uuid.uuid4().hex, None) + '\n')
+            os.chmod(temporary, 0o644)
+            getattr(os, 'replace', os.rename)(temporary, self.path)
+        except Exception:
+            os.unlink(temporary)
+            raise
+
+    def poll(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return ()
+        seen = (stat.st_ino, stat.st_size, stat.st_mtime)
+        messages = []
+        with self.lock:
+            if seen == self.seen:
+                return ()
+            self.seen = seen
+            with open(self.path, 'r') as handle:
+                first_line = self.read_first_line(handle)
+                if (self.first_line is not None and
+                        first_line is not None and
+                        first_line != self.first_line):
+                    # replaced, and its first line says everything changed.
+                    self.offset = 0
+                handle.seek(0, os.SEEK_END)
+                size = handle.tell()
+                if size < self.offset:
+                    # truncated, so whatever was in it is unknown.
+                    self.offset, first_line = 0, None
+                    messages.append(('', None))
+                if first_line is not None:
+                    self.first_line = first_line
+                handle.seek(self.offset)
+                data = handle.read(size - self.offset)
+            # a line still being written is left for the next poll.
+            complete = data.rfind('\n') + 1
+            self.offset += complete
+        decoded = (decode_message(x) for x in data[:complete].splitlines())
+        messages.extend(x for x in decoded if x is not None)
+        return tuple(messages)
+
+
+class RedisTransport(object):
+    """
+    Publishes to `channel` on the Redis server at `url`, with a background
+    thread in each process listening for messages. Requires the `redis`
+    package.
+    """
+    def __init__(self, url='redis://localhost:6379/0',
+                 channel='menuhin:invalidations', **options):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.channel = channel
+        self.thread = None
+
+    def start(self, deliver):
+        self.thread = threading.Thread(target=self.listen, args=(deliver,),
+                                       name='menuhin-invalidations')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listen(self, deliver):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.channel)
+                # anything published while disconnected was missed.
+                deliver(('', None))
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = message['data']
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    decoded = decode_message(data)
+                    if decoded is not None:
+                        deliver(decoded)
+            except Exception:
+                logger.exception("Lost the connection to Redis, retrying")
+                time.sleep(1)
+
+    def publish(self, token, site_ids):
+        self.client.publish(self.channel, encode_message(token, site_ids))
+
+    def poll(self):
+        return ()
+
+
+class InvalidationBus(object):
+    """
+    Hands each message to the subscribed callables, once in the process
+    which published it (straight away) and once in every other process
+    (when it arrives).
+    """
+    def __init__(self, transport, poll_interval=1):
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self.token = uuid.uuid4().hex
+        #: a bus built before the process forked (eg: by gunicorn --preload)
+        #: would share its token, and lack the transport's threads.
+        self.pid = os.getpid()
+        self.subscribers = []
+        self.last_poll = 0
+        self.lock = threading.Lock()
+        transport.start(self.receive)
+
+    def subscribe(self, callback):
+        if callback not in self.subscribers:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def deliver(self, site_ids):
+        for callback in tuple(self.subscribers):
+            callback(site_ids)
+
+    def receive(self, message):
+        token, site_ids = message
+        if token != self.token:
+            self.deliver(site_ids)
+
+    def publish(self, site_ids):
+        if site_ids is not None:
+            site_ids = tuple(site_ids)
+        self.deliver(site_ids)
+        try:
+            self.transport.publish(self.token, site_ids)
+        except Exception:
+            logger.exception("Couldn't tell other processes that the menus "
+                             "for {0!r} changed".format(site_ids))
+
+    def poll(self, force=False):
+        """
+        Deliver anything other processes have published, at most every
+        `poll_interval` seconds unless `force` is True.
+        """
+        now = time.time()
+        if not force and now - self.last_poll < self.poll_interval:
+            return None
+        with self.lock:
+            self.last_poll = now
+            try:
+                messages = self.transport.poll()
+            except Exception:
+                logger.exception("Couldn't check for menu changes")
+                messages = ()
+        for message in messages:
+            self.receive(message)
+        return len(messages)
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_transport_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+def get_bus():
+    global _bus
+    with _bus_lock:
+        if _bus is None or _bus.pid != os.getpid():
+            transport_class = get_transport_class(getattr(
+                settings, 'MENUHIN_INVALIDATION_TRANSPORT',
+                'menuhin.bus.LocalTransport'))
+            options = getattr(settings, 'MENUHIN_INVALIDATION_OPTIONS', {})
+            _bus = InvalidationBus(
+                transport=transport_class(**options),
+                poll_interval=getattr(
+                    settings, 'MENUHIN_INVALIDATION_POLL_INTERVAL', 1))
+        return _bus
+
+
+def _reset_bus(sender, setting, **kwargs):
+    global _bus
+    if setting.startswith('MENUHIN_INVALIDATION_'):
+        with _bus_lock:
+            _bus = None
+
+
+setting_changed.connect(_reset_bus, dispatch_uid='menuhin_reset_bus')
+
+
+def publish_tree_changed(sender, site_ids, **kwargs):
+    """
+    `menuhin.signals.tree_changed` listener to tell every process.
+    """
+    get_bus().publish(site_ids)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+
+
+MAGIC = b'MNHT'
+FORMAT_VERSION = 2
+#: magic, format version, flags, site, tree version, nodes
+HEADER = struct.Struct('<4sHHIII')
+#: set in the header's flags when everything after it is zlib compressed.
+COMPRESSED = 0x1
+#: set in a node's flags when it's published.
+PUBLISHED = 0x1
+STRING_FIELDS = ('path', 'uri', 'title', 'menu_slug')
+
+
+class CodecError(ValueError): pass  # noqa
+
+
+Header = namedtuple('Header', ('format_version', 'flags', 'site_id',
+                               'version', 'count'))
+
+
+class Node(namedtuple('Node', ('pk', 'depth', 'numchild', 'is_published',
+                               'path', 'uri', 'title', 'menu_slug'))):
+    """
+    A decoded menu item, with enough of `MenuItem`'s interface for
+    `MenuItem._annotate_published`.
+    """
+    def get_depth(self):
+        return self.depth
+
+    def get_absolute_url(self):
+        return self.uri
+
+    def is_leaf(self):
+        return self.numchild == 0
+
+
+def _to_bytes(column):
+    if sys.byteorder == 'big':  # pragma: no cover
+        column = array(column.typecode, column)
+        column.byteswap()
+    try:
+        return column.tobytes()
+    except AttributeError:  # pragma: no cover (Python 2)
+        return column.tostring()
+
+
+def _from_bytes(typecode, data):
+    column = array(typecode)
+    try:
+        column.frombytes(data)
+    except AttributeError:  # pragma: no cover (Python 2)
+        column.fromstring(data)
+    if sys.byteorder == 'big':  # pragma: no cover
+        column.byteswap()
+    return column
+
+
+def _padding(size, to=4):
+    return b'\0' * (-size % to)
+
+
+class Layout(namedtuple('Layout', ('count', 'pks', 'numchilds', 'depths',
+                                   'flags', 'offsets', 'strings'))):
+    """
+    Where each column starts, relative to the end of the header: primary
+    keys and child counts (4 bytes each), depths (2), flags (1), then for
+    each of `STRING_FIELDS` the offsets (4) of every node's value into that
+    field's table of UTF-8 strings, which follow one after another.
+    """
+    @classmethod
+    def for_count(cls, count):
+        pks = 0
+        numchilds = pks + 4 * count
+        depths = numchilds + 4 * count
+        flags = depths + 2 * count
+        offsets = flags + count
+        offsets += len(_padding(offsets))
+        strings = offsets + 4 * len(STRING_FIELDS) * (count + 1)
+        return cls(count=count, pks=pks, numchilds=numchilds, depths=depths,
+                   flags=flags, offsets=offsets, strings=strings)
+
+    def offsets_for(self, field):
+        return self.offsets + 4 * field * (self.count + 1)
+
+
+def encode_tree(rows, site_id=0, version=0, compress=False):
+    """
+    The given (pk, depth, numchild, is_published, path, uri, title,
+    menu_slug) rows, in the order given (for trees, path order), as
+    little-endian columns after a header, optionally zlib compressed.
+    """
+    pks, numchilds, depths, flags = (array('I'), array('I'), array('H'),
+                                     array('B'))
+    offsets = [array('I', [0]) for x in STRING_FIELDS]
+    sizes = [0] * len(STRING_FIELDS)
+    tables = [[] for x in STRING_FIELDS]
+    for row in rows:
+        pk, depth, numchild, is_published = row[:4]
+        pks.append(pk)
+        numchilds.append(numchild)
+        depths.append(depth)
+        flags.append(PUBLISHED if is_published else 0)
+        for field, value in enumerate(row[4:]):
+            encoded = (value or '').encode('utf-8')
+            tables[field].append(encoded)
+            sizes[field] += len(encoded)
+            offsets[field].append(sizes[field])
+    body = [_to_bytes(pks), _to_bytes(numchilds), _to_bytes(depths),
+            _to_bytes(flags)]
+    body.append(_padding(sum(len(x) for x in body)))
+    body.extend(_to_bytes(x) for x in offsets)
+    for table in tables:
+        body.extend(table)
+    body = b''.join(body)
+    header_flags = 0
+    if compress:
+        body = zlib.compress(body)
+        header_flags |= COMPRESSED
+    return HEADER.pack(MAGIC, FORMAT_VERSION, header_flags, site_id, version,
+                       len(pks)) + body
+
+
+def decode_header(data):
+    if len(data) < HEADER.size:
+        raise CodecError("Too short to be an encoded tree")
+    magic, format_version, flags, site_id, version, count = \
+        HEADER.unpack_from(data, 0)
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        raise CodecError("Not a version {0} encoded tree".format(
+            FORMAT_VERSION))
+    return Header(format_version=format_version, flags=flags,
+                  site_id=site_id, version=version, count=count)
+
+
+def get_body(data, header=None):
+    """
+    Everything after the header, decompressed if need be, and checked to
+    be the right size.
+    """
+    if header is None:
+        header = decode_header(data)
+    body = data[HEADER.size:]
+    if header.flags & COMPRESSED:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise CodecError("Couldn't decompress the tree: {0}".format(e))
+    layout = Layout.for_count(header.count)
+    if len(body) < layout.strings:
+        raise CodecError("The encoded tree is truncated")
+    size = sum(struct.unpack_from('<I', body, layout.offsets_for(x) +
+                                  4 * header.count)[0]
+               for x in range(len(STRING_FIELDS)))
+    if layout.strings + size != len(body):
+        raise CodecError("The encoded tree is the wrong size")
+    return body
+
+
+def decode_tree(data):
+    """
+    The `Node`s of an encoded tree, all at once.
+    """
+    header = decode_header(data)
+    body = get_body(data, header)
+    layout = Layout.for_count(header.count)
+    count = header.count
+    pks = _from_bytes('I', body[layout.pks:layout.pks + 4 * count])
+    numchilds = _from_bytes('I', body[layout.numchilds:
+                                      layout.numchilds + 4 * count])
+    depths = _from_bytes('H', body[layout.depths:layout.depths + 2 * count])
+    flags = _from_bytes('B', body[layout.flags:layout.flags + count])
+    columns = []
+    start = layout.strings
+    for field in range(len(STRING_FIELDS)):
+        at = layout.offsets_for(field)
+        offsets = _from_bytes('I', body[at:at + 4 * (count + 1)])
+        table = body[start:start + offsets[-1]]
+        columns.append([table[offsets[x]:offsets[x + 1]].decode('utf-8')
+                        for x in range(count)])
+        start += offsets[-1]
+    return [Node(pk, depth, numchild, bool(flag & PUBLISHED), path, uri,
+                 title, menu_slug or None)
+            for pk, depth, numchild, flag, path, uri, title, menu_slug
+            in zip(pks, depths, numchilds, flags, *columns)]
+
+
+class TreeReader(object):
+    """
+    Random access to the nodes of an uncompressed encoded tree held in any
+    buffer (eg: a memory map), decoding only what's asked for.
+    """
+    def __init__(self, data):
+        header = decode_header(data)
+        if header.flags & COMPRESSED:
+            raise CodecError("Compressed trees can't be read in place")
+        self.data = data
+        self.site_id = header.site_id
+        self.version = header.version
+        self.count = header.count
+        layout = Layout.for_count(header.count)
+        base = HEADER.size
+        if len(data) < base + layout.strings:
+            raise CodecError("The encoded tree is truncated")
+        self.pks_at = base + layout.pks
+        self.numchilds_at = base + layout.numchilds
+        self.depths_at = base + layout.depths
+        self.flags_at = base + layout.flags
+        self.offsets_at = [base + layout.offsets_for(x)
+                           for x in range(len(STRING_FIELDS))]
+        self.tables_at = []
+        at = base + layout.strings
+        for offsets_at in self.offsets_at:
+            self.tables_at.append(at)
+            at += struct.unpack_from('<I', data, offsets_at + 4 * self.count)[0]
+        if at != len(data):
+            raise CodecError("The encoded tree is the wrong size")
+
+    def __len__(self):
+        return self.count
+
+    def get_string(self, field, index):
+        start, end = struct.unpack_from('<II', self.data,
+                                        self.offsets_at[field] + 4 * index)
+        table = self.tables_at[field]
+        return self.data[table + start:table + end].decode('utf-8')
+
+    def get_path(self, index):
+        return self.get_string(0, index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        unpack = struct.unpack_from
+        return Node(
+            pk=unpack('<I', self.data, self.pks_at + 4 * index)[0],
+            depth=unpack('<H', self.data, self.depths_at + 2 * index)[0],
+            numchild=unpack('<I', self.data,
+                            self.numchilds_at + 4 * index)[0],
+            is_published=bool(unpack('<B', self.data, self.flags_at +
+                                     index)[0] & PUBLISHED),
+            path=self.get_string(0, index),
+            uri=self.get_string(1, index),
+            title=self.get_string(2, index),
+            menu_slug=self.get_string(3, index) or None)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
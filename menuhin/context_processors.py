@@ -1,6 +1,8 @@
 
 from .models import MenuItem
-from .utils import LengthLazyObject, get_relations_for_request
+from .utils import (LengthLazyObject, get_relations_for_request,
+                    get_current_site)
+from .versions import get_tree_version
 
 
 def request_ancestors(request):
@@ -29,3 +31,14 @@ def request_descendants(request):
     return {
         'MENUHIN_DESCENDANTS': descendants
     }
+
+
+def tree_version(request):
+    """
+    The current site's tree version, for use in template fragment cache
+    keys, eg: ``{% cache 600 sidebar MENUHIN_TREE_VERSION %}``
+    """
+    return {
+        'MENUHIN_TREE_VERSION': get_tree_version(
+            get_current_site(request).pk)
+    }
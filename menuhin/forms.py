@@ -12,7 +12,7 @@ try:
 except ImportError:  # pragma: no cover
     text_type = unicode
 from .utils import _collect_menus, update_all_urls
-from .models import MenuItem
+from .models import MenuItem, ImportJob
 
 
 class MenuItemTreeForm(MoveNodeForm):
@@ -89,6 +89,15 @@ class ImportMenusForm(Form):
                 return menu.instance
         raise ValueError("Menu instance went missing.")
 
+    def create_job(self, kind=ImportJob.IMPORT):
+        """
+        An ImportJob for the selected menu and site, to be given to
+        `menuhin.jobs.start_import_job` rather than saving in the request.
+        """
+        return ImportJob.objects.create(handler=self.cleaned_data['klass'],
+                                        site=self.cleaned_data['site'],
+                                        kind=kind)
+
     def save(self):
         klass = self._menu_class_instance_from_cleaned_data()
         possibilities = tuple(klass.get_urls())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import MenuItem, ImportJob
+from .utils import (_collect_menus, chunked, diff_urls, sync_urls,
+                    get_sync_chunk_size)
+from .versions import _in_transaction
+
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+_state = threading.local()
+
+
+def get_handler(path):
+    for menu in _collect_menus():
+        if menu.path == path:
+            return menu.instance
+    raise ValueError("No menu handler called {0}".format(path))
+
+
+def run_import_job(job_pk):
+    """
+    Works through the job's handler URLs a chunk at a time, finding (and
+    for imports, inserting) those the site lacks, saving the progress made
+    after each chunk.
+    """
+    try:
+        job = ImportJob.objects.get(pk=job_pk)
+    except ImportJob.DoesNotExist:
+        logger.error("Import job {0} went missing".format(job_pk))
+        return None
+    if job.status != ImportJob.PENDING:
+        return job
+    claimed = ImportJob.objects.filter(
+        pk=job.pk, status=ImportJob.PENDING).update(
+        status=ImportJob.RUNNING, modified=timezone.now())
+    if not claimed:
+        # started elsewhere since it was fetched.
+        return ImportJob.objects.get(pk=job_pk)
+
+    job.status = ImportJob.RUNNING
+    try:
+        urls = tuple(frozenset(get_handler(job.handler).get_urls()))
+        job.total = len(urls)
+        job.save()
+        missing = []
+        for chunk in chunked(urls, get_sync_chunk_size()):
+            if job.kind == ImportJob.IMPORT:
+                result = sync_urls(model=MenuItem, urls=chunk,
+                                   site_id=job.site_id, partial=True,
+                                   update_titles=False)
+                job.inserted += len(result.inserted)
+            else:
+                diff = diff_urls(model=MenuItem, urls=chunk,
+                                 site_id=job.site_id, partial=True)
+                missing.extend(diff.added)
+            job.processed += len(chunk)
+            job.save()
+        job.set_missing(missing)
+        job.status = ImportJob.FINISHED
+        job.save()
+    except Exception as e:
+        logger.exception("Import job {0} failed".format(job_pk))
+        job.status = ImportJob.FAILED
+        job.error = '{0}: {1}'.format(e.__class__.__name__, e)
+        job.save()
+    return job
+
+
+def _run_in_thread(job_pk):
+    try:
+        return run_import_job(job_pk)
+    finally:
+        # each pool thread has a connection of its own.
+        connection.close()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'MENUHIN_IMPORT_THREADS',
+                                       2))
+        return _pool
+
+
+def get_runner():
+    """
+    Either 'thread' (the default) or 'celery', per MENUHIN_IMPORT_RUNNER.
+    """
+    return getattr(settings, 'MENUHIN_IMPORT_RUNNER', 'thread')
+
+
+def _dispatch(job_pk):
+    if get_runner() == 'celery':
+        from .tasks import run_import_job_task
+        return run_import_job_task.delay(job_pk)
+    return get_pool().apply_async(_run_in_thread, (job_pk,))
+
+
+def start_import_job(job):
+    """
+    Runs the job in the background, which looks it up again from elsewhere,
+    so inside a transaction it's only started once that's over: at the end
+    of the request, or on commit with Django 1.9+. Outside of requests,
+    call `start_pending_jobs` after committing.
+    """
+    if not _in_transaction():
+        return _dispatch(job.pk)
+    pending = getattr(_state, 'pending', None)
+    if pending is None:
+        pending = _state.pending = []
+    pending.append(job.pk)
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:  # pragma: no cover (Django 1.9+)
+        on_commit(start_pending_jobs)
+    return None
+
+
+def start_pending_jobs():
+    """
+    Starts the jobs which were waiting for their transaction to be over.
+    """
+    pending = getattr(_state, 'pending', None)
+    _state.pending = []
+    return [_dispatch(x) for x in pending or ()]
+
+
+def discard_pending_jobs():
+    """
+    Forgets the jobs waiting for their transaction, eg: between tests,
+    whose transactions are always rolled back.
+    """
+    _state.pending = []
+
+
+def start_at_request_end(sender, **kwargs):
+    """
+    request_finished listener to start any jobs still pending.
+    """
+    start_pending_jobs()
+
+
+request_finished.connect(start_at_request_end,
+                         dispatch_uid='menuhin_start_pending_import_jobs')
@@ -1,10 +1,146 @@
+import functools
+import operator
+import threading
+from contextlib import contextmanager
 try:
     from django.utils.encoding import force_text
 except ImportError:
     from django.utils.encoding import force_unicode as force_text
-from django.contrib.sites.models import Site
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.conf import settings
+from django.utils import timezone
 from .models import MenuItem, ModelURI
-from .utils import update_all_urls, get_title
+from .versions import defer_version_bumps
+from .utils import (update_all_urls, get_title, sync_urls, chunked,
+                    normalize_uri, get_sync_chunk_size, get_current_site)
+
+
+_state = threading.local()
+
+
+class PendingMenuChanges(object):
+    """
+    Menu maintenance collected by the listeners, to be applied in bulk by
+    `flush` rather than as each instance is saved or deleted.
+    """
+    def __init__(self, using):
+        self.using = using
+        self.creates = []
+        self.moves = []
+        self.unpublishes = []
+
+    def __len__(self):
+        return len(self.creates) + len(self.moves) + len(self.unpublishes)
+
+    def flush(self):
+        creates, moves, unpublishes = (self.creates, self.moves,
+                                       self.unpublishes)
+        self.creates, self.moves, self.unpublishes = [], [], []
+        if not (creates or moves or unpublishes):
+            return None
+
+        site = get_current_site()
+        with defer_version_bumps():
+            if creates:
+                sync_urls(model=MenuItem, urls=creates, site_id=site.pk,
+                          partial=True, update_titles=False)
+
+            items = MenuItem.objects.using(self.using).filter(site=site)
+            for old_url, new_url, new_title in coalesce_moves(moves):
+                update_on = {'uri': new_url, 'modified': timezone.now()}
+                if new_title is not None:
+                    update_on.update(title=new_title)
+                items.filter(uri__iexact=old_url).update(**update_on)
+
+            unpublish_urls(unpublishes, site=site, using=self.using)
+        return len(creates) + len(moves) + len(unpublishes)
+
+
+def unpublish_urls(urls, site, using=DEFAULT_DB_ALIAS, descendants=None):
+    """
+    Unpublish the site's menu items for the given URLs, matched without
+    regard to case (as the syncing does), in chunked updates. If
+    `descendants` is True (by default, the MENUHIN_UNPUBLISH_DESCENDANTS
+    setting), everything below those items in the tree is unpublished too.
+    """
+    if descendants is None:
+        descendants = getattr(settings, 'MENUHIN_UNPUBLISH_DESCENDANTS',
+                              False)
+    items = MenuItem.objects.using(using).filter(site=site)
+    updated = 0
+    with defer_version_bumps():
+        for chunk in chunked(frozenset(urls), get_sync_chunk_size()):
+            matched = items.filter(functools.reduce(
+                operator.or_, (Q(uri__iexact=x) for x in chunk)))
+            if descendants:
+                paths = tuple(matched.values_list('path', flat=True))
+                if not paths:
+                    continue
+                matched = items.filter(functools.reduce(
+                    operator.or_, (Q(path__startswith=x) for x in paths)))
+            updated += matched.update(is_published=False,
+                                      modified=timezone.now())
+    return updated
+
+
+def coalesce_moves(moves):
+    """
+    Collapse chains of (old_url, new_url, new_title) moves (a -> b, b -> c)
+    into one (a -> c) with the latest title, dropping any which end up
+    where they started without a title to change.
+    """
+    final = []
+    by_destination = {}
+    for old_url, new_url, new_title in moves:
+        entry = by_destination.pop(normalize_uri(old_url), None)
+        if entry is None:
+            entry = [old_url, new_url, new_title]
+            final.append(entry)
+        else:
+            entry[1] = new_url
+            if new_title is not None:
+                entry[2] = new_title
+        by_destination[normalize_uri(new_url)] = entry
+    return [tuple(x) for x in final
+            if normalize_uri(x[0]) != normalize_uri(x[1]) or x[2] is not None]
+
+
+def _pending_changes(using):
+    """
+    Where a listener should put its change inside `defer_menu_updates`, or
+    None if it should be applied immediately.
+    """
+    deferred = getattr(_state, 'deferred', None)
+    if deferred is None:
+        return None
+    if using not in deferred:
+        deferred[using] = PendingMenuChanges(using=using)
+    return deferred[using]
+
+
+@contextmanager
+def defer_menu_updates():
+    """
+    Collect all menu maintenance done by the listeners within the block,
+    applying it in bulk when the block exits, eg: for imports::
+
+        with defer_menu_updates():
+            for row in rows:
+                MyModel.objects.create(**row)
+    """
+    if getattr(_state, 'deferred', None) is not None:
+        # already deferring; the outermost block does the work.
+        yield
+        return
+    _state.deferred = {}
+    try:
+        yield
+    finally:
+        deferred, _state.deferred = _state.deferred, None
+    for pending in deferred.values():
+        pending.flush()
 
 
 def create_menu_url(sender, instance, created, **kwargs):
@@ -21,13 +157,66 @@ def create_menu_url(sender, instance, created, **kwargs):
     title = get_title(instance)
     abs_url = instance.get_absolute_url()
     uri = ModelURI(path=abs_url, title=title, model_instance=instance)
+    pending = _pending_changes(kwargs.get('using') or DEFAULT_DB_ALIAS)
+    if pending is not None:
+        pending.creates.append(uri)
+        return None
     return update_all_urls(model=MenuItem, possible_urls=(uri,))
 
 
+def _has_deferred_fields(instance):
+    if hasattr(instance, 'get_deferred_fields'):
+        return len(instance.get_deferred_fields()) > 0
+    return getattr(instance, '_deferred', False)
+
+
+def _menu_state(instance):
+    max_length = MenuItem._meta.get_field_by_name('title')[0].max_length
+    return (instance.get_absolute_url(), get_title(instance)[:max_length])
+
+
+def remember_menu_state(sender, instance, **kwargs):
+    """
+    post_init and post_save listener to remember the field values an
+    instance was loaded (or last saved) with, so that update_old_url
+    needn't query for its old URL and title when it is saved. They're only
+    worked out then, so loading instances stays cheap. Instances with
+    deferred fields are skipped, as working out their URL may itself need
+    queries.
+    """
+    if instance.pk is None:
+        return None
+
+    if not hasattr(instance, 'get_absolute_url'):
+        return None
+
+    if _has_deferred_fields(instance):
+        return None
+
+    instance._menuhin_original = dict(
+        (key, value) for key, value in instance.__dict__.items()
+        if key not in ('_state', '_menuhin_original'))
+    return instance._menuhin_original
+
+
+def _remembered_menu_state(instance, values):
+    """
+    The URL and title of a stand-in for the instance, with the field values
+    remember_menu_state kept.
+    """
+    original = instance.__class__.__new__(instance.__class__)
+    original.__dict__.update(values)
+    original._state = instance._state
+    return _menu_state(original)
+
+
 def update_old_url(sender, instance, raw, using, **kwargs):
     """
-    pre_save listener to update a URL if it moves. Requires an existing
-    instance and a get_absolute_url implementation.
+    pre_save listener to update a URL (and title) if it changes. Requires an
+    existing instance and a get_absolute_url implementation.
+
+    If remember_menu_state is connected for the model, the values the
+    instance was loaded with are used; otherwise, they're fetched again.
     """
     if not instance.pk:
         return None
@@ -35,14 +224,29 @@ def update_old_url(sender, instance, raw, using, **kwargs):
     if not hasattr(instance, 'get_absolute_url'):
         return None
 
-    new_url = instance.get_absolute_url()
-    old_instance = instance.__class__.objects.using(using).get(pk=instance.pk)
-    old_url = old_instance.get_absolute_url()
-    if old_url == new_url:
+    new_url, new_title = _menu_state(instance)
+    values = getattr(instance, '_menuhin_original', None)
+    # instances built by hand, rather than loaded, may have been given
+    # a pk, so their snapshot is of the new values, not the stored ones.
+    if values is None or instance._state.adding:
+        old_instance = instance.__class__.objects.using(using).get(
+            pk=instance.pk)
+        old_url, old_title = _menu_state(old_instance)
+    else:
+        # the snapshot is left alone until the save succeeds, when
+        # remember_menu_state (on post_save) takes another.
+        old_url, old_title = _remembered_menu_state(instance, values)
+    if old_url == new_url and old_title == new_title:
         return None
 
-    filter_by = {'uri__iexact': old_url, 'site': Site.objects.get_current()}
-    update_on = {'uri': new_url}
+    pending = _pending_changes(using)
+    if pending is not None:
+        pending.moves.append((old_url, new_url, new_title))
+        return None
+
+    filter_by = {'uri__iexact': old_url, 'site': get_current_site()}
+    update_on = {'uri': new_url, 'title': new_title,
+                 'modified': timezone.now()}
     return MenuItem.objects.using(using).filter(**filter_by).update(
         **update_on)
 
@@ -54,5 +258,28 @@ def unpublish_on_delete(sender, instance, **kwargs):
     if not hasattr(instance, 'get_absolute_url'):
         return None
     old_url = instance.get_absolute_url()
-    filter_by = {'uri__iexact': old_url, 'site': Site.objects.get_current()}
-    return MenuItem.objects.filter(**filter_by).update(is_published=False)
+
+    using = kwargs.get('using') or DEFAULT_DB_ALIAS
+    pending = _pending_changes(using)
+    if pending is not None:
+        pending.unpublishes.append(force_text(old_url))
+        return None
+
+    return unpublish_urls((force_text(old_url),),
+                          site=get_current_site(), using=using)
+
+
+class MenuAwareQuerySetMixin(object):
+    """
+    Collects the menu items to unpublish for everything a delete() removes
+    (via unpublish_on_delete) and unpublishes them together, rather than
+    one UPDATE per instance.
+    """
+    def delete(self):
+        with defer_menu_updates():
+            return super(MenuAwareQuerySetMixin, self).delete()
+    delete.alters_data = True
+
+
+class MenuAwareQuerySet(MenuAwareQuerySetMixin, QuerySet):
+    pass
@@ -1,11 +1,12 @@
-from itertools import chain
+import json
 from optparse import make_option
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.contrib.sites.models import Site
 from menuhin.models import MenuItem
-from menuhin.utils import (_collect_menus, find_missing,
-                           ensure_default_for_site, add_urls)
+from menuhin.utils import (_collect_menus, ensure_default_for_site,
+                           diff_urls, apply_diff, SyncResult, collect_urls,
+                           record_watermarks)
 
 
 class Command(BaseCommand):
@@ -30,11 +31,39 @@ class Command(BaseCommand):
                     default=False,
                     help='Tells Django to NOT prompt the user for input '
                     'of any kind.'),
+
+        make_option('--unpublish',
+                    action='store_true',
+                    dest='unpublish',
+                    default=False,
+                    help='Unpublish menu items whose URLs are no longer '
+                    'provided by any of the MENUHIN_MENU_HANDLERS.'),
+
+        make_option('--update-titles',
+                    action='store_true',
+                    dest='update_titles',
+                    default=False,
+                    help='Update the titles of existing menu items to '
+                    'match the MENUHIN_MENU_HANDLERS.'),
+
+        make_option('--full',
+                    action='store_true',
+                    dest='full',
+                    default=False,
+                    help='Ask every handler for all of its URLs, ignoring '
+                    'when they were last synced.'),
+
+        make_option('--json',
+                    action='store_true',
+                    dest='as_json',
+                    default=False,
+                    help='Output a JSON report of the changes instead.'),
     )
 
     def handle(self, *args, **options):
         verbosity = int(options.get('verbosity'))
         dry_run = options.get('dry_run')
+        as_json = options.get('as_json')
         site_id = int(options.get('site_id') or settings.SITE_ID)
 
         if not Site.objects.filter(pk=site_id).exists():
@@ -43,6 +72,10 @@ class Command(BaseCommand):
                                   "doesn't exist in the database."))
             return
 
+        if as_json:
+            # nothing but the report may go to stdout.
+            verbosity = 0
+
         if dry_run and verbosity > 0:
             self.stdout.write(self.style.HTTP_BAD_REQUEST("This is a "
                               "dry-run, nothing new will be installed "
@@ -50,8 +83,9 @@ class Command(BaseCommand):
 
         if not dry_run:
             ensure_default_for_site(model=MenuItem, site_id=site_id)
-        url_iterables = [x.instance.get_urls() for x in _collect_menus()]
-        all_urls = frozenset(chain(*url_iterables))
+        collected = collect_urls(_collect_menus(), site_id=site_id,
+                                 full=options.get('full'))
+        all_urls = frozenset(collected.urls)
 
         if verbosity > 1:
             self.stdout.write(self.style.HTTP_REDIRECT("The following URLs "
@@ -61,44 +95,59 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.HTTP_NOT_FOUND(
                                   possible_insert.path))
 
-        the_missing = find_missing(model=MenuItem, urls=all_urls,
-                                   site_id=site_id)
+        diff = diff_urls(model=MenuItem, urls=all_urls, site_id=site_id,
+                         partial=collected.partial)
+        if dry_run:
+            result = SyncResult(diff=diff, inserted=(), retitled=0,
+                                unpublished=0)
+        else:
+            result = apply_diff(model=MenuItem, diff=diff,
+                                unpublish=options.get('unpublish'),
+                                update_titles=options.get('update_titles'))
+            record_watermarks(collected, site_id=site_id)
 
-        # no missing things, so fail early.
-        if the_missing is None:
-            if verbosity > 0:
-                self.stdout.write(self.style.HTTP_REDIRECT("No URLs need "
-                                  "to be added, yay!"))
-                return
+        if as_json:
+            report = result.as_dict()
+            report.update(dry_run=dry_run, partial=collected.partial)
+            self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
+            return
 
-        actually_missing = frozenset(the_missing)
+        if verbosity < 1:
+            return
 
-        # fail early as there is nothing to consider
-        if len(actually_missing) == 0:
-            if verbosity > 0:
-                self.stdout.write(self.style.HTTP_REDIRECT("No URLs need "
-                                  "to be added, yay!"))
+        if not diff.has_changes():
+            self.stdout.write(self.style.HTTP_REDIRECT("No URLs need "
+                              "to be added, yay!"))
             return
-        else:
-            # print wtf is going to happen
-            if verbosity > 0:
-                self.stdout.write(self.style.HTTP_REDIRECT("The following "
-                                  "URLs are missing and will be "
-                                  "installed."))
-                for missing in actually_missing:
-                    self.stdout.write(self.style.HTTP_NOT_FOUND(
-                                      missing.path))
-            # possibly do inserts
-            if not dry_run:
-                responses = add_urls(model=MenuItem, urls=actually_missing,
-                                     site_id=site_id)
-            else:
-                responses = actually_missing
-
-            if responses is not None:
-                responses = tuple(responses)
-            if verbosity > 0 and responses is not None:
-                count = len(responses)
-                self.stdout.write(self.style.HTTP_REDIRECT("{0} URLs have "
-                                  "been added".format(count)))
+
+        if len(diff.added) > 0:
+            self.stdout.write(self.style.HTTP_REDIRECT("The following "
+                              "URLs are missing and will be installed."))
+            for missing in diff.added:
+                self.stdout.write(self.style.HTTP_NOT_FOUND(missing.path))
+
+        if len(diff.retitled) > 0:
+            self.stdout.write(self.style.HTTP_REDIRECT("The following "
+                              "URLs have new titles."))
+            for changed in diff.retitled:
+                self.stdout.write(self.style.HTTP_NOT_FOUND(
+                    "{0}: {1} -> {2}".format(changed.uri, changed.old_title,
+                                             changed.title)))
+
+        if len(diff.orphaned) > 0:
+            self.stdout.write(self.style.HTTP_REDIRECT("The following "
+                              "URLs are no longer provided by any menu."))
+            for orphan in diff.orphaned:
+                self.stdout.write(self.style.HTTP_NOT_FOUND(orphan.uri))
+
+        if dry_run:
+            counts = diff.counts()
+            self.stdout.write(self.style.HTTP_REDIRECT("{added} URLs would "
+                              "be added, {retitled} retitled".format(
+                                  **counts)))
             return
+
+        self.stdout.write(self.style.HTTP_REDIRECT("{inserted} URLs have been "
+                          "added, {retitled} retitled and {unpublished} "
+                          "unpublished".format(**result.counts())))
+        return
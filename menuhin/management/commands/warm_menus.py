@@ -0,0 +1,92 @@
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.contrib.sites.models import Site
+from menuhin.warming import warm_menus, get_warm_threads
+
+
+class Command(BaseCommand):
+    help = ("Preloads menus and renders MENUHIN_WARM_TEMPLATES for each "
+            "URL, filling the caches before traffic does.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--site',
+                    action='append',
+                    dest='site_ids',
+                    help='A site to warm; may be given more than once. '
+                    'Defaults to MENUHIN_WARM_SITES, or SITE_ID.'),
+
+        make_option('--url',
+                    action='append',
+                    dest='urls',
+                    help='A URL to render; may be given more than once. '
+                    'Defaults to MENUHIN_WARM_URLS, or the published '
+                    'menu items.'),
+
+        make_option('--threads',
+                    action='store',
+                    dest='threads',
+                    type='int',
+                    default=None,
+                    help='How many threads to warm with. Defaults to '
+                    'MENUHIN_WARM_THREADS.'),
+
+        make_option('--json',
+                    action='store_true',
+                    dest='as_json',
+                    default=False,
+                    help='Output a JSON report of the timings instead.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity'))
+        site_ids = options.get('site_ids') or getattr(
+            settings, 'MENUHIN_WARM_SITES', (settings.SITE_ID,))
+        site_ids = [int(x) for x in site_ids]
+        sites = tuple(Site.objects.filter(pk__in=site_ids))
+
+        if len(sites) != len(frozenset(site_ids)):
+            if verbosity > 0:
+                self.stdout.write(self.style.HTTP_BAD_REQUEST("Some of those "
+                                  "site IDs don't exist in the database."))
+            return
+
+        threads = options.get('threads') or get_warm_threads()
+        report = warm_menus(sites=sites, urls=options.get('urls'),
+                            threads=threads)
+
+        if options.get('as_json'):
+            self.stdout.write(json.dumps({
+                'counts': report.counts(),
+                'results': [{
+                    'kind': x.job.kind,
+                    'site': x.job.site.pk,
+                    'target': x.job.target,
+                    'seconds': x.seconds,
+                    'error': x.error,
+                } for x in report.results],
+            }, indent=2, sort_keys=True))
+            return
+
+        if verbosity < 1:
+            return
+
+        if verbosity > 1:
+            self.stdout.write(self.style.HTTP_REDIRECT("The slowest to "
+                              "warm were:"))
+            for result in report.slowest():
+                self.stdout.write(self.style.HTTP_NOT_FOUND(
+                    "{0:.3f}s: {1} {2!r} for site {3}".format(
+                        result.seconds, result.job.kind, result.job.target,
+                        result.job.site.pk)))
+
+        for result in report.errors():
+            self.stdout.write(self.style.HTTP_BAD_REQUEST(
+                "{0} {1!r} for site {2} failed: {3}".format(
+                    result.job.kind, result.job.target, result.job.site.pk,
+                    result.error)))
+
+        self.stdout.write(self.style.HTTP_REDIRECT(
+            "Warmed {snapshots} menus and {pages} pages in {seconds:.2f}s, "
+            "with {errors} errors".format(**report.counts())))
@@ -4,7 +4,8 @@ from django.conf import settings
 from django.core.urlresolvers import reverse, NoReverseMatch
 from .models import MenuItem
 from .utils import (LengthLazyObject, get_menuitem_or_none,
-                    get_relations_for_request)
+                    get_relations_for_request, get_current_site)
+from .versions import get_tree_version
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,9 @@ class RequestTreeMiddleware(object):
             logger.debug("Admin is not mounted")
 
     def process_request(self, request):
+        # resolved once, up front, so that everything later in the request
+        # which needs the current site gets this one.
+        get_current_site(request)
         ignored_prefixes = tuple(self.get_ignorables())
         if request.path.startswith(ignored_prefixes):
             logger.debug("Skipping this request")
@@ -55,3 +59,18 @@ class RequestTreeMiddleware(object):
         request.descendants = LengthLazyObject(lazy_descendants_func)
         request.siblings = LengthLazyObject(lazy_siblings_func)
         request.children = LengthLazyObject(lazy_children_func)
+
+
+class TreeVersionHeaderMiddleware(object):
+    """
+    Adds the current site's tree version to responses, as the
+    MENUHIN_TREE_VERSION_HEADER (by default, X-Menu-Version) header, for
+    reverse proxies to key or purge cached pages on.
+    """
+    def process_response(self, request, response):
+        header = getattr(settings, 'MENUHIN_TREE_VERSION_HEADER',
+                         'X-Menu-Version')
+        if header not in response:
+            site_id = get_current_site(request).pk
+            response[header] = str(get_tree_version(site_id))
+        return response
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0001_initial'),
+        ('menuhin', '0004_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreeVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('site', models.OneToOneField(to='sites.Site')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
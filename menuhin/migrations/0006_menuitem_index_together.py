@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('sites', '0001_initial'),
+        ('menuhin', '0005_treeversion'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='menuitem',
+            index_together=set([('site', 'menu_slug'), ('site', 'is_published', 'path'), ('_original_content_type', '_original_content_id')]),
+        ),
+    ]
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
+import functools
 import json
 import logging
-from collections import namedtuple
+import operator
+from collections import namedtuple, defaultdict
+import django
 
 try:
     from django.contrib.contenttypes.fields import GenericForeignKey
@@ -16,6 +19,7 @@ from django.template.loader import render_to_string
 from django.template.context import Context
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.functional import cached_property
+from django.utils import timezone
 
 try:
     from django.utils.six.moves import urllib_parse
@@ -29,12 +33,26 @@ try:
 except ImportError:  # pragma: no cover (Django < 1.7)
     from django.db.models.options import get_verbose_name
 
-from treebeard.mp_tree import MP_Node
-from django.db.models import (SlugField, ForeignKey, CharField, TextField,
-                              BooleanField)
+from treebeard.mp_tree import MP_Node, MP_NodeManager, MP_NodeQuerySet
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.core.signals import request_finished
+from django.db import connection
+from django.db.models import (Model, SlugField, ForeignKey, CharField,
+                              TextField, BooleanField, DateTimeField, Q, Count,
+                              PositiveIntegerField, OneToOneField)
 from django.contrib.sites.models import Site
 from model_utils.models import TimeStampedModel
-from .utils import set_menu_slug, get_title, get_list_title
+from .utils import (set_menu_slug, get_title, get_list_title, chunked,
+                    get_sync_chunk_size, get_current_site,
+                    forget_default_roots, forget_sites)
+from .shorturls import forget_shorturl, forget_shorturls
+from .versions import (bump_tree_versions, defer_version_bumps,
+                       bump_for_instance, publish_at_request_end)
+from .bus import publish_tree_changed
+from .treefiles import rewrite_tree_files
+from .signals import tree_changed
 from menuhin.text import (menu_v, menu_vp, title_label, title_help,
                           display_title_label, display_title_help,
                           menuitem_v, menuitem_vp, uri_v)
@@ -49,6 +67,49 @@ def is_valid_uri(value):
     return True
 
 
+class MenuItemQuerySet(MP_NodeQuerySet):
+    """
+    Bumps the tree version (see `menuhin.versions`) of every site a bulk
+    update or delete touches, and forgets the cached short URLs of rows
+    whose URLs it changes.
+    """
+    #: fields treebeard updates alongside saving a node, which needn't bump
+    #: the version again.
+    bookkeeping_fields = frozenset(['numchild'])
+
+    def update(self, **kwargs):
+        if self.bookkeeping_fields.issuperset(kwargs):
+            return super(MenuItemQuerySet, self).update(**kwargs)
+        pks = ()
+        if 'uri' in kwargs:
+            # the rows' cached short URLs have to be forgotten as well.
+            rows = tuple(self.order_by().values_list('pk', 'site'))
+            pks = [pk for pk, site_id in rows]
+            site_ids = set(site_id for pk, site_id in rows)
+        else:
+            site_ids = set(self.order_by().values_list('site', flat=True)
+                           .distinct())
+        updated = super(MenuItemQuerySet, self).update(**kwargs)
+        if 'site' in kwargs:
+            site_ids.add(getattr(kwargs['site'], 'pk', kwargs['site']))
+        if updated:
+            forget_shorturls(self.model, pks)
+            bump_tree_versions(site_ids)
+        return updated
+    update.alters_data = True
+
+    def delete(self):
+        with defer_version_bumps():
+            return super(MenuItemQuerySet, self).delete()
+    delete.alters_data = True
+
+
+class MenuItemManager(MP_NodeManager):
+    def get_query_set(self):
+        return MenuItemQuerySet(self.model).order_by('path')
+    get_queryset = get_query_set
+
+
 @python_2_unicode_compatible
 class MenuItem(TimeStampedModel, MP_Node):
 
@@ -74,6 +135,8 @@ class MenuItem(TimeStampedModel, MP_Node):
     user_passes_test = True
     vary_on_user = False
 
+    objects = MenuItemManager()
+
     def __str__(self):
         return self.title  # pragma: no cover
 
@@ -119,6 +182,38 @@ class MenuItem(TimeStampedModel, MP_Node):
     def get_absolute_url(self):
         return self.uri
 
+    def move(self, target, pos=None):
+        # treebeard rewrites the paths with raw SQL, which bypasses the
+        # queryset.
+        old_path = self.path
+        with defer_version_bumps():
+            moved = super(MenuItem, self).move(target, pos=pos)
+            bump_tree_versions((self.site_id, target.site_id))
+            self.touch_moved(old_path)
+        return moved
+
+    def touch_moved(self, old_path):
+        """
+        Updates the `modified` time of a moved node, everything below it,
+        and its old and new ancestors (whose descendants have changed), so
+        that Last-Modified times (see `menuhin.utils.get_validators`) notice.
+        """
+        cls = self.__class__
+        new_path = cls.objects.filter(pk=self.pk).values_list(
+            'path', flat=True)[0]
+        ancestors = set(path[:end] for path in (old_path, new_path)
+                        for end in range(cls.steplen, len(path),
+                                         cls.steplen))
+        touched = Q(path__startswith=new_path)
+        if ancestors:
+            touched |= Q(path__in=ancestors)
+        return cls.objects.filter(touched).update(modified=timezone.now())
+
+    @classmethod
+    def load_bulk(cls, *args, **kwargs):
+        with defer_version_bumps():
+            return super(MenuItem, cls).load_bulk(*args, **kwargs)
+
     def href(self):
         return self.uri
 
@@ -193,11 +288,17 @@ class MenuItem(TimeStampedModel, MP_Node):
         copy paste job of the original `get_annotated_list` so that we can
         filter only published items, specifically for this.
         """
-        result, info = [], {}
-        start_depth, prev_depth = (None, None)
+        return list(cls.iter_published_annotated(parent=parent,
+                                                 **tree_kwargs))
 
+    @classmethod
+    def iter_published_annotated(cls, parent=None, **tree_kwargs):
+        """
+        Yields the same (node, info) pairs as `get_published_annotated_list`,
+        without fetching every node up front.
+        """
         if 'site' not in tree_kwargs:
-            tree_kwargs.update(site=Site.objects.get_current())
+            tree_kwargs.update(site=get_current_site())
 
         if 'is_published' not in tree_kwargs:
             tree_kwargs.update(is_published=True)
@@ -221,24 +322,161 @@ class MenuItem(TimeStampedModel, MP_Node):
             tree_kwargs.update(depth__lte=maximum_depth)
 
         qs = cls.get_tree(parent).select_related('site').filter(**tree_kwargs)
-        for node in qs.defer('_original_content_type', '_original_content_id'):
+        qs = qs.defer('_original_content_type', '_original_content_id')
+        # a generator of its own, so that bad arguments raise immediately.
+        return cls._annotate_published(qs.iterator())
+
+    @staticmethod
+    def _annotate_published(nodes):
+        """
+        Each node is held back until the next one is known, as that decides
+        which levels the held node closes.
+        """
+        start_depth, prev_depth = (None, None)
+        previous = None
+        for node in nodes:
             depth = node.get_depth()
             if start_depth is None:
                 start_depth = depth
             open = (depth and (prev_depth is None or depth > prev_depth))
-            if prev_depth is not None and depth < prev_depth:
-                info['close'] = list(range(0, prev_depth - depth))
+            if previous is not None:
+                if depth < prev_depth:
+                    previous[1]['close'] = list(range(0, prev_depth - depth))
+                yield previous
             info = {'open': open, 'close': [], 'level': depth - start_depth}
-            result.append((node, info,))
+            previous = (node, info,)
             prev_depth = depth
-        if start_depth and start_depth > 0:
-            info['close'] = list(range(0, prev_depth - start_depth + 1))
-        return result
+        if previous is not None and start_depth and start_depth > 0:
+            previous[1]['close'] = list(range(0, prev_depth - start_depth + 1))
+        if previous is not None:
+            yield previous
+
+    @classmethod
+    def get_subtree_range(cls, path):
+        """
+        The (lowest, highest) paths of the subtree rooted at `path`, itself
+        included, for `path__range` lookups which can use the index on
+        `path`, unlike LIKE/startswith on every database.
+        """
+        max_length = cls._meta.get_field_by_name('path')[0].max_length
+        return (path, path + cls.alphabet[-1] * (max_length - len(path)))
+
+    @classmethod
+    def get_descendant_counts(cls, nodes):
+        """
+        The number of descendants of each of the given nodes, keyed by
+        primary key, from one grouped query per distinct depth among them
+        rather than a COUNT per node.
+        """
+        counts = {}
+        by_depth = defaultdict(dict)
+        for node in nodes:
+            counts[node.pk] = 0
+            by_depth[node.depth][node.path] = node.pk
+        prefix_sql = 'SUBSTR({table}.{column}, 1, {length:d})'
+        for depth, paths in by_depth.items():
+            prefix = prefix_sql.format(
+                table=connection.ops.quote_name(cls._meta.db_table),
+                column=connection.ops.quote_name('path'),
+                length=depth * cls.steplen)
+            within = functools.reduce(
+                operator.or_, (Q(path__startswith=x) for x in paths))
+            rows = (cls.objects.filter(within, depth__gt=depth)
+                    .extra(select={'prefix': prefix}).values('prefix')
+                    .annotate(descendants=Count('pk')).order_by())
+            for row in rows:
+                if row['prefix'] in paths:
+                    counts[paths[row['prefix']]] = row['descendants']
+        return counts
+
+    @classmethod
+    def prefetch_ancestors(cls, nodes, parents_only=False):
+        """
+        Fetches the ancestors of all the given nodes together, setting
+        `prefetched_ancestors` (root first) on each, and treebeard's cached
+        parent, so that `get_parent` needn't query.
+        If `parents_only` is True, only the parents are fetched.
+        """
+        nodes = list(nodes)
+        wanted = set()
+        for node in nodes:
+            first = node.depth - 1 if parents_only else 1
+            for depth in range(max(first, 1), node.depth):
+                wanted.add(node.path[:depth * cls.steplen])
+        found = {}
+        for chunk in chunked(wanted, get_sync_chunk_size()):
+            found.update((x.path, x) for x in
+                         cls.objects.filter(path__in=chunk))
+        for node in nodes:
+            first = node.depth - 1 if parents_only else 1
+            ancestors = [found[node.path[:depth * cls.steplen]]
+                         for depth in range(max(first, 1), node.depth)
+                         if node.path[:depth * cls.steplen] in found]
+            node.prefetched_ancestors = ancestors
+            if ancestors and ancestors[-1].depth == node.depth - 1:
+                node._cached_parent_obj = ancestors[-1]
+        return nodes
+
+    @classmethod
+    def annotate_descendant_counts(cls, nodes, complete=False):
+        """
+        Sets `descendant_count` on each of the given nodes, for the API.
+        If `complete` is True, the nodes are taken to include all of each
+        other's descendants (eg: a whole subtree), and are counted without
+        any queries.
+        """
+        nodes = list(nodes)
+        if complete:
+            by_path = dict((node.path, 0) for node in nodes)
+            for node in nodes:
+                for depth in range(1, node.depth):
+                    ancestor = node.path[:depth * cls.steplen]
+                    if ancestor in by_path:
+                        by_path[ancestor] += 1
+            for node in nodes:
+                node.descendant_count = by_path[node.path]
+            return nodes
+        counts = cls.get_descendant_counts(nodes)
+        for node in nodes:
+            node.descendant_count = counts[node.pk]
+        return nodes
 
     class Meta:
         verbose_name = menuitem_v
         verbose_name_plural = menu_vp
         # ordering = ('-created', 'title')
+        if django.VERSION >= (1, 5):
+            # the published tree of a site (by path prefix or range, in
+            # path order), menu roots by slug, and items by original object.
+            index_together = (
+                ('site', 'is_published', 'path'),
+                ('site', 'menu_slug'),
+                ('_original_content_type', '_original_content_id'),
+            )
+
+
+post_save.connect(forget_shorturl, sender=MenuItem,
+                  dispatch_uid='menuhin_forget_shorturl_on_save')
+post_delete.connect(forget_shorturl, sender=MenuItem,
+                    dispatch_uid='menuhin_forget_shorturl_on_delete')
+post_save.connect(bump_for_instance, sender=MenuItem,
+                  dispatch_uid='menuhin_bump_tree_version_on_save')
+post_delete.connect(bump_for_instance, sender=MenuItem,
+                    dispatch_uid='menuhin_bump_tree_version_on_delete')
+request_finished.connect(publish_at_request_end,
+                         dispatch_uid='menuhin_publish_pending_versions')
+tree_changed.connect(publish_tree_changed,
+                     dispatch_uid='menuhin_publish_tree_changed')
+tree_changed.connect(rewrite_tree_files,
+                     dispatch_uid='menuhin_rewrite_tree_files')
+post_save.connect(forget_default_roots, sender=MenuItem,
+                  dispatch_uid='menuhin_forget_default_roots_on_save')
+post_delete.connect(forget_default_roots, sender=MenuItem,
+                    dispatch_uid='menuhin_forget_default_roots_on_delete')
+post_save.connect(forget_sites, sender=Site,
+                  dispatch_uid='menuhin_forget_sites_on_save')
+post_delete.connect(forget_sites, sender=Site,
+                    dispatch_uid='menuhin_forget_sites_on_delete')
 
 
 class MenuItemGroup(object):
@@ -256,11 +494,147 @@ class MenuItemGroup(object):
                                   "`URI` instances.")
 
 
+@python_2_unicode_compatible
+class SyncWatermark(Model):
+    """
+    Records when a handler which supports incremental syncing last
+    successfully ran for a site.
+    """
+    handler = CharField(max_length=255)
+    site = ForeignKey('sites.Site')
+    watermark = DateTimeField()
+
+    def __str__(self):
+        return '{0} @ {1}'.format(self.handler, self.watermark)  # pragma: no cover
+
+    @classmethod
+    def get_for(cls, handler, site_id):
+        try:
+            return (cls.objects.filter(handler=handler, site=site_id)
+                    .values_list('watermark', flat=True)[:1][0])
+        except IndexError:
+            return None
+
+    @classmethod
+    def get_oldest(cls, handler, site_ids):
+        """
+        The earliest watermark across all the given sites, or None if any
+        of them has never been synced.
+        """
+        watermarks = tuple(cls.objects.filter(handler=handler,
+                                              site__in=site_ids)
+                           .values_list('watermark', flat=True))
+        if len(watermarks) < len(frozenset(site_ids)):
+            return None
+        return min(watermarks)
+
+    @classmethod
+    def record(cls, handler, site_id, watermark):
+        updated = cls.objects.filter(handler=handler, site=site_id).update(
+            watermark=watermark)
+        if not updated:
+            cls.objects.create(handler=handler, site_id=site_id,
+                               watermark=watermark)
+        return watermark
+
+    class Meta:
+        unique_together = ('handler', 'site')
+
+
+@python_2_unicode_compatible
+class TreeVersion(Model):
+    """
+    How many times a site's menu items have changed, which
+    `menuhin.versions` keeps in the cache, falling back to this.
+    """
+    site = OneToOneField('sites.Site')
+    version = PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return '{0}: {1}'.format(self.site_id, self.version)  # pragma: no cover
+
+
+@python_2_unicode_compatible
+class ImportJob(TimeStampedModel):
+    """
+    Previewing or importing the URLs of one of the MENUHIN_MENU_HANDLERS
+    into a site, in the background (see `menuhin.jobs`), recording its
+    progress as it goes.
+    """
+    PREVIEW = 'preview'
+    IMPORT = 'import'
+    KIND_CHOICES = ((PREVIEW, 'preview'), (IMPORT, 'import'))
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'pending'), (RUNNING, 'running'),
+                      (FINISHED, 'finished'), (FAILED, 'failed'))
+
+    handler = CharField(max_length=255)
+    site = ForeignKey('sites.Site')
+    kind = CharField(max_length=10, choices=KIND_CHOICES, default=PREVIEW)
+    status = CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING,
+                       db_index=True)
+    total = PositiveIntegerField(default=0)
+    processed = PositiveIntegerField(default=0)
+    inserted = PositiveIntegerField(default=0)
+    #: JSON list of the [path, title] pairs not yet in the site.
+    missing = TextField(blank=True, default='')
+    error = TextField(blank=True, default='')
+
+    def __str__(self):
+        return '{0} {1} ({2})'.format(self.kind, self.handler, self.status)  # pragma: no cover
+
+    def is_done(self):
+        return self.status in (self.FINISHED, self.FAILED)
+
+    def progress(self):
+        """
+        How far through the handler's URLs the job is, as a percentage.
+        """
+        if self.status == self.FINISHED:
+            return 100
+        if not self.total:
+            return 0
+        return min(100, int(self.processed * 100 / self.total))
+
+    def get_missing(self):
+        if not self.missing:
+            return []
+        return [URI(path=path, title=title)
+                for path, title in json.loads(self.missing)]
+
+    def set_missing(self, urls):
+        self.missing = json.dumps([[x.path, x.title] for x in urls])
+
+    def as_dict(self):
+        return {'id': self.pk, 'handler': self.handler,
+                'site': self.site_id, 'kind': self.kind,
+                'status': self.status, 'total': self.total,
+                'processed': self.processed, 'inserted': self.inserted,
+                'progress': self.progress(), 'error': self.error,
+                'done': self.is_done()}
+
+    class Meta:
+        ordering = ('-created',)
+
+
 class InvalidModelError(ValueError): pass  # noqa
 
 
 class ModelMenuItemGroup(MenuItemGroup):
     model = None
+    #: the name of a DateTimeField (eg: `modified`) which changes whenever an
+    #: instance is saved. If set, syncing only considers instances changed
+    #: since the last successful run.
+    updated_field = None
+    #: the fields `get_absolute_url` and the title methods need; if set, only
+    #: those (and the primary key) are loaded.
+    fields = None
+    #: how many instances to load per query.
+    chunk_size = 1000
 
     def __init__(self):
         super(ModelMenuItemGroup, self).__init__()
@@ -270,29 +644,80 @@ class ModelMenuItemGroup(MenuItemGroup):
         if not hasattr(model, 'get_absolute_url'):
             raise InvalidModelError("{cls!r} lacks a `get_absolute_url` "
                                     "method")
+        if self.updated_field is not None:
+            try:
+                model._meta.get_field_by_name(self.updated_field)
+            except FieldDoesNotExist:
+                raise InvalidModelError("{cls!r} has no field {field!r} to "
+                                        "use as `updated_field`".format(
+                                            cls=model,
+                                            field=self.updated_field))
 
     def get_model(self):
         return self.model
 
-    def get_queryset(self):
-        return self.get_model().objects.all().iterator()
+    def get_fields(self):
+        return self.fields
 
-    def get_urls(self):
+    def get_queryset(self, since=None):
+        queryset = self.get_model().objects.all()
+        if since is not None and self.updated_field is not None:
+            lookup = '{0}__gte'.format(self.updated_field)
+            queryset = queryset.filter(**{lookup: since})
+        fields = self.get_fields()
+        if fields:
+            queryset = queryset.only(*fields)
+        return queryset
+
+    def iterate(self, queryset):
+        """
+        Walk the queryset in primary key order, `chunk_size` instances at a
+        time, so that only one chunk is ever held in memory.
+        Anything other than a QuerySet is iterated over as-is.
+        """
+        if not isinstance(queryset, QuerySet):
+            for obj in queryset:
+                yield obj
+            return
+        queryset = queryset.order_by('pk')
+        last_pk = None
+        while True:
+            page = queryset
+            if last_pk is not None:
+                page = page.filter(pk__gt=last_pk)
+            page = list(page[:self.chunk_size])
+            for obj in page:
+                yield obj
+            if len(page) < self.chunk_size:
+                return
+            last_pk = page[-1].pk
+
+    def get_urls(self, since=None):
         """
         Unlike the standard MenuItemGroup usage, which would yield
         individual items, this one collects into a complete iterable so
         that it may be de-duplicated for any list urls.
+
+        If `since` is given, only instances changed since then are
+        considered (requires `updated_field`).
         """
-        queryset = self.get_queryset()
+        if since is not None and self.updated_field is not None:
+            queryset = self.get_queryset(since=since)
+        else:
+            # handlers written before `since` existed override
+            # get_queryset() without it.
+            queryset = self.get_queryset()
+        content_type = ContentType.objects.get_for_model(self.get_model())
         final_urls = set()
-        for obj in queryset:
+        for obj in self.iterate(queryset):
 
             abs_url = getattr(obj, 'get_absolute_url')
             if callable(abs_url):
                 abs_url = abs_url()
 
             abs_obj = ModelURI(path=abs_url, title=get_title(obj),
-                               model_instance=obj)
+                               content_type_id=content_type.pk,
+                               object_pk=obj.pk)
             if abs_obj not in final_urls:
                 final_urls.add(abs_obj)
 
@@ -314,5 +739,22 @@ class ModelMenuItemGroup(MenuItemGroup):
 
 # collects just a path and a page title, used for inserting.
 URI = namedtuple('URI', ('path', 'title'))
-# collects the above + the original object ...
-ModelURI = namedtuple('URI', ('path', 'title', 'model_instance'))
+
+
+class ModelURI(namedtuple('URI', ('path', 'title', 'content_type_id',
+                                  'object_pk'))):
+    """
+    collects the above + a reference to the original object, without
+    keeping the instance itself alive. For convenience, `model_instance`
+    may be given instead of the content type and primary key.
+    """
+    __slots__ = ()
+
+    def __new__(cls, path, title, content_type_id=None, object_pk=None,
+                model_instance=None):
+        if model_instance is not None:
+            content_type = ContentType.objects.get_for_model(model_instance)
+            content_type_id = content_type.pk
+            object_pk = model_instance.pk
+        return super(ModelURI, cls).__new__(cls, path, title,
+                                            content_type_id, object_pk)
@@ -12,14 +12,29 @@ class MenuItemSerializer(serializers.HyperlinkedModelSerializer):
     descendants = serializers.SerializerMethodField('get_descendant_count')
     ancestors = serializers.SerializerMethodField('get_ancestor_count')
 
+    def __init__(self, *args, **kwargs):
+        """
+        Allows for `fields` to limit the output to a subset of those in
+        the Meta.
+        """
+        fields = kwargs.pop('fields', None)
+        super(MenuItemSerializer, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     def is_child_node(self, obj):
         return obj.depth > 1
 
     def get_descendant_count(self, obj):
-        return obj.get_descendants().count()
+        # set in bulk by MenuItem.annotate_descendant_counts
+        count = getattr(obj, 'descendant_count', None)
+        if count is None:
+            count = obj.get_descendant_count()
+        return count
 
     def get_ancestor_count(self, obj):
-        return obj.get_ancestors().count()
+        return obj.depth - 1
 
     def get_object_url(self, obj):
         request = self.context.get('request', None)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from .signals import shorturl_hits
+
+
+logger = logging.getLogger(__name__)
+
+#: cached for primary keys which don't exist, so that repeated requests for
+#: them don't reach the database either.
+MISSING = ''
+
+
+def shorturl_cache_key(model, pk):
+    return 'menuhin:shorturl:{table}:{pk}'.format(table=model._meta.db_table,
+                                                  pk=pk)
+
+
+def get_shorturl(model, pk):
+    """
+    The URL the given primary key redirects to, or None if there isn't
+    one, going to the database only when the cache doesn't know.
+    """
+    key = shorturl_cache_key(model, pk)
+    url = cache.get(key)
+    if url is None:
+        try:
+            url = model.objects.filter(pk=pk).values_list('uri',
+                                                          flat=True)[0]
+            timeout = getattr(settings, 'MENUHIN_SHORTURL_CACHE_TIMEOUT',
+                              3600)
+        except IndexError:
+            url = MISSING
+            timeout = getattr(settings, 'MENUHIN_SHORTURL_MISSING_TIMEOUT',
+                              60)
+        cache.set(key, url, timeout)
+    if url == MISSING:
+        return None
+    return url
+
+
+def forget_shorturl(sender, instance, **kwargs):
+    """
+    post_save and post_delete listener to drop the cached URL for a
+    MenuItem.
+    """
+    cache.delete(shorturl_cache_key(sender, instance.pk))
+
+
+def forget_shorturls(model, pks):
+    """
+    Drop the cached URLs for the given primary keys, for bulk updates which
+    don't send post_save.
+    """
+    cache.delete_many([shorturl_cache_key(model, x) for x in pks])
+
+
+class HitBuffer(object):
+    """
+    Counts redirects in memory, sending them as one `shorturl_hits` signal
+    per model (with a dictionary of primary key to hit count) once
+    MENUHIN_SHORTURL_HITS_BATCH hits have been seen, or
+    MENUHIN_SHORTURL_HITS_INTERVAL seconds after the first unsent one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.count = 0
+        self.timer = None
+
+    def record(self, sender, pk):
+        batch = getattr(settings, 'MENUHIN_SHORTURL_HITS_BATCH', 100)
+        with self.lock:
+            self.hits[(sender, pk)] += 1
+            self.count += 1
+            full = self.count >= batch
+            if not full and self.timer is None:
+                interval = getattr(settings,
+                                   'MENUHIN_SHORTURL_HITS_INTERVAL', 10)
+                self.timer = threading.Timer(interval,
+                                             self.flush_in_thread)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            hits, self.hits = self.hits, defaultdict(int)
+            self.count = 0
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        by_sender = defaultdict(dict)
+        for (sender, pk), count in hits.items():
+            by_sender[sender][pk] = count
+        for sender, counts in by_sender.items():
+            try:
+                shorturl_hits.send(sender=sender, hits=counts)
+            except Exception:
+                logger.exception("Unable to send short URL hits")
+        return sum(hits.values())
+
+    def flush_in_thread(self):
+        try:
+            return self.flush()
+        finally:
+            # listeners may have used the timer thread's own connection.
+            connection.close()
+
+
+hit_buffer = HitBuffer()
+atexit.register(hit_buffer.flush)
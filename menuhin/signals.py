@@ -3,6 +3,11 @@ from django.dispatch import Signal
 
 default_for_site_needed = Signal(providing_args=('site'))
 default_for_site_created = Signal(providing_args=('site', 'instance'))
+#: sent for every redirect; the instance is only fetched when it's used.
 shorturl_redirect = Signal(providing_args=("instance", "user"))
+shorturl_hits = Signal(providing_args=("hits",))
 rebuild_requested = Signal(providing_args=())
 missing_inserted = Signal(providing_args=('found', 'missing'))
+#: sent, once the transaction making the changes is over, with the primary
+#: keys of the sites whose menu items have changed.
+tree_changed = Signal(providing_args=('site_ids',))
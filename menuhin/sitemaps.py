@@ -2,12 +2,44 @@
 from datetime import datetime
 import logging
 from django.contrib.sitemaps import Sitemap
+from django.contrib.sitemaps.views import sitemap as sitemap_view
+from django.core.paginator import InvalidPage, Paginator
+from django.utils import timezone
+from django.views.decorators.http import condition
 from .models import MenuItem
+from .utils import get_current_site
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_changefreq(modified):
+    if timezone.is_aware(modified):
+        now = timezone.now()
+    else:
+        now = datetime.today()
+    datediff = now - modified
+    if datediff.days < 3:
+        return 'daily'
+    if datediff.days <= 7:
+        return 'weekly'
+    return 'monthly'
+
+
+def get_priority(depth):
+    """
+    The farther down the rabbit hole we go, the lest important the pages,
+    right?
+    """
+    start_priority = 1.0
+    remove_amount = 0
+    # only start trimming the start priority if we're more than 1 deep.
+    if depth > 0:
+        remove_amount = float(depth) / 10
+    remove_amount = min(remove_amount, 0.99)
+    return start_priority - remove_amount
+
+
 class MenuItemSitemap(Sitemap):
     model = MenuItem
 
@@ -18,27 +50,96 @@ class MenuItemSitemap(Sitemap):
         return obj.modified
 
     def changefreq(self, obj):
-        datediff = datetime.today() - obj.modified
-        if datediff.days < 3:
-            return 'daily'
-        if datediff.days <= 7:
-            return 'weekly'
-        return 'monthly'
+        return get_changefreq(obj.modified)
 
     def priority(self, obj):
+        priority = get_priority(obj.depth)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("{obj!r} has a priority of {depth!s} (depth "
+                         "{level!s})".format(obj=obj, depth=priority,
+                                             level=obj.depth))
+        return priority
+
+
+class StreamingMenuItemSitemap(Sitemap):
+    """
+    Outputs the same as MenuItemSitemap, but each page of the sitemap is
+    a query for just the columns it needs, so that large menus may be
+    split up under a sitemap index without loading every item.
+    """
+    model = MenuItem
+    limit = 5000
+
+    def get_queryset(self):
+        return (self.model.objects
+                .filter(site=get_current_site(), is_published=True)
+                .order_by('path'))
+
+    def items(self):
+        return self.get_queryset().values('uri', 'modified', 'depth')
+
+    @property
+    def paginator(self):
+        # not cached, as sitemaps live as long as the urlconf, so the count
+        # would never change.
+        return Paginator(self.items(), self.limit)
+
+    def get_page_last_modified(self, page):
         """
-        The farther down the rabbit hole we go, the lest important the pages,
-        right?
+        The most recent `modified` time for the items on the given page
+        of the sitemap.
         """
-        start_priority = 1.0
-        remove_amount = 0
-        # only start trimming the start priority if we're more than 1 deep.
-        if obj.depth > 0:
-            remove_amount = float(obj.depth) / 10
-        remove_amount = min(remove_amount, 0.99)
-        remove_depth = start_priority - remove_amount
-        logger.debug("{obj!r} has a priority of {depth!s} ({removed!s} "
-                     "removed from maximum of {start!s})".format(
-                         obj=obj, depth=remove_depth, removed=remove_amount,
-                         start=start_priority))
-        return remove_depth
+        page = self.paginator.page(page)
+        modified = list(self.get_queryset()
+                        .values_list('modified', flat=True)
+                        [page.start_index() - 1:page.end_index()])
+        return max(modified) if modified else None
+
+    def location(self, row):
+        return row['uri']
+
+    def lastmod(self, row):
+        return row['modified']
+
+    def changefreq(self, row):
+        return get_changefreq(row['modified'])
+
+    def priority(self, row):
+        return get_priority(row['depth'])
+
+
+def get_last_modified(sitemaps, section=None, page=1):
+    """
+    The most recent change to the given page of the sitemaps, if all of
+    them know (see StreamingMenuItemSitemap.get_page_last_modified).
+    """
+    if section is not None:
+        sitemaps = {section: sitemaps[section]} if section in sitemaps else {}
+    last_modified = None
+    for site in sitemaps.values():
+        get_page_last_modified = getattr(site, 'get_page_last_modified', None)
+        if get_page_last_modified is None:
+            return None
+        try:
+            modified = get_page_last_modified(page)
+        except InvalidPage:
+            return None
+        if modified is not None:
+            last_modified = max(modified, last_modified or modified)
+    return last_modified
+
+
+def sitemap(request, sitemaps, section=None, **kwargs):
+    """
+    Django's sitemap view, with a Last-Modified header for the page and
+    a 304 Not Modified response if the client has it already.
+    """
+    sitemaps = dict((key, site() if callable(site) else site)
+                    for key, site in sitemaps.items())
+
+    def last_modified(request, *args, **kwargs):
+        return get_last_modified(sitemaps, section=section,
+                                 page=request.GET.get('p', 1))
+
+    view = condition(last_modified_func=last_modified)(sitemap_view)
+    return view(request, sitemaps=sitemaps, section=section, **kwargs)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import copy
+import logging
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from django.db import connection
+from .bus import get_bus
+from .treefiles import get_published_annotated_list
+
+
+logger = logging.getLogger(__name__)
+
+#: `stale_since` is None until the site's menus change.
+Snapshot = namedtuple('Snapshot', ('tree', 'built', 'stale_since'))
+
+
+class Flight(object):
+    """
+    A rebuild in progress, which other requests for the same menu may wait
+    on rather than starting their own.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.tree = None
+        self.error = None
+
+
+class MenuSnapshots(object):
+    """
+    Published, annotated menus kept in this process's memory, until the
+    invalidation bus (see `menuhin.bus`) says their site's menus changed.
+
+    Each menu is only rebuilt by one thread at a time. For `grace` seconds
+    after a change, the previous menu is still served while it's rebuilt,
+    either by the first request to notice (`refresh` of 'inline') or in the
+    background ('thread'). After that, requests wait up to `wait` seconds
+    for the rebuild. If it fails, or takes too long, the last good menu is
+    served, and rebuilding isn't tried again for `retry` seconds.
+
+    Every caller gets copies of the nodes, as rendering marks them up for
+    the request.
+    """
+    def __init__(self, grace=None, refresh=None, wait=None, retry=None):
+        self.grace = grace
+        self.refresh = refresh
+        self.wait = wait
+        self.retry = retry
+        self.snapshots = {}
+        self.flights = {}
+        self.failures = {}
+        #: goes up with every invalidation, so that a snapshot built from
+        #: before one is known to be stale already.
+        self.generation = 0
+        self.bus = None
+        self.lock = threading.Lock()
+
+    def get_setting(self, name, default):
+        value = getattr(self, name)
+        if value is None:
+            value = getattr(settings,
+                            'MENUHIN_SNAPSHOT_{0}'.format(name.upper()),
+                            default)
+        return value
+
+    def get_key(self, site_id, parent, from_depth, to_depth):
+        return (site_id, getattr(parent, 'pk', parent), from_depth, to_depth)
+
+    def subscribe(self):
+        bus = get_bus()
+        if bus is not self.bus:
+            # a new bus, so anything it would have said has been missed.
+            self.invalidate(site_ids=None)
+            with self.lock:
+                self.bus = bus
+            bus.subscribe(self.invalidate)
+        bus.poll()
+
+    def invalidate(self, site_ids):
+        now = time.time()
+        with self.lock:
+            self.generation += 1
+            if site_ids is not None:
+                site_ids = frozenset(site_ids)
+            for key, snapshot in tuple(self.snapshots.items()):
+                if site_ids is not None and key[0] not in site_ids:
+                    continue
+                if snapshot.stale_since is None:
+                    self.snapshots[key] = snapshot._replace(stale_since=now)
+
+    def build(self, model, site, parent, from_depth, to_depth):
+        # from the site's tree file, if MENUHIN_TREE_FILES_DIR is set.
+        return tuple(get_published_annotated_list(
+            model, site=site, parent=parent, from_depth=from_depth,
+            to_depth=to_depth))
+
+    def claim(self, key):
+        """
+        The rebuild of the given menu, and whether the caller should do it,
+        or (None, False) if the last attempt failed too recently to try
+        again.
+        """
+        with self.lock:
+            if key in self.flights:
+                return self.flights[key], False
+            failed = self.failures.get(key)
+            if (failed is not None and
+                    time.time() - failed < self.get_setting('retry', 5)):
+                return None, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def rebuild(self, key, flight, build_kwargs):
+        generation = self.generation
+        try:
+            tree = self.build(**build_kwargs)
+        except Exception as e:
+            logger.exception("Couldn't rebuild the menu for {0!r}".format(
+                key))
+            flight.error = e
+            with self.lock:
+                self.failures[key] = time.time()
+        else:
+            flight.tree = tree
+            now = time.time()
+            with self.lock:
+                self.failures.pop(key, None)
+                # changed while it was being built, so it's already stale.
+                stale_since = None if generation == self.generation else now
+                self.snapshots[key] = Snapshot(tree=tree, built=now,
+                                               stale_since=stale_since)
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.done.set()
+        return flight
+
+    def rebuild_in_thread(self, key, flight, build_kwargs):
+        try:
+            return self.rebuild(key, flight, build_kwargs)
+        finally:
+            # the thread has a connection of its own.
+            connection.close()
+
+    def get_tree(self, key, build_kwargs):
+        snapshot = self.snapshots.get(key)
+        if snapshot is not None and snapshot.stale_since is None:
+            return snapshot.tree
+
+        in_grace = (snapshot is not None and time.time() -
+                    snapshot.stale_since < self.get_setting('grace', 30))
+        flight, leader = self.claim(key)
+        if in_grace:
+            if leader and self.get_setting('refresh', 'thread') == 'thread':
+                thread = threading.Thread(
+                    target=self.rebuild_in_thread,
+                    args=(key, flight, build_kwargs),
+                    name='menuhin-snapshot-{0}'.format(key[0]))
+                thread.daemon = True
+                thread.start()
+            elif leader:
+                self.rebuild(key, flight, build_kwargs)
+                if flight.error is None:
+                    return flight.tree
+            return snapshot.tree
+
+        if leader:
+            self.rebuild(key, flight, build_kwargs)
+        elif flight is not None:
+            flight.done.wait(self.get_setting('wait', 5))
+        if (flight is not None and flight.done.is_set() and
+                flight.error is None):
+            return flight.tree
+        if snapshot is not None:
+            logger.warning("Serving the last good menu for {0!r}".format(key))
+            return snapshot.tree
+        logger.error("No menu available for {0!r}".format(key))
+        return ()
+
+    def get(self, model, site, parent=None, from_depth=None, to_depth=None):
+        """
+        The same as `get_published_annotated_list`, built at most once for
+        each change to the site's menus.
+        """
+        self.subscribe()
+        key = self.get_key(site.pk, parent, from_depth, to_depth)
+        tree = self.get_tree(key, build_kwargs={
+            'model': model, 'site': site, 'parent': parent,
+            'from_depth': from_depth, 'to_depth': to_depth})
+        return [(copy.copy(node), info) for node, info in tree]
+
+
+menu_snapshots = MenuSnapshots()
@@ -9,7 +9,9 @@
     }
 
 
-    var do_ajax_success = function(data, textStatus, jqXHR) {
+    var POLL_INTERVAL = 1000;
+
+    var do_missing_success = function(data, textStatus, jqXHR) {
         var callback = enable_submits;
         // in the event there were no missing items to add, the server returns
         // 202 so that we can avoid re-enabling the save button for no reason.
@@ -21,6 +23,76 @@
         $('.menuhin_preview').html(data).fadeIn(500, callback);
     };
 
+    var load_missing = function(url) {
+        $.ajax({
+            url: url,
+            type: 'GET',
+            success: do_missing_success,
+            error: do_ajax_error,
+            cache: false
+        });
+    };
+
+    // the preview runs in the background; ask after it until it's done,
+    // then fetch the first page of whatever it found missing.
+    var poll_job = function(job) {
+        if (job.status === 'failed') {
+            do_ajax_error({status: 403, responseText: job.error});
+        } else if (job.done) {
+            $('.menuhin_preview').data('missing-url', job.missing_url);
+            load_missing(job.missing_url);
+        } else {
+            $('.menuhin_preview').html('<p>' + job.progress + '%</p>').show();
+            window.setTimeout(function() {
+                $.ajax({
+                    url: job.status_url,
+                    type: 'GET',
+                    dataType: 'json',
+                    success: poll_job,
+                    error: do_ajax_error,
+                    cache: false
+                });
+            }, POLL_INTERVAL);
+        }
+    };
+
+    var do_ajax_success = function(data, textStatus, jqXHR) {
+        poll_job(data);
+    };
+
+    var do_page = function(evt) {
+        var page = $(this).attr('href');
+        var url = $(this).closest('.menuhin_preview').data('missing-url');
+        evt.preventDefault();
+        if (url) {
+            load_missing(url + page);
+        }
+    };
+
+    var poll_progress = function() {
+        var progress = $('.menuhin_progress');
+        var url = progress.data('status-url');
+        if (!url) {
+            return;
+        }
+        $.ajax({
+            url: url,
+            type: 'GET',
+            dataType: 'json',
+            cache: false,
+            success: function(job) {
+                progress.find('.menuhin_progress_status').text(job.status);
+                progress.find('.menuhin_progress_percent').text(job.progress);
+                if (job.error) {
+                    progress.append($('<p class="errornote"></p>').text(job.error));
+                }
+                if (!job.done) {
+                    window.setTimeout(poll_progress, POLL_INTERVAL);
+                }
+            }
+        });
+    };
+
     var do_ajax_error = function(data, textStatus, jqXHR) {
         var preview_html = $('.menuhin_preview');
         if (data !== void(0) && data.status !== void(0)) {
@@ -51,6 +123,7 @@
                 url: form.attr('action'),
                 data: form.serialize(),
                 type: 'POST',
+                dataType: 'json',
                 success: do_ajax_success,
                 error: do_ajax_error,
                 cache: false
@@ -70,6 +143,8 @@
     var setup = function() {
         $('#id_klass').bind('change', do_ajax);
         $('form').bind('submit', disable_submits);
+        $('.menuhin_preview').delegate('a.menuhin_page', 'click', do_page);
+        poll_progress();
     };
     $(document).ready(setup);
 })(django.jQuery);
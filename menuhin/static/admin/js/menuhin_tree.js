@@ -0,0 +1,95 @@
+;(function($) {
+
+    // treebeard binds its drag and drop handlers when the page loads, so
+    // rows loaded afterwards are given copies of an existing row's.
+    var copy_handlers = function(from, to, type) {
+        var events;
+        if (from.length === 0) {
+            return;
+        }
+        events = $._data ? $._data(from[0], 'events') : from.data('events');
+        if (events && events[type]) {
+            $.each(events[type], function(index, handler) {
+                if (handler.handler !== expand) {
+                    to.bind(type, handler.handler);
+                }
+            });
+        }
+    };
+
+    var has_loaded_children = function(row) {
+        return $('tr[parent=' + row.attr('node') + ']').length > 0;
+    };
+
+    var insert_rows = function(after, html) {
+        var rows = $('<div/>').html(html).find('tbody tr');
+        var last = after;
+        var handle = $('#result_list tbody tr td.drag-handler span').first();
+        rows.each(function() {
+            var child = $(this);
+            child.insertAfter(last);
+            last = child;
+            if (handle.hasClass('active')) {
+                copy_handlers(handle, child.find('td.drag-handler span')
+                                           .addClass('active'), 'mousedown');
+            }
+            if (child.find('a.collapse').length > 0) {
+                child.find('a.collapse').removeClass('expanded')
+                                        .addClass('collapsed');
+                copy_handlers($('#result_list a.collapse').not(
+                                  rows.find('a.collapse')).first(),
+                              child.find('a.collapse'), 'click');
+                child.find('a.collapse').bind('click', expand);
+            }
+        });
+        return last;
+    };
+
+    var load_children = function(row, page, after) {
+        var params = {'path': row.attr('data-path')};
+        if (page) {
+            params.p = page;
+        }
+        row.addClass('menuhin-loading');
+        $.ajax({
+            url: $('#menuhin-tree').attr('data-children'),
+            data: params,
+            dataType: 'json',
+            success: function(data) {
+                var last = insert_rows(after || row, data.html);
+                row.removeClass('menuhin-loading');
+                if (data.next_page !== null) {
+                    load_children(row, data.next_page, last);
+                }
+            },
+            error: function() {
+                row.removeClass('menuhin-loading');
+            }
+        });
+    };
+
+    var expand = function() {
+        var row = $(this).closest('tr');
+        if (!has_loaded_children(row) && !row.hasClass('menuhin-loading')) {
+            load_children(row);
+        }
+        return false;
+    };
+
+    var setup = function() {
+        if ($('#menuhin-tree').length === 0) {
+            return;
+        }
+        $('#result_list tbody tr').each(function() {
+            var row = $(this);
+            var collapse = row.find('a.collapse');
+            var unloaded = parseInt(row.attr('children-num'), 10) > 0 &&
+                           !has_loaded_children(row);
+            if (unloaded) {
+                collapse.removeClass('expanded').addClass('collapsed');
+            }
+            collapse.bind('click', expand);
+        });
+    };
+    $(document).ready(setup);
+})(django.jQuery);
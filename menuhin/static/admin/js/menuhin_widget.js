@@ -0,0 +1,77 @@
+;(function($) {
+
+    var PAGE_PARAM = 'page';
+    var TERM_PARAM = 'q';
+
+    var build_option = function(result) {
+        return $('<option/>').val(result.value).text(result.label);
+    };
+
+    var search = function(select, term, page) {
+        var url = select.attr('data-menuhin-search');
+        var params = {};
+        params[TERM_PARAM] = term;
+        params[PAGE_PARAM] = page;
+        $.ajax({
+            url: url,
+            data: params,
+            dataType: 'json',
+            cache: true,
+            success: function(data) {
+                var empty = select.find('option[value=""]').first().clone();
+                var selected = select.find('option:selected').clone();
+                if (page === 1) {
+                    select.empty().append(empty);
+                    if (selected.val()) {
+                        select.append(selected);
+                    }
+                } else {
+                    select.find('.menuhin-more').remove();
+                }
+                $.each(data.results, function(index, result) {
+                    if (result.value !== selected.val()) {
+                        select.append(build_option(result));
+                    }
+                });
+                if (data.more) {
+                    $('<option/>').addClass('menuhin-more')
+                        .attr('data-page', page + 1)
+                        .val('')
+                        .text('…').appendTo(select);
+                }
+            }
+        });
+    };
+
+    var setup_one = function() {
+        var select = $(this);
+        var timer = null;
+        var input = $('<input type="search" class="vTextField"/>')
+            .attr('placeholder', 'Search…')
+            .insertBefore(select);
+        input.bind('keyup', function() {
+            var term = $.trim(input.val());
+            window.clearTimeout(timer);
+            timer = window.setTimeout(function() {
+                search(select, term, 1);
+            }, 250);
+        });
+        select.data('menuhin-value', select.val());
+        select.bind('change', function() {
+            var more = select.find('option.menuhin-more:selected');
+            if (more.length > 0) {
+                // choosing "more" loads the next page, keeping the value.
+                select.val(select.data('menuhin-value') || '');
+                search(select, $.trim(input.val()),
+                       parseInt(more.attr('data-page'), 10));
+            } else {
+                select.data('menuhin-value', select.val());
+            }
+        });
+    };
+
+    var setup = function() {
+        $('select[data-menuhin-search]').each(setup_one);
+    };
+    $(document).ready(setup);
+})((window.django && window.django.jQuery) || window.jQuery);
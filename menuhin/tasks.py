@@ -1,26 +1,117 @@
-from itertools import chain
+from django.conf import settings
 from django.contrib.sites.models import Site
-from celery.decorators import shared_task
-from .utils import update_all_urls, _collect_menus
+from django.db import IntegrityError
+from django.utils.dateparse import parse_datetime
+from celery import shared_task, chord
+from celery.signals import task_postrun
+from .utils import (update_all_urls, _collect_menus, sync_handlers,
+                    collect_urls, unique_rows, row_to_uri, chunked, sync_urls,
+                    record_watermarks, CollectedURLs)
 from .models import MenuItem
+from .jobs import run_import_job
+from .versions import publish_pending
+
+
+def get_task_chunk_size():
+    return getattr(settings, 'MENUHIN_TASK_CHUNK_SIZE', 1000)
 
 
 @shared_task
-def update_urls_for_all_sites():
+def update_urls_for_all_sites(full=False, chunk_size=None):
     """
     Run this one periodically, to asynchronously update all the URLs
-    for all sites
+    for all sites.
+
+    Every handler is asked for its URLs once, which are flattened into
+    (path, title, content_type_id, object_pk) rows and sent out in chunks
+    of `chunk_size`, one task per site and chunk. Once all the chunks for a
+    site are done, `finish_site_update` totals them up.
+
+    Handlers with an `updated_field` only look at what changed since their
+    last successful run, unless `full` is True.
+    """
+    if chunk_size is None:
+        chunk_size = get_task_chunk_size()
+    site_pks = tuple(Site.objects.values_list('pk', flat=True))
+    if len(site_pks) == 0:
+        return None
+    collected = collect_urls(_collect_menus(), site_id=site_pks, full=full)
+    chunks = tuple(chunked(unique_rows(collected.urls), chunk_size))
+    finished = {
+        'watermarked': collected.watermarked,
+        'started': collected.started.isoformat(),
+    }
+    for site_pk in site_pks:
+        callback = finish_site_update.s(site_pk=site_pk, **finished)
+        if len(chunks) == 0:
+            callback.delay([])
+            continue
+        header = [update_urls_for_chunk.s(site_pk=site_pk, rows=rows)
+                  for rows in chunks]
+        chord(header)(callback)
+    return {'sites': len(site_pks), 'chunks': len(chunks)}
+
+
+@shared_task(bind=True, max_retries=5)
+def update_urls_for_chunk(self, site_pk, rows):
+    """
+    Sync one chunk of rows into a site. Because a chunk is only part of
+    the handlers' output, nothing is ever unpublished from here.
     """
-    for site in Site.objects.only('pk').iterator():
-        url_iterables = [x.instance.get_urls() for x in _collect_menus()]
-        all_urls = frozenset(chain(*url_iterables))
-        update_urls_for_site.delay(site_pk=site, url_set=all_urls)
+    urls = tuple(row_to_uri(row) for row in rows)
+    try:
+        result = sync_urls(model=MenuItem, urls=urls, site_id=site_pk,
+                           partial=True)
+    except IntegrityError as exc:
+        # chunks for the same tree run concurrently, and may collide when
+        # adding root nodes; each chunk is idempotent, so try it again.
+        raise self.retry(exc=exc, countdown=1)
+    return result.counts()
+
+
+@shared_task
+def finish_site_update(results, site_pk, watermarked=(), started=None):
+    totals = {'site': site_pk, 'chunks': len(results), 'inserted': 0,
+              'retitled': 0, 'unpublished': 0}
+    for result in results:
+        for key in ('inserted', 'retitled', 'unpublished'):
+            totals[key] += result[key]
+    if started is not None and watermarked:
+        collected = CollectedURLs(urls=(), partial=True,
+                                  watermarked=tuple(watermarked),
+                                  started=parse_datetime(started))
+        record_watermarks(collected, site_id=site_pk)
+    return totals
 
 
 @shared_task
-def update_urls_for_site(site_pk, url_set):
+def update_urls_for_site(site_pk, url_set=None, full=False):
+    if url_set is None:
+        result = sync_handlers(model=MenuItem, menus=_collect_menus(),
+                               site_id=site_pk, full=full)
+        return result.counts()
     results = update_all_urls(model=MenuItem, possible_urls=url_set,
                               site_id=site_pk)
     if results is not None:
         results = tuple(results)
     return results
+
+
+@shared_task
+def run_import_job_task(job_pk):
+    job = run_import_job(job_pk)
+    if job is None:
+        return None
+    return job.as_dict()
+
+
+def publish_after_task(**kwargs):
+    """
+    task_postrun listener to publish the tree versions any task bumped
+    inside a transaction, as there's no request to finish.
+    """
+    publish_pending()
+
+
+task_postrun.connect(publish_after_task,
+                     dispatch_uid='menuhin_publish_after_task')
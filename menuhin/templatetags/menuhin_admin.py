@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from django import template
+from treebeard.templatetags.admin_tree import result_tree
+
+
+register = template.Library()
+
+
+@register.inclusion_tag(
+    'admin/menuhin/menuitem/tree_change_list_results.html',
+    takes_context=True)
+def menuhin_result_tree(context, cl, request):
+    """
+    treebeard's `result_tree`, with each row's path, so that its children
+    may be loaded on demand.
+    """
+    data = result_tree(context, cl, request)
+    data['results'] = [row + (node.path,) for row, node
+                       in zip(data['results'], cl.result_list)]
+    return data
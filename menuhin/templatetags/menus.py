@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 import logging
 from collections import namedtuple
-from django.contrib.sites.models import Site
 from classytags.core import Options
 from classytags.arguments import Argument, IntegerArgument
 from classytags.helpers import InclusionTag, AsTag
+from django.conf import settings
 from django.db.models.query_utils import DeferredAttribute
 from django.utils.functional import lazy
 from menuhin.models import MenuItem
-from menuhin.utils import marked_annotated_list
+from menuhin.utils import marked_annotated_list, get_current_site
+from menuhin.snapshots import menu_snapshots
+from menuhin.treefiles import get_published_annotated_list
 from django import template
 from django.core.validators import slug_re
 try:
@@ -106,7 +108,7 @@ class ShowMenu(GetMenuItem, InclusionTag, AsTag):
     )
 
     def get_context(self, context, menu_slug, from_depth, to_depth, template, **kwargs):
-        site = Site.objects.get_current()
+        site = get_current_site(context.get('request'))
         # allow passing through None or "" ...
         if not from_depth:
             from_depth = 0
@@ -133,8 +135,14 @@ class ShowMenu(GetMenuItem, InclusionTag, AsTag):
             return base
 
         menu_root.is_active = True
-        depth_filtered_menu = MenuItem.get_published_annotated_list(
-            parent=menu_root, from_depth=from_depth, to_depth=to_depth)
+        if getattr(settings, 'MENUHIN_SNAPSHOTS', False):
+            depth_filtered_menu = menu_snapshots.get(
+                MenuItem, site=site, parent=menu_root, from_depth=from_depth,
+                to_depth=to_depth)
+        else:
+            depth_filtered_menu = get_published_annotated_list(
+                MenuItem, site=site, parent=menu_root, from_depth=from_depth,
+                to_depth=to_depth)
 
         if 'request' in context:
             marked_annotated_menu = marked_annotated_list(
@@ -177,7 +185,7 @@ class ShowBreadcrumbs(GetMenuItem, InclusionTag, AsTag):
     )
 
     def get_context(self, context, path_or_menuslug, template, **kwargs):
-        site = Site.objects.get_current()
+        site = get_current_site(context.get('request'))
         base = {
             'site': site,
             'template': template or self.template,
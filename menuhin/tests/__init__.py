@@ -1,13 +1,24 @@
-# from .admin import *
+from .admin import *
+from .bus import *
+from .codec import *
 from .context_processors import *
 from .middleware import *
 from .utils import *
 from .models import *
 from .forms import *
+from .jobs import *
 # from .signals import *
 from .sitemaps import *
+from .snapshots import *
 from .templatetags import *
-# from .views import *
+from .tasks import *
+from .treefiles import *
+from .listeners import *
+from .widgets import *
+from .views import *
+from .views_drf import *
+from .versions import *
+from .warming import *
 
 try:
     from unittest import TestCase
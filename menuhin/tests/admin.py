@@ -0,0 +1,48 @@
+from django.test import TestCase as TestCaseWithDB
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from menuhin.admin import MenuItemAdmin, CHILDREN_VAR
+from menuhin.models import MenuItem
+from .data import get_bulk_data
+
+
+class MenuItemChangeListTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+        self.modeladmin = MenuItemAdmin(MenuItem, admin.site)
+        self.user = User.objects.create_superuser(
+            username='admin', password='admin', email='admin@example.com')
+
+    def changelist(self, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        response = self.modeladmin.changelist_view(request)
+        return response.context_data['cl']
+
+    def titles(self, cl):
+        return [x.title for x in cl.result_list]
+
+    def test_roots_only(self):
+        self.assertEqual(self.titles(self.changelist()), ['1', '2', '3', '4'])
+
+    @override_settings(MENUHIN_ADMIN_CHANGELIST_DEPTH=None)
+    def test_whole_tree(self):
+        self.assertEqual(len(self.changelist().result_list), 10)
+
+    def test_children(self):
+        parent = MenuItem.objects.get(title='2')
+        cl = self.changelist(**{CHILDREN_VAR: parent.path})
+        self.assertEqual(self.titles(cl), ['21', '22', '23', '24'])
+        for node in cl.result_list:
+            with self.assertNumQueries(0):
+                self.assertEqual(node.get_parent(), parent)
+
+    def test_search_shows_ancestors(self):
+        cl = self.changelist(q='231')
+        self.assertEqual(self.titles(cl), ['231'])
+        with self.assertNumQueries(0):
+            ancestry = self.modeladmin.ancestry(cl.result_list[0])
+        self.assertEqual(ancestry, '2 > 23')
+        self.assertIn('ancestry', cl.list_display)
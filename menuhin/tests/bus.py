@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+try:
+    from unittest import TestCase
+except ImportError:  # pragma: no cover
+    from django.utils.unittest import TestCase
+from django.test.utils import override_settings
+from menuhin.bus import (InvalidationBus, LocalTransport, FileTransport,
+                         encode_message, decode_message, get_bus)
+
+
+class MessageTestCase(TestCase):
+    def test_roundtrip(self):
+        self.assertEqual(decode_message(encode_message('abc', (1, 2))),
+                         ('abc', (1, 2)))
+
+    def test_everything(self):
+        self.assertEqual(decode_message(encode_message('abc', None)),
+                         ('abc', None))
+
+    def test_blank(self):
+        self.assertIsNone(decode_message(''))
+
+
+class InvalidationBusTestCase(TestCase):
+    def setUp(self):
+        self.received = []
+        self.bus = InvalidationBus(transport=LocalTransport())
+        self.bus.subscribe(self.received.append)
+
+    def test_publish_delivers_locally(self):
+        self.bus.publish([1, 2])
+        self.assertEqual(self.received, [(1, 2)])
+
+    def test_own_messages_ignored(self):
+        self.bus.receive((self.bus.token, (1,)))
+        self.bus.receive(('elsewhere', (2,)))
+        self.assertEqual(self.received, [(2,)])
+
+    def test_unsubscribe(self):
+        self.bus.unsubscribe(self.received.append)
+        self.bus.publish([1])
+        self.assertEqual(self.received, [])
+
+
+class FileTransportTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'invalidations')
+        self.received = []
+        self.publisher = InvalidationBus(FileTransport(path=self.path))
+        self.subscriber = InvalidationBus(FileTransport(path=self.path),
+                                          poll_interval=60)
+        self.subscriber.subscribe(self.received.append)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reaches_other_bus(self):
+        self.publisher.publish([1])
+        self.publisher.publish(None)
+        self.assertEqual(self.subscriber.poll(force=True), 2)
+        self.assertEqual(self.received, [(1,), None])
+        self.assertEqual(self.subscriber.poll(force=True), 0)
+
+    def test_poll_interval(self):
+        self.subscriber.poll(force=True)
+        self.publisher.publish([1])
+        self.assertIsNone(self.subscriber.poll())
+        self.assertEqual(self.received, [])
+
+    def test_partial_line_left(self):
+        with open(self.path, 'a') as handle:
+            handle.write('elsewhere 1\nelsewhere')
+        self.subscriber.poll(force=True)
+        self.assertEqual(self.received, [(1,)])
+        with open(self.path, 'a') as handle:
+            handle.write(' 2\n')
+        self.subscriber.poll(force=True)
+        self.assertEqual(self.received, [(1,), (2,)])
+
+    def test_truncated(self):
+        self.publisher.publish([1])
+        self.subscriber.poll(force=True)
+        open(self.path, 'w').close()
+        self.subscriber.poll(force=True)
+        self.assertEqual(self.received, [(1,), None])
+
+    def test_rotated(self):
+        # each line is 35 bytes, so every other one replaces the file (and
+        # a replacement may well reuse the inode of the one before).
+        self.publisher.transport.max_size = 50
+        self.publisher.publish([1])
+        self.subscriber.poll(force=True)
+        for site_id in range(2, 6):
+            self.publisher.publish([site_id])
+        self.assertTrue(os.path.getsize(self.path) <= 50)
+        self.subscriber.poll(force=True)
+        self.assertEqual(self.received, [(1,), None])
+
+
+class GetBusTestCase(TestCase):
+    def test_rebuilt_after_fork(self):
+        bus = get_bus()
+        self.assertIs(get_bus(), bus)
+        # as if inherited from the process which forked this one.
+        bus.pid = -1
+        self.assertIsNot(get_bus(), bus)
+        self.assertNotEqual(get_bus().token, bus.token)
+
+    def test_setting(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(
+                    MENUHIN_INVALIDATION_TRANSPORT='menuhin.bus.FileTransport',
+                    MENUHIN_INVALIDATION_OPTIONS={'path': tmpdir + '/x'}):
+                self.assertIsInstance(get_bus().transport, FileTransport)
+            self.assertIsInstance(get_bus().transport, LocalTransport)
+        finally:
+            shutil.rmtree(tmpdir)
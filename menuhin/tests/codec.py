@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+from menuhin.codec import (encode_tree, decode_tree, decode_header,
+                           TreeReader, Node, CodecError, FORMAT_VERSION)
+
+
+ROWS = (
+    (1, 1, 2, True, '0001', '/', 'Home', 'default'),
+    (2, 2, 0, False, '00010001', '/a/', u'\xc4 ☃', None),
+    (3, 2, 0, True, '00010002', '/b/', '', 'b'),
+    (70000, 1, 0, True, '0002', '/x/', 'X', None),
+)
+
+
+class CodecTestCase(TestCase):
+    def test_roundtrip(self):
+        self.assertEqual(decode_tree(encode_tree(ROWS)),
+                         [Node(*x) for x in ROWS])
+
+    def test_compressed_roundtrip(self):
+        data = encode_tree(ROWS * 50, compress=True)
+        self.assertTrue(len(data) < len(encode_tree(ROWS * 50)))
+        self.assertEqual(decode_tree(data), [Node(*x) for x in ROWS * 50])
+
+    def test_empty(self):
+        self.assertEqual(decode_tree(encode_tree(())), [])
+
+    def test_header(self):
+        header = decode_header(encode_tree(ROWS, site_id=2, version=5,
+                                           compress=True))
+        self.assertEqual(header.format_version, FORMAT_VERSION)
+        self.assertEqual((header.site_id, header.version, header.count),
+                         (2, 5, 4))
+
+    def test_other_versions_rejected(self):
+        data = bytearray(encode_tree(ROWS))
+        data[4] += 1
+        self.assertRaises(CodecError, decode_tree, bytes(data))
+
+    def test_truncated(self):
+        data = encode_tree(ROWS)
+        self.assertRaises(CodecError, decode_tree, data[:-1])
+        self.assertRaises(CodecError, decode_tree, data[:10])
+        self.assertRaises(CodecError, TreeReader, data[:30])
+
+    def test_corrupt_compression(self):
+        data = encode_tree(ROWS, compress=True)
+        self.assertRaises(CodecError, decode_tree, data[:-4] + b'nope')
+
+    def test_reader(self):
+        reader = TreeReader(encode_tree(ROWS))
+        self.assertEqual(len(reader), 4)
+        self.assertEqual(reader[1], Node(*ROWS[1]))
+        self.assertEqual(list(reader), decode_tree(encode_tree(ROWS)))
+        self.assertRaises(IndexError, lambda: reader[4])
+
+    def test_reader_refuses_compressed(self):
+        self.assertRaises(CodecError, TreeReader,
+                          encode_tree(ROWS, compress=True))
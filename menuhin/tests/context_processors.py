@@ -1,7 +1,9 @@
 from django.test import TestCase as TestCaseUsingDB
 from django.test.client import RequestFactory
 from menuhin.models import MenuItem
-from menuhin.context_processors import request_ancestors, request_descendants
+from django.core.cache import cache
+from menuhin.context_processors import (request_ancestors, request_descendants,
+                                        tree_version)
 from .data import get_bulk_data
 
 
@@ -43,3 +45,12 @@ class LazyDescendantsTestCase(TestCaseUsingDB):
         resp = request_descendants(req)
         self.assertIn('MENUHIN_DESCENDANTS', resp)
         self.assertEqual(resp['MENUHIN_DESCENDANTS'], 'FAKE')
+
+
+class TreeVersionContextProcessorTestCase(TestCaseUsingDB):
+    def test_usage(self):
+        cache.clear()
+        req = RequestFactory().get('/')
+        self.assertEqual(tree_version(req), {'MENUHIN_TREE_VERSION': 0})
+        MenuItem.load_bulk(get_bulk_data())
+        self.assertEqual(tree_version(req), {'MENUHIN_TREE_VERSION': 1})
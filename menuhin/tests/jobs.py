@@ -0,0 +1,197 @@
+import json
+from django.test import TestCase as TestCaseWithDB
+from django.test.client import RequestFactory
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.test.utils import override_settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from menuhin.admin import MenuItemAdmin
+from menuhin.jobs import (run_import_job, get_runner, start_import_job,
+                          discard_pending_jobs)
+from menuhin.models import MenuItem, ImportJob, URI
+
+
+HANDLERS = (
+    'menuhin.tests.data.TestMenu1',
+    'menuhin.tests.data.TestMenu2'
+)
+
+
+@override_settings(MENUHIN_MENU_HANDLERS=HANDLERS)
+class RunImportJobTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        for name in ('a', 'b', 'c'):
+            User.objects.create(username=name)
+
+    def job(self, **kwargs):
+        kwargs.setdefault('handler', 'menuhin.tests.data.TestMenu1')
+        return ImportJob.objects.create(site=self.site, **kwargs)
+
+    def test_preview(self):
+        job = run_import_job(self.job(kind=ImportJob.PREVIEW).pk)
+        self.assertEqual(job.status, ImportJob.FINISHED)
+        self.assertEqual(job.total, 3)
+        self.assertEqual(job.processed, 3)
+        self.assertEqual(job.inserted, 0)
+        self.assertEqual(sorted(x.path for x in job.get_missing()),
+                         ['/usertest/a', '/usertest/b', '/usertest/c'])
+        self.assertEqual(MenuItem.objects.count(), 0)
+
+    def test_import(self):
+        job = run_import_job(self.job(kind=ImportJob.IMPORT).pk)
+        self.assertEqual(job.status, ImportJob.FINISHED)
+        self.assertEqual(job.inserted, 3)
+        self.assertEqual(job.get_missing(), [])
+        self.assertEqual(
+            MenuItem.objects.filter(uri__startswith='/usertest/').count(), 3)
+
+    @override_settings(MENUHIN_SYNC_CHUNK_SIZE=1)
+    def test_progress_saved_per_chunk(self):
+        job = self.job(kind=ImportJob.IMPORT)
+        run_import_job(job.pk)
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.processed, 3)
+        self.assertEqual(job.progress(), 100)
+
+    def test_claimed_elsewhere(self):
+        job = self.job()
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.RUNNING)
+        # as if fetched just before another worker claimed it.
+        ImportJob.objects.get = lambda **kwargs: job
+        try:
+            self.assertEqual(run_import_job(job.pk).processed, 0)
+        finally:
+            del ImportJob.objects.get
+        self.assertEqual(ImportJob.objects.get(pk=job.pk).status,
+                         ImportJob.RUNNING)
+
+    def test_already_run(self):
+        job = self.job(status=ImportJob.FINISHED)
+        with self.assertNumQueries(1):
+            self.assertEqual(run_import_job(job.pk).pk, job.pk)
+
+    def test_missing_job(self):
+        self.assertIsNone(run_import_job(1000))
+
+    def test_unknown_handler_fails(self):
+        job = run_import_job(self.job(handler='menuhin.tests.data.Nope').pk)
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertIn('Nope', job.error)
+        self.assertTrue(job.is_done())
+
+
+class ImportJobTestCase(TestCaseWithDB):
+    def test_progress(self):
+        job = ImportJob(total=0, processed=0)
+        self.assertEqual(job.progress(), 0)
+        job.total, job.processed = 3, 1
+        self.assertEqual(job.progress(), 33)
+        job.status = ImportJob.FINISHED
+        self.assertEqual(job.progress(), 100)
+
+    def test_missing_roundtrip(self):
+        job = ImportJob()
+        self.assertEqual(job.get_missing(), [])
+        job.set_missing([URI(path='/a/', title='A')])
+        self.assertEqual(job.get_missing(), [URI(path='/a/', title='A')])
+
+    def test_runner_defaults_to_threads(self):
+        self.assertEqual(get_runner(), 'thread')
+
+    @override_settings(MENUHIN_IMPORT_RUNNER='celery')
+    def test_runner_setting(self):
+        self.assertEqual(get_runner(), 'celery')
+
+    def test_started_after_transaction(self):
+        job = ImportJob.objects.create(site=Site.objects.get_current(),
+                                       handler='menuhin.tests.data.TestMenu1')
+        try:
+            # the test's own transaction is still open.
+            self.assertIsNone(start_import_job(job))
+        finally:
+            discard_pending_jobs()
+        self.assertEqual(ImportJob.objects.get(pk=job.pk).status,
+                         ImportJob.PENDING)
+
+
+@override_settings(MENUHIN_MENU_HANDLERS=HANDLERS)
+class ImportJobViewsTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.modeladmin = MenuItemAdmin(MenuItem, admin.site)
+        self.user = User.objects.create_superuser(
+            username='admin', password='admin', email='admin@example.com')
+        self.job = ImportJob.objects.create(
+            site=Site.objects.get_current(), kind=ImportJob.PREVIEW,
+            handler='menuhin.tests.data.TestMenu1')
+
+    def tearDown(self):
+        discard_pending_jobs()
+
+    def request(self, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        return request
+
+    def post(self, **kwargs):
+        data = {'site': Site.objects.get_current().pk,
+                'klass': 'menuhin.tests.data.TestMenu1'}
+        request = RequestFactory().post('/', data, **kwargs)
+        request.user = self.user
+        request._messages = CookieStorage(request)
+        return request
+
+    def test_import_post(self):
+        response = self.modeladmin.import_view(self.post())
+        self.assertEqual(response.status_code, 302)
+        job = ImportJob.objects.exclude(pk=self.job.pk).get()
+        self.assertEqual(job.kind, ImportJob.IMPORT)
+        self.assertTrue(response['Location'].endswith(
+            '?job={0}'.format(job.pk)))
+
+    def test_preview_ajax(self):
+        response = self.modeladmin.import_view(
+            self.post(HTTP_X_REQUESTED_WITH='XMLHttpRequest'))
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.content.decode('utf-8'))
+        job = ImportJob.objects.get(pk=data['id'])
+        self.assertEqual(job.kind, ImportJob.PREVIEW)
+        # not started until the request's transaction is over.
+        self.assertEqual(data['status'], ImportJob.PENDING)
+        self.assertIn('status_url', data)
+
+    def test_invalid_ajax(self):
+        request = RequestFactory().post(
+            '/', {}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = self.user
+        response = self.modeladmin.import_view(request)
+        self.assertEqual(response.status_code, 403)
+
+    def test_status(self):
+        response = self.modeladmin.import_status_view(self.request(),
+                                                      pk=self.job.pk)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['status'], ImportJob.PENDING)
+        self.assertFalse(data['done'])
+        self.assertIn('status_url', data)
+        self.assertIn('missing_url', data)
+
+    def test_missing_paginated(self):
+        self.job.status = ImportJob.FINISHED
+        self.job.set_missing([URI(path='/{0}/'.format(x), title=str(x))
+                              for x in range(3)])
+        self.job.save()
+        with self.settings(MENUHIN_IMPORT_PREVIEW_PAGE_SIZE=2):
+            response = self.modeladmin.import_missing_view(
+                self.request(page=2), pk=self.job.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x.path for x in response.context_data['missing']],
+                         ['/2/'])
+
+    def test_nothing_missing(self):
+        self.job.status = ImportJob.FINISHED
+        self.job.save()
+        response = self.modeladmin.import_missing_view(self.request(),
+                                                       pk=self.job.pk)
+        self.assertEqual(response.status_code, 202)
@@ -0,0 +1,205 @@
+try:
+    from django.utils.unittest import TestCase
+except ImportError:  # pragma: no cover
+    from unittest import TestCase
+from django.test import TestCase as TestCaseWithDB
+from django.contrib.sites.models import Site
+from django.db.models.signals import pre_delete
+from menuhin.models import MenuItem
+from menuhin.listeners import (create_menu_url, unpublish_on_delete,
+                               defer_menu_updates, coalesce_moves,
+                               remember_menu_state, update_old_url,
+                               unpublish_urls, MenuAwareQuerySet)
+
+
+class CoalesceMovesTestCase(TestCase):
+    def test_chains(self):
+        moves = [('/a/', '/b/', 'b'), ('/B/', '/c/', 'c'),
+                 ('/x/', '/y/', None)]
+        self.assertEqual(coalesce_moves(moves), [('/a/', '/c/', 'c'),
+                                                 ('/x/', '/y/', None)])
+
+    def test_round_trip_is_dropped(self):
+        moves = [('/a/', '/b/', None), ('/b/', '/a/', None)]
+        self.assertEqual(coalesce_moves(moves), [])
+
+    def test_title_change_is_kept(self):
+        moves = [('/a/', '/a/', 'new')]
+        self.assertEqual(coalesce_moves(moves), [('/a/', '/a/', 'new')])
+
+
+class DeferMenuUpdatesTestCase(TestCaseWithDB):
+    """
+    MenuItems stand in for the original objects, living on another site
+    so that they don't get confused with the ones the listeners make.
+    """
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.othersite = Site(domain='x.com', name='y.com')
+        self.othersite.full_clean()
+        self.othersite.save()
+        self.originals = [
+            MenuItem.add_root(uri='/original/{0}/'.format(x),
+                              title=str(x), site=self.othersite)
+            for x in range(3)
+        ]
+
+    def created(self):
+        return MenuItem.objects.filter(site=self.site)
+
+    def test_immediate(self):
+        create_menu_url(sender=MenuItem, instance=self.originals[0],
+                        created=True)
+        self.assertEqual(self.created().count(), 1)
+
+    def test_deferred_creates(self):
+        with defer_menu_updates():
+            for obj in self.originals:
+                create_menu_url(sender=MenuItem, instance=obj, created=True)
+            self.assertEqual(self.created().count(), 0)
+        self.assertEqual(self.created().count(), 3)
+
+    def test_deferred_unpublishes(self):
+        for obj in self.originals:
+            MenuItem.add_root(uri=obj.uri, title=obj.title, site=self.site,
+                              is_published=True)
+        with defer_menu_updates():
+            for obj in self.originals[:2]:
+                unpublish_on_delete(sender=MenuItem, instance=obj)
+            self.assertEqual(self.created().filter(is_published=True)
+                             .count(), 3)
+        self.assertEqual(self.created().filter(is_published=True).count(), 1)
+
+    def test_nested(self):
+        with defer_menu_updates():
+            with defer_menu_updates():
+                create_menu_url(sender=MenuItem, instance=self.originals[0],
+                                created=True)
+            self.assertEqual(self.created().count(), 0)
+        self.assertEqual(self.created().count(), 1)
+
+
+class UpdateOldUrlTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        othersite = Site(domain='x.com', name='y.com')
+        othersite.full_clean()
+        othersite.save()
+        original = MenuItem.add_root(uri='/original/', title='original',
+                                     site=othersite)
+        self.menuitem = MenuItem.add_root(uri='/original/', title='original',
+                                          site=self.site)
+        self.original = MenuItem.objects.get(pk=original.pk)
+
+    def test_snapshot_avoids_query(self):
+        remember_menu_state(sender=MenuItem, instance=self.original)
+        self.original.uri = '/moved/'
+        self.original.title = 'moved'
+        # just the UPDATE (with the SELECT of the sites it touches, and the
+        # UPDATE and SELECT of their tree version), no SELECT of the
+        # original.
+        with self.assertNumQueries(4):
+            update_old_url(sender=MenuItem, instance=self.original,
+                           raw=False, using='default')
+        menuitem = MenuItem.objects.get(pk=self.menuitem.pk)
+        self.assertEqual(menuitem.uri, '/moved/')
+        self.assertEqual(menuitem.title, 'moved')
+
+    def test_without_snapshot(self):
+        self.original.title = 'retitled'
+        with self.assertNumQueries(5):
+            update_old_url(sender=MenuItem, instance=self.original,
+                           raw=False, using='default')
+        self.assertEqual(MenuItem.objects.get(pk=self.menuitem.pk).title,
+                         'retitled')
+
+    def test_unchanged(self):
+        remember_menu_state(sender=MenuItem, instance=self.original)
+        with self.assertNumQueries(0):
+            update_old_url(sender=MenuItem, instance=self.original,
+                           raw=False, using='default')
+
+    def test_snapshot_is_lazy(self):
+        class Loaded(object):
+            pk = 1
+            calls = 0
+
+            def get_absolute_url(self):
+                self.calls += 1
+                return '/'
+        instance = Loaded()
+        remember_menu_state(sender=Loaded, instance=instance)
+        self.assertEqual(instance.calls, 0)
+
+    def test_failed_save_keeps_snapshot(self):
+        remember_menu_state(sender=MenuItem, instance=self.original)
+        self.original.uri = '/moved/'
+        update_old_url(sender=MenuItem, instance=self.original,
+                       raw=False, using='default')
+        # as if the save failed, and its transaction was rolled back.
+        MenuItem.objects.filter(pk=self.menuitem.pk).update(uri='/original/')
+        update_old_url(sender=MenuItem, instance=self.original,
+                       raw=False, using='default')
+        self.assertEqual(MenuItem.objects.get(pk=self.menuitem.pk).uri,
+                         '/moved/')
+
+    def test_snapshot_after_save(self):
+        remember_menu_state(sender=MenuItem, instance=self.original)
+        self.original.uri = '/moved/'
+        update_old_url(sender=MenuItem, instance=self.original,
+                       raw=False, using='default')
+        # post_save
+        remember_menu_state(sender=MenuItem, instance=self.original,
+                            created=False)
+        self.original.uri = '/again/'
+        update_old_url(sender=MenuItem, instance=self.original,
+                       raw=False, using='default')
+        self.assertEqual(MenuItem.objects.get(pk=self.menuitem.pk).uri,
+                         '/again/')
+
+
+class UnpublishUrlsTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        parent = MenuItem.add_root(uri='/parent/', title='parent',
+                                   site=self.site, is_published=True)
+        parent.add_child(uri='/child/', title='child', site=self.site,
+                         is_published=True)
+        MenuItem.add_root(uri='/other/', title='other', site=self.site,
+                          is_published=True)
+
+    def published(self):
+        return sorted(MenuItem.objects.filter(is_published=True)
+                      .values_list('uri', flat=True))
+
+    def test_usage(self):
+        self.assertEqual(unpublish_urls(('/parent/', '/other/'),
+                                        site=self.site), 2)
+        self.assertEqual(self.published(), ['/child/'])
+
+    def test_mixed_case(self):
+        self.assertEqual(unpublish_urls(('/Parent/', '/OTHER/'),
+                                        site=self.site), 2)
+        self.assertEqual(self.published(), ['/child/'])
+
+    def test_descendants(self):
+        self.assertEqual(unpublish_urls(('/parent/',), site=self.site,
+                                        descendants=True), 2)
+        self.assertEqual(self.published(), ['/other/'])
+
+    def test_queryset_delete(self):
+        othersite = Site(domain='x.com', name='y.com')
+        othersite.full_clean()
+        othersite.save()
+        for uri in ('/parent/', '/other/'):
+            MenuItem.add_root(uri=uri, title=uri, site=othersite)
+        pre_delete.connect(unpublish_on_delete, sender=MenuItem,
+                           dispatch_uid='test_queryset_delete')
+        try:
+            queryset = MenuAwareQuerySet(model=MenuItem).filter(
+                site=othersite)
+            queryset.delete()
+        finally:
+            pre_delete.disconnect(sender=MenuItem,
+                                  dispatch_uid='test_queryset_delete')
+        self.assertEqual(self.published(), ['/child/'])
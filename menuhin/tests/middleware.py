@@ -7,7 +7,10 @@ from django.test.client import RequestFactory
 from django.test.utils import override_settings
 from django.contrib.sites.models import Site
 from menuhin.models import MenuItem
-from menuhin.middleware import RequestTreeMiddleware
+from django.core.cache import cache
+from django.http import HttpResponse
+from menuhin.middleware import (RequestTreeMiddleware,
+                                TreeVersionHeaderMiddleware)
 from .data import get_bulk_data
 
 
@@ -69,3 +72,21 @@ class RequestTreeMiddlewareTestCase(TestCaseWithDB):
         children = [x for x in req.children]
         urls = [x.uri for x in children]
         self.assertEqual(urls, ['/a/b/c/', '/d/', '/e', '/x/'])
+
+
+class TreeVersionHeaderMiddlewareTestCase(TestCaseWithDB):
+    def setUp(self):
+        cache.clear()
+        self.mw = TreeVersionHeaderMiddleware()
+
+    def test_header(self):
+        MenuItem.load_bulk(get_bulk_data())
+        response = self.mw.process_response(RequestFactory().get('/'),
+                                            HttpResponse())
+        self.assertEqual(response['X-Menu-Version'], '1')
+
+    @override_settings(MENUHIN_TREE_VERSION_HEADER='X-Tree')
+    def test_header_setting(self):
+        response = self.mw.process_response(RequestFactory().get('/'),
+                                            HttpResponse())
+        self.assertEqual(response['X-Tree'], '0')
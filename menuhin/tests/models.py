@@ -1,9 +1,17 @@
+import re
 try:
-    from django.utils.unittest import TestCase
+    from django.utils.unittest import TestCase, skipUnless
 except ImportError:
-    from unittest import TestCase
+    from unittest import TestCase, skipUnless
+from django.db import connection
+from django.test import TestCase as TestCaseWithDB
 from django.core.exceptions import ValidationError
-from menuhin.models import MenuItem, is_valid_uri, MenuItemGroup, URI
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.utils import timezone
+from menuhin.models import (MenuItem, is_valid_uri, MenuItemGroup, URI,
+                            ModelMenuItemGroup, InvalidModelError, ModelURI)
+from .data import get_bulk_data
 
 
 class IsValidUriTestCase(TestCase):
@@ -88,3 +96,274 @@ class MenuItemGroupTestCase(TestCase):
         menu = MyMenuIsNeat()
         menu_urls = tuple(menu.get_urls())
         self.assertEqual(len(menu_urls), 3)
+
+
+class ModelMenuItemGroupTestCase(TestCase):
+    def test_missing_model(self):
+        with self.assertRaises(InvalidModelError):
+            ModelMenuItemGroup()
+
+    def test_bad_updated_field(self):
+        class BadField(ModelMenuItemGroup):
+            model = MenuItem
+            updated_field = 'not_a_field'
+        with self.assertRaises(InvalidModelError):
+            BadField()
+
+
+class ChunkedMenuItems(ModelMenuItemGroup):
+    model = MenuItem
+    fields = ('uri', 'title')
+    chunk_size = 2
+
+
+class OldStyleMenuItems(ModelMenuItemGroup):
+    model = MenuItem
+
+    def get_queryset(self):
+        return MenuItem.objects.filter(uri='/1/')
+
+
+class ModelMenuItemGroupUrlsTestCase(TestCaseWithDB):
+    def setUp(self):
+        for x in range(5):
+            MenuItem.add_root(uri='/{0}/'.format(x), title=str(x),
+                              site=Site.objects.get_current())
+
+    def test_chunked(self):
+        menu = ChunkedMenuItems()
+        ContentType.objects.get_for_model(MenuItem)
+        # 5 rows in chunks of 2 means a third, final query.
+        with self.assertNumQueries(3):
+            urls = menu.get_urls()
+        self.assertEqual(len(urls), 5)
+        content_type = ContentType.objects.get_for_model(MenuItem)
+        for url in urls:
+            self.assertIsInstance(url, ModelURI)
+            self.assertEqual(url.content_type_id, content_type.pk)
+            self.assertEqual(MenuItem.objects.get(pk=url.object_pk).uri,
+                             url.path)
+
+    def test_get_queryset_without_since(self):
+        urls = OldStyleMenuItems().get_urls(since=timezone.now())
+        self.assertEqual([x.path for x in urls], ['/1/'])
+
+    def test_only_loads_fields(self):
+        obj = ChunkedMenuItems().get_queryset()[0]
+        self.assertIn('uri', obj.__dict__)
+        self.assertNotIn('menu_slug', obj.__dict__)
+
+
+class ModelURITestCase(TestCaseWithDB):
+    def test_from_instance(self):
+        obj = MenuItem.add_root(uri='/a/', title='a',
+                                site=Site.objects.get_current())
+        uri = ModelURI(path='/a/', title='a', model_instance=obj)
+        self.assertEqual(uri.object_pk, obj.pk)
+        self.assertEqual(uri.content_type_id,
+                         ContentType.objects.get_for_model(MenuItem).pk)
+        self.assertEqual(uri, ModelURI(path='/a/', title='a',
+                                       content_type_id=uri.content_type_id,
+                                       object_pk=obj.pk))
+
+
+class DescendantCountsTestCase(TestCaseWithDB):
+    def setUp(self):
+        site = Site.objects.get_current()
+        self.a = MenuItem.add_root(uri='/a/', title='a', site=site)
+        self.b = MenuItem.add_root(uri='/b/', title='b', site=site)
+        self.a1 = self.a.add_child(uri='/a/1/', title='a1', site=site)
+        self.a2 = self.a.add_child(uri='/a/2/', title='a2', site=site)
+        self.a11 = self.a1.add_child(uri='/a/1/1/', title='a11', site=site)
+        self.expected = {self.a.pk: 3, self.b.pk: 0, self.a1.pk: 1,
+                         self.a2.pk: 0, self.a11.pk: 0}
+
+    def test_one_query_per_depth(self):
+        nodes = list(MenuItem.objects.all())
+        with self.assertNumQueries(3):
+            counts = MenuItem.get_descendant_counts(nodes)
+        self.assertEqual(counts, self.expected)
+        for node in nodes:
+            self.assertEqual(counts[node.pk],
+                             node.get_descendants().count())
+
+    def test_complete(self):
+        nodes = list(MenuItem.objects.order_by('path'))
+        with self.assertNumQueries(0):
+            MenuItem.annotate_descendant_counts(nodes, complete=True)
+        self.assertEqual(dict((x.pk, x.descendant_count) for x in nodes),
+                         self.expected)
+
+
+def annotated_reference(nodes):
+    """
+    The annotation as get_published_annotated_list originally built it.
+    """
+    result, info = [], {}
+    start_depth, prev_depth = (None, None)
+    for node in nodes:
+        depth = node.get_depth()
+        if start_depth is None:
+            start_depth = depth
+        open = (depth and (prev_depth is None or depth > prev_depth))
+        if prev_depth is not None and depth < prev_depth:
+            info['close'] = list(range(0, prev_depth - depth))
+        info = {'open': open, 'close': [], 'level': depth - start_depth}
+        result.append((node, info,))
+        prev_depth = depth
+    if start_depth and start_depth > 0:
+        info['close'] = list(range(0, prev_depth - start_depth + 1))
+    return result
+
+
+class IterPublishedAnnotatedTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+        self.site = Site.objects.get_current()
+
+    def assertSameAnnotations(self, parent=None, **kwargs):
+        tree = MenuItem.get_tree(parent).filter(is_published=True,
+                                                site=self.site)
+        depth = 0 if parent is None else parent.get_depth()
+        if 'from_depth' in kwargs:
+            tree = tree.filter(depth__gte=depth + kwargs['from_depth'])
+        if 'to_depth' in kwargs:
+            tree = tree.filter(depth__lte=depth + kwargs['to_depth'])
+        expected = annotated_reference(tree)
+        streamed = list(MenuItem.iter_published_annotated(parent=parent,
+                                                          **kwargs))
+        self.assertEqual(streamed, expected)
+        self.assertEqual(MenuItem.get_published_annotated_list(
+            parent=parent, **kwargs), expected)
+
+    def test_equivalent(self):
+        parent = MenuItem.objects.get(title='2')
+        self.assertSameAnnotations()
+        self.assertSameAnnotations(from_depth=2)
+        self.assertSameAnnotations(to_depth=2)
+        self.assertSameAnnotations(parent=parent)
+        self.assertSameAnnotations(parent=parent, from_depth=1, to_depth=1)
+        self.assertSameAnnotations(parent=parent, to_depth=2)
+
+    def test_unpublished(self):
+        MenuItem.objects.filter(title__in=('23', '4')).update(
+            is_published=False)
+        self.assertSameAnnotations()
+
+    def test_empty(self):
+        self.assertEqual(list(MenuItem.iter_published_annotated(
+            site=Site(pk=999))), [])
+
+    def test_bad_depths_raise_immediately(self):
+        with self.assertRaises(ValueError):
+            MenuItem.iter_published_annotated(from_depth=2, to_depth=1)
+
+    def test_one_query(self):
+        with self.assertNumQueries(1):
+            for node, info in MenuItem.iter_published_annotated():
+                node.site.domain
+
+
+class PrefetchAncestorsTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+
+    def test_ancestors(self):
+        nodes = list(MenuItem.objects.filter(title__in=('231', '41', '1')))
+        with self.assertNumQueries(1):
+            MenuItem.prefetch_ancestors(nodes)
+        by_title = dict((x.title, x) for x in nodes)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [x.title for x in by_title['231'].prefetched_ancestors],
+                ['2', '23'])
+            self.assertEqual(by_title['231'].get_parent().title, '23')
+            self.assertEqual(by_title['1'].prefetched_ancestors, [])
+            self.assertIsNone(by_title['1'].get_parent())
+
+    def test_parents_only(self):
+        nodes = list(MenuItem.objects.filter(title='231'))
+        MenuItem.prefetch_ancestors(nodes, parents_only=True)
+        self.assertEqual([x.title for x in nodes[0].prefetched_ancestors],
+                         ['23'])
+
+
+SEARCH_RE = re.compile(r'^SEARCH (?:TABLE )?(?P<table>\S+)(?: AS \S+)? '
+                       r'USING (?:COVERING )?INDEX (?P<index>\S+)')
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN is SQLite's")
+class MenuItemQueryPlanTestCase(TestCaseWithDB):
+    """
+    The hot queries should each find their rows by searching the index
+    meant for them, rather than by scanning the table or any index.
+    """
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+        self.site = Site.objects.get_current()
+        self.parent = MenuItem.objects.get(title='2')
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        # the detail is the last column, whichever the SQLite version.
+        return [row[-1] for row in cursor.fetchall()]
+
+    def get_index_name(self, *fields):
+        """
+        The name of the index on exactly the given fields' columns, in order.
+        """
+        columns = tuple(MenuItem._meta.get_field(x).column for x in fields)
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = %s", [MenuItem._meta.db_table])
+        for name in [row[0] for row in cursor.fetchall()]:
+            cursor.execute('PRAGMA index_info({0})'.format(
+                connection.ops.quote_name(name)))
+            if tuple(row[2] for row in cursor.fetchall()) == columns:
+                return name
+        self.fail("No index on {0!r}".format(columns))
+
+    def assertUsesIndex(self, queryset, *fields):
+        index = self.get_index_name(*fields)
+        table = MenuItem._meta.db_table
+        plan = self.get_plan(queryset)
+        scans = [x for x in plan if x.startswith('SCAN')]
+        self.assertEqual(scans, [], "Scan in {0!r}".format(plan))
+        # older SQLites say SEARCH TABLE, newer ones just SEARCH.
+        searches = [SEARCH_RE.match(x) for x in plan]
+        used = [x.group('index') for x in searches
+                if x is not None and x.group('table') == table]
+        self.assertTrue(used, "{0} not searched in {1!r}".format(table, plan))
+        self.assertEqual(set(used), set([index]),
+                         "{0} not used in {1!r}".format(index, plan))
+
+    def test_published_tree(self):
+        self.assertUsesIndex(MenuItem.get_tree(None).filter(
+            site=self.site, is_published=True, depth__lte=2),
+            'site', 'is_published', 'path')
+
+    def test_published_subtree(self):
+        depth = self.parent.get_depth()
+        self.assertUsesIndex(
+            MenuItem.get_tree(self.parent).select_related('site').filter(
+                site=self.site, is_published=True, depth__gte=depth,
+                depth__lte=depth + 2),
+            'site', 'is_published', 'path')
+
+    def test_subtree_range(self):
+        self.assertUsesIndex(MenuItem.objects.filter(
+            site=self.site, is_published=True,
+            path__range=MenuItem.get_subtree_range(self.parent.path)),
+            'site', 'is_published', 'path')
+
+    def test_menu_slug(self):
+        self.assertUsesIndex(MenuItem.objects.filter(
+            site=self.site, menu_slug='default'), 'site', 'menu_slug')
+
+    def test_original_object(self):
+        content_type = ContentType.objects.get_for_model(Site)
+        self.assertUsesIndex(MenuItem.objects.filter(
+            _original_content_type=content_type, _original_content_id='1'),
+            '_original_content_type', '_original_content_id')
@@ -4,8 +4,12 @@ try:
 except ImportError:  # pragma: no cover
     from unittest import TestCase
 from django.test import TestCase as TestCaseWithDB
+from django.test.client import RequestFactory
+from django.contrib.sites.models import Site
+from django.utils.http import http_date
 from menuhin.models import MenuItem
-from menuhin.sitemaps import MenuItemSitemap
+from menuhin.sitemaps import (MenuItemSitemap, StreamingMenuItemSitemap,
+                              sitemap)
 from .data import get_bulk_data
 
 
@@ -48,3 +52,58 @@ class SitemapTestCase(TestCaseWithDB):
             self.assertGreater(
                 x, datetime.now() - timedelta(minutes=3600))
             self.assertLess(x, datetime.now())
+
+
+class StreamingSitemapTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+
+    def test_same_as_annotated(self):
+        annotated = MenuItemSitemap()
+        streaming = StreamingMenuItemSitemap()
+        items = annotated.items()
+        rows = list(streaming.items())
+        self.assertEqual([streaming.location(x) for x in rows],
+                         [x.get_absolute_url() for x in items])
+        self.assertEqual([streaming.priority(x) for x in rows],
+                         [annotated.priority(x) for x in items])
+        self.assertEqual([streaming.changefreq(x) for x in rows],
+                         [annotated.changefreq(x) for x in items])
+        self.assertEqual([streaming.lastmod(x) for x in rows],
+                         [annotated.lastmod(x) for x in items])
+
+    def test_pages(self):
+        streaming = StreamingMenuItemSitemap()
+        streaming.limit = 4
+        # 1 to count, 1 for the page.
+        with self.assertNumQueries(2):
+            self.assertEqual(len(streaming.paginator.page(3).object_list), 2)
+        self.assertEqual(streaming.paginator.num_pages, 3)
+
+    def test_pages_follow_changes(self):
+        streaming = StreamingMenuItemSitemap()
+        streaming.limit = 4
+        self.assertEqual(streaming.paginator.num_pages, 3)
+        for index in range(3):
+            MenuItem.add_root(uri='/new/{0}/'.format(index), title='new',
+                              site=Site.objects.get_current(),
+                              is_published=True)
+        self.assertEqual(streaming.paginator.num_pages, 4)
+
+    def test_page_last_modified(self):
+        streaming = StreamingMenuItemSitemap()
+        streaming.limit = 4
+        MenuItem.objects.all().update(
+            modified=datetime.now() - timedelta(days=5))
+        latest = datetime.now() - timedelta(days=1)
+        MenuItem.objects.filter(title='41').update(modified=latest)
+        self.assertEqual(streaming.get_page_last_modified(3), latest)
+        self.assertLess(streaming.get_page_last_modified(1), latest)
+
+    def test_not_modified(self):
+        MenuItem.objects.all().update(
+            modified=datetime.now() - timedelta(days=5))
+        request = RequestFactory().get('/', HTTP_IF_MODIFIED_SINCE=http_date())
+        response = sitemap(request,
+                           sitemaps={'menus': StreamingMenuItemSitemap})
+        self.assertEqual(response.status_code, 304)
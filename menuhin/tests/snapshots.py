@@ -0,0 +1,189 @@
+import threading
+import time
+from unittest import TestCase
+from django.core.cache import cache
+from django.test import TestCase as TestCaseWithDB
+from django.contrib.sites.models import Site
+from menuhin.models import MenuItem
+from menuhin.snapshots import MenuSnapshots
+from menuhin.versions import publish_pending, discard_pending
+from .data import get_bulk_data
+
+
+class MenuSnapshotsTestCase(TestCaseWithDB):
+    def setUp(self):
+        discard_pending()
+        cache.clear()
+        MenuItem.load_bulk(get_bulk_data())
+        self.site = Site.objects.get_current()
+        self.snapshots = MenuSnapshots(refresh='inline')
+
+    def titles(self, tree):
+        return [node.title for node, info in tree]
+
+    def test_matches_published_annotated_list(self):
+        root = MenuItem.objects.get(title='2')
+        expected = MenuItem.get_published_annotated_list(parent=root,
+                                                         site=self.site)
+        tree = self.snapshots.get(MenuItem, site=self.site, parent=root)
+        self.assertEqual(self.titles(tree), self.titles(expected))
+        self.assertEqual([info for node, info in tree],
+                         [info for node, info in expected])
+
+    def test_built_once(self):
+        self.snapshots.get(MenuItem, site=self.site)
+        with self.assertNumQueries(0):
+            tree = self.snapshots.get(MenuItem, site=self.site)
+        self.assertEqual(len(tree), 10)
+
+    def test_copies(self):
+        first = self.snapshots.get(MenuItem, site=self.site)
+        first[0][0].is_active = True
+        second = self.snapshots.get(MenuItem, site=self.site)
+        self.assertFalse(second[0][0].is_active)
+
+    def test_changes_invalidate(self):
+        self.snapshots.get(MenuItem, site=self.site, to_depth=1)
+        node = MenuItem.objects.get(title='3')
+        node.is_published = False
+        node.save()
+        # as at the end of the request.
+        publish_pending()
+        tree = self.snapshots.get(MenuItem, site=self.site, to_depth=1)
+        self.assertEqual(self.titles(tree), ['1', '2', '4'])
+
+    def test_other_sites_kept(self):
+        self.snapshots.get(MenuItem, site=self.site)
+        self.snapshots.invalidate((self.site.pk + 1,))
+        with self.assertNumQueries(0):
+            self.snapshots.get(MenuItem, site=self.site)
+
+
+class FakeSnapshots(MenuSnapshots):
+    """
+    Builds from `trees` rather than the database; a build raises whatever
+    exception is next instead, if any.
+    """
+    def __init__(self, **kwargs):
+        self.builds = 0
+        self.trees = []
+        self.errors = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        super(FakeSnapshots, self).__init__(**kwargs)
+
+    def build(self, **kwargs):
+        self.builds += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.trees.pop(0)
+
+
+class StaleWhileRevalidateTestCase(TestCase):
+    key = (1, None, None, None)
+
+    def snapshots(self, **kwargs):
+        kwargs.setdefault('refresh', 'inline')
+        kwargs.setdefault('retry', 0)
+        snapshots = FakeSnapshots(**kwargs)
+        snapshots.trees.extend([('old',), ('new',)])
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+        snapshots.invalidate((1,))
+        return snapshots
+
+    def test_fresh_not_rebuilt(self):
+        snapshots = FakeSnapshots()
+        snapshots.trees.append(('old',))
+        snapshots.get_tree(self.key, {})
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+        self.assertEqual(snapshots.builds, 1)
+
+    def test_other_sites_stay_fresh(self):
+        snapshots = FakeSnapshots()
+        snapshots.trees.append(('old',))
+        snapshots.get_tree(self.key, {})
+        snapshots.invalidate((2,))
+        self.assertIsNone(snapshots.snapshots[self.key].stale_since)
+
+    def test_inline_refresh_in_grace(self):
+        snapshots = self.snapshots(grace=30)
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('new',))
+        self.assertIsNone(snapshots.snapshots[self.key].stale_since)
+
+    def test_stale_served_while_rebuilding(self):
+        snapshots = self.snapshots(grace=30)
+        snapshots.release.clear()
+        snapshots.started.clear()
+        leader = threading.Thread(target=snapshots.get_tree,
+                                  args=(self.key, {}))
+        leader.start()
+        snapshots.started.wait(5)
+        try:
+            self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+        finally:
+            snapshots.release.set()
+            leader.join()
+        self.assertEqual(snapshots.builds, 2)
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('new',))
+
+    def test_background_refresh(self):
+        snapshots = self.snapshots(grace=30, refresh='thread')
+        snapshots.rebuild_in_thread = snapshots.rebuild
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+        for x in range(50):
+            if not snapshots.flights:
+                break
+            time.sleep(0.1)
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('new',))
+        self.assertEqual(snapshots.builds, 2)
+
+    def test_single_flight_after_grace(self):
+        snapshots = self.snapshots(grace=0)
+        snapshots.release.clear()
+        results = []
+
+        def get():
+            results.append(snapshots.get_tree(self.key, {}))
+        threads = [threading.Thread(target=get) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        snapshots.started.wait(5)
+        # give the others time to find the rebuild in progress.
+        time.sleep(0.2)
+        snapshots.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(snapshots.builds, 2)
+        self.assertEqual(results, [('new',)] * 5)
+
+    def test_changed_during_build_is_stale(self):
+        snapshots = self.snapshots(grace=30)
+        snapshots.build = lambda **kw: snapshots.invalidate((1,)) or ('new',)
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('new',))
+        self.assertIsNotNone(snapshots.snapshots[self.key].stale_since)
+
+    def test_failure_serves_last_good(self):
+        snapshots = self.snapshots(grace=0)
+        snapshots.errors.append(ValueError('database went away'))
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('new',))
+
+    def test_failure_in_grace_serves_last_good(self):
+        snapshots = self.snapshots(grace=30)
+        snapshots.errors.append(ValueError('database went away'))
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+
+    def test_failure_not_retried_straight_away(self):
+        snapshots = self.snapshots(grace=0, retry=60)
+        snapshots.errors.append(ValueError('database went away'))
+        snapshots.get_tree(self.key, {})
+        self.assertEqual(snapshots.get_tree(self.key, {}), ('old',))
+        self.assertEqual(snapshots.builds, 2)
+
+    def test_failure_without_snapshot(self):
+        snapshots = FakeSnapshots()
+        snapshots.errors.append(ValueError('database went away'))
+        self.assertEqual(snapshots.get_tree(self.key, {}), ())
@@ -0,0 +1,51 @@
+try:
+    from django.utils.unittest import skipIf
+except ImportError:  # pragma: no cover
+    from unittest import skipIf
+from django.test import TestCase as TestCaseWithDB
+from django.test.utils import override_settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from menuhin.models import MenuItem
+try:
+    from celery import current_app
+    from menuhin.tasks import update_urls_for_all_sites, finish_site_update
+except ImportError:  # pragma: no cover
+    current_app = None
+
+
+@skipIf(current_app is None, "celery is not installed")
+@override_settings(MENUHIN_MENU_HANDLERS=('menuhin.tests.data.TestMenu1',))
+class UpdateUrlsForAllSitesTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.previous = (current_app.conf.CELERY_ALWAYS_EAGER,
+                         current_app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS)
+        current_app.conf.CELERY_ALWAYS_EAGER = True
+        current_app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+        for name in ('a', 'b', 'c'):
+            User.objects.create(username=name)
+        othersite = Site(domain='x.com', name='y.com')
+        othersite.full_clean()
+        othersite.save()
+
+    def tearDown(self):
+        (current_app.conf.CELERY_ALWAYS_EAGER,
+         current_app.conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS) = self.previous
+
+    def test_fan_out(self):
+        result = update_urls_for_all_sites.delay(chunk_size=2).get()
+        self.assertEqual(result, {'sites': 2, 'chunks': 2})
+        for site in Site.objects.all():
+            self.assertEqual(MenuItem.objects.filter(site=site).count(), 3)
+
+    def test_running_again_adds_nothing(self):
+        update_urls_for_all_sites.delay(chunk_size=2).get()
+        update_urls_for_all_sites.delay(chunk_size=2).get()
+        self.assertEqual(MenuItem.objects.count(), 6)
+
+    def test_totals(self):
+        results = [{'inserted': 2, 'retitled': 1, 'unpublished': 0},
+                   {'inserted': 1, 'retitled': 0, 'unpublished': 0}]
+        totals = finish_site_update.delay(results, site_pk=1).get()
+        self.assertEqual(totals, {'site': 1, 'chunks': 2, 'inserted': 3,
+                                  'retitled': 1, 'unpublished': 0})
@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from django.core.cache import cache
+from django.test import TestCase as TestCaseWithDB
+from django.contrib.sites.models import Site
+from menuhin import treefiles
+from menuhin.models import MenuItem
+from menuhin.codec import encode_tree, CodecError
+from menuhin.versions import discard_pending
+from menuhin.treefiles import (MappedTree, get_mapped_tree, write_tree_file,
+                               get_published_annotated_list)
+from .data import get_bulk_data
+
+
+ROWS = (
+    (1, 1, 2, True, '0001', '/', 'Home', 'default'),
+    (2, 2, 0, True, '00010001', '/a/', u'\xc4', None),
+    (3, 2, 1, True, '00010002', '/b/', 'B', None),
+    (4, 3, 0, True, '000100020001', '/b/c/', 'C', None),
+    (5, 1, 0, True, '0002', '/x/', 'X', 'x'),
+)
+
+
+class MappedTreeFileTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tree.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def mapped(self, rows=ROWS, **kwargs):
+        kwargs.setdefault('site_id', 1)
+        with open(self.path, 'wb') as handle:
+            handle.write(encode_tree(rows, **kwargs))
+        return MappedTree(self.path)
+
+    def test_roundtrip(self):
+        tree = self.mapped(version=3)
+        self.assertEqual(len(tree), 5)
+        self.assertEqual(tree.version, 3)
+        self.assertEqual([tuple(x) for x in tree], list(ROWS))
+        self.assertEqual(tree[-1].menu_slug, 'x')
+
+    def test_empty(self):
+        self.assertEqual(list(self.mapped(rows=())), [])
+
+    def test_index(self):
+        tree = self.mapped()
+        self.assertEqual(tree.index('0002'), 4)
+        self.assertRaises(KeyError, tree.index, '0003')
+
+    def test_subtree_range(self):
+        tree = self.mapped()
+        self.assertEqual(tree.subtree_range('0001'), (0, 4))
+        self.assertEqual(tree.subtree_range('00010002'), (2, 4))
+        self.assertEqual(tree.subtree_range('0002'), (4, 5))
+
+    def test_truncated(self):
+        data = encode_tree(ROWS, site_id=1)
+        with open(self.path, 'wb') as handle:
+            handle.write(data[:-1])
+        self.assertRaises(CodecError, MappedTree, self.path)
+
+    def test_compressed(self):
+        data = encode_tree(ROWS, site_id=1, compress=True)
+        with open(self.path, 'wb') as handle:
+            handle.write(data)
+        self.assertRaises(CodecError, MappedTree, self.path)
+
+
+class MappedTreeTestCase(TestCaseWithDB):
+    def setUp(self):
+        cache.clear()
+        MenuItem.load_bulk(get_bulk_data())
+        # as though loaded in an earlier, committed, transaction.
+        discard_pending()
+        self.site = Site.objects.get_current()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        discard_pending()
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        self.assertIsNone(get_mapped_tree(self.site.pk))
+
+    def inline(self):
+        return self.settings(MENUHIN_TREE_FILES_DIR=self.directory,
+                             MENUHIN_TREE_FILES_WRITE='inline')
+
+    def test_written_in_background(self):
+        requested = []
+        original = treefiles.write_in_background
+        treefiles.write_in_background = requested.append
+        try:
+            with self.settings(MENUHIN_TREE_FILES_DIR=self.directory):
+                self.assertIsNone(get_mapped_tree(self.site.pk))
+        finally:
+            treefiles.write_in_background = original
+        self.assertEqual(requested, [self.site.pk])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_written_when_missing(self):
+        with self.inline():
+            tree = get_mapped_tree(self.site.pk)
+            self.assertIs(get_mapped_tree(self.site.pk), tree)
+        published = MenuItem.objects.filter(site=self.site, is_published=True)
+        self.assertEqual([x.pk for x in tree],
+                         [x.pk for x in published.order_by('path')])
+
+    def test_rewritten_when_changed(self):
+        with self.inline():
+            before = len(get_mapped_tree(self.site.pk))
+            MenuItem.objects.filter(title='3').update(is_published=False)
+            self.assertEqual(len(get_mapped_tree(self.site.pk)), before - 1)
+
+    def test_unreadable_rewritten(self):
+        with self.inline():
+            path = write_tree_file(self.site.pk)
+            with open(path, 'wb') as handle:
+                handle.write(b'x' * 100)
+            self.assertTrue(len(get_mapped_tree(self.site.pk)) > 0)
+
+    def test_atomic_rename(self):
+        path = write_tree_file(self.site.pk, directory=self.directory)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(path)])
+
+    def test_matches_published_annotated_list(self):
+        root = MenuItem.objects.get(title='2')
+        expected = MenuItem.get_published_annotated_list(
+            parent=root, site=self.site, to_depth=1)
+        tree = MappedTree(write_tree_file(self.site.pk,
+                                          directory=self.directory))
+        annotated = list(tree.iter_annotated(parent_path=root.path,
+                                             to_depth=1))
+        self.assertEqual([(x.pk, info) for x, info in annotated],
+                         [(x.pk, info) for x, info in expected])
+
+    def test_menu_source(self):
+        root = MenuItem.objects.get(title='2')
+        expected = MenuItem.get_published_annotated_list(
+            parent=root, site=self.site, from_depth=0, to_depth=1)
+        with self.inline():
+            get_mapped_tree(self.site.pk)
+            with self.assertNumQueries(0):
+                annotated = get_published_annotated_list(
+                    MenuItem, site=self.site, parent=root, from_depth=0,
+                    to_depth=1)
+        self.assertEqual([(x.pk, x.uri, x.title, info)
+                          for x, info in annotated],
+                         [(x.pk, x.uri, x.title, info)
+                          for x, info in expected])
+        self.assertIsInstance(annotated[0][0], MenuItem)
+        self.assertEqual(annotated[0][0].site, self.site)
+
+    def test_menu_source_unpublished_parent(self):
+        root = MenuItem.objects.get(title='2')
+        MenuItem.objects.filter(pk=root.pk).update(is_published=False)
+        root = MenuItem.objects.get(pk=root.pk)
+        expected = MenuItem.get_published_annotated_list(parent=root,
+                                                         site=self.site)
+        with self.inline():
+            annotated = get_published_annotated_list(MenuItem, site=self.site,
+                                                     parent=root)
+        self.assertEqual([x.pk for x, info in annotated],
+                         [x.pk for x, info in expected])
@@ -1,17 +1,34 @@
+from datetime import timedelta
 try:
     from django.utils.unittest import TestCase
 except ImportError:
     from unittest import TestCase
 from django.test import TestCase as TestCaseWithDB
 from django.test.utils import override_settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test.client import RequestFactory
+from django.utils.http import http_date
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from menuhin.models import MenuItem, URI
+from menuhin.models import (MenuItem, URI, ModelURI, ModelMenuItemGroup,
+                            SyncWatermark)
+from menuhin.versions import bump_tree_versions
 from menuhin.utils import (ensure_default_for_site, DefaultForSite,
                            get_menuitem_or_none, set_menu_slug,
                            RequestRelations, find_missing, add_urls,
                            get_relations_for_request, change_published_status,
-                           marked_annotated_list, MenuItemURI, update_all_urls)
+                           toggle_published, set_subtree_published,
+                           publish_subtree,
+                           marked_annotated_list, MenuItemURI, update_all_urls,
+                           diff_urls, apply_diff, sync_urls, SyncDiff,
+                           SyncResult, normalize_uri, chunked, CollectedMenu,
+                           collect_urls, record_watermarks, sync_handlers,
+                           uri_to_row, row_to_uri, unique_rows,
+                           MenuRegistry, menu_registry, _collect_menus,
+                           get_validators, search_menu_items, depth_label,
+                           RequestCache, request_cache, get_current_site,
+                           ensure_default_exists, forget_sites,
+                           _sites_by_domain)
 from .data import get_bulk_data
 
 
@@ -22,8 +39,8 @@ class EnsureDefaultTestCase(TestCaseWithDB):
     @override_settings(SITE_ID=1)
     def test_creation(self):
         # 1 query for site, 1 to look the MenuItem up, 2 to insert it
-        # if needs be.
-        with self.assertNumQueries(4):
+        # if needs be, and 3 to start the site's tree version.
+        with self.assertNumQueries(7):
             default = ensure_default_for_site(MenuItem)
         self.assertIsInstance(default, DefaultForSite)
         self.assertTrue(default.created)
@@ -194,6 +211,390 @@ class UpdateAllUrlsTestCase(TestCaseWithDB):
         self.assertIsNone(result)
 
 
+class ChunkedTestCase(TestCase):
+    def test_usage(self):
+        self.assertEqual(list(chunked(range(5), 2)), [(0, 1), (2, 3), (4,)])
+
+    def test_empty(self):
+        self.assertEqual(list(chunked((), 2)), [])
+
+
+class NormalizeUriTestCase(TestCase):
+    def test_usage(self):
+        self.assertEqual(normalize_uri(' /A/b/ '), '/a/b/')
+
+
+class SyncDataMixin(object):
+    def setUp(self):
+        site = Site.objects.get_current()
+        MenuItem.add_root(uri='/same/', title='same', site=site)
+        MenuItem.add_root(uri='/Renamed/', title='old', site=site)
+        content_type = ContentType.objects.get_for_model(Site)
+        MenuItem.add_root(uri='/gone/', title='gone', site=site,
+                          is_published=True,
+                          _original_content_type=content_type,
+                          _original_content_id=site.pk)
+        MenuItem.add_root(uri='/manual/', title='manual', site=site,
+                          is_published=True)
+        ensure_default_for_site(MenuItem)
+
+    def get_urls(self):
+        yield URI(title='same', path='/same/')
+        yield URI(title='new', path='/renamed/')
+        yield URI(title='added', path='/added/')
+        yield URI(title='added again', path='/added/')
+
+
+class DiffUrlsTestCase(SyncDataMixin, TestCaseWithDB):
+    def test_classification(self):
+        diff = diff_urls(MenuItem, urls=self.get_urls())
+        self.assertIsInstance(diff, SyncDiff)
+        self.assertEqual(diff.counts(), {'added': 1, 'retitled': 1,
+                                         'unchanged': 1, 'orphaned': 1})
+        self.assertEqual(diff.added[0].title, 'added')
+        self.assertEqual(diff.retitled[0].uri, '/Renamed/')
+        self.assertEqual(diff.retitled[0].title, 'new')
+        self.assertEqual(diff.retitled[0].old_title, 'old')
+        self.assertEqual(diff.orphaned[0].uri, '/gone/')
+        self.assertTrue(diff.has_changes())
+
+    def test_manual_items_not_orphaned(self):
+        diff = diff_urls(MenuItem, urls=self.get_urls())
+        self.assertNotIn('/manual/', [x.uri for x in diff.orphaned])
+        self.assertNotIn('/manual/', [x.uri for x in diff.unchanged])
+
+    def test_partial_has_no_orphans(self):
+        with self.assertNumQueries(1):
+            diff = diff_urls(MenuItem, urls=self.get_urls(), partial=True)
+        self.assertEqual(diff.counts(), {'added': 1, 'retitled': 1,
+                                         'unchanged': 1, 'orphaned': 0})
+
+    def test_other_site(self):
+        othersite = Site(domain='x.com', name='y.com')
+        othersite.full_clean()
+        othersite.save()
+        diff = diff_urls(MenuItem, urls=self.get_urls(), site_id=othersite)
+        self.assertEqual(len(diff.added), 3)
+        self.assertFalse(diff.orphaned)
+
+    def test_report(self):
+        report = diff_urls(MenuItem, urls=self.get_urls()).as_dict()
+        self.assertEqual(report['counts']['added'], 1)
+        self.assertEqual(report['added'], [{'uri': '/added/',
+                                            'title': 'added'}])
+        self.assertEqual(report['orphaned'][0]['uri'], '/gone/')
+
+
+class ApplyDiffTestCase(SyncDataMixin, TestCaseWithDB):
+    def test_apply(self):
+        diff = diff_urls(MenuItem, urls=self.get_urls())
+        result = apply_diff(MenuItem, diff=diff, update_titles=True)
+        self.assertIsInstance(result, SyncResult)
+        self.assertEqual(result.counts(), {'inserted': 1, 'retitled': 1,
+                                           'unpublished': 0})
+        self.assertEqual(MenuItem.objects.get(uri='/Renamed/').title, 'new')
+        self.assertTrue(MenuItem.objects.get(uri='/gone/').is_published)
+
+    def test_apply_unpublishing(self):
+        result = sync_urls(MenuItem, urls=self.get_urls(), unpublish=True,
+                           chunk_size=1)
+        self.assertEqual(result.unpublished, 1)
+        self.assertFalse(MenuItem.objects.get(uri='/gone/').is_published)
+        self.assertTrue(MenuItem.objects.get(uri='/manual/').is_published)
+        self.assertTrue(MenuItem.objects.filter(uri='/added/').exists())
+        again = diff_urls(MenuItem, urls=self.get_urls())
+        self.assertEqual(again.counts()['unchanged'], 3)
+
+    def test_titles_kept_by_default(self):
+        sync_urls(MenuItem, urls=self.get_urls())
+        self.assertEqual(MenuItem.objects.get(uri='/Renamed/').title, 'old')
+
+
+class MenuRegistryTestCase(TestCase):
+    @override_settings(MENUHIN_MENU_HANDLERS=(
+        'menuhin.tests.data.TestMenu1',))
+    def test_instances_are_shared(self):
+        first = tuple(_collect_menus())
+        second = tuple(_collect_menus())
+        self.assertEqual(len(first), 1)
+        self.assertIs(first[0].instance, second[0].instance)
+        self.assertIs(menu_registry.get('menuhin.tests.data.TestMenu1'),
+                      first[0])
+
+    def test_setting_changes_reload(self):
+        with override_settings(MENUHIN_MENU_HANDLERS=(
+                'menuhin.tests.data.TestMenu1',)):
+            self.assertEqual(len(menu_registry), 1)
+        with override_settings(MENUHIN_MENU_HANDLERS=(
+                'menuhin.tests.data.TestMenu1',
+                'menuhin.tests.data.TestMenu2')):
+            self.assertEqual(len(menu_registry), 2)
+
+    def test_missing(self):
+        with override_settings(MENUHIN_MENU_HANDLERS=()):
+            with self.assertRaises(KeyError):
+                menu_registry.get('menuhin.tests.data.TestMenu1')
+
+    def test_validates_eagerly(self):
+        registry = MenuRegistry()
+        with override_settings(MENUHIN_MENU_HANDLERS=(
+                'menuhin.tests.data.NotAMenu',)):
+            with self.assertRaises(ImproperlyConfigured):
+                registry.populate()
+
+
+class RowsTestCase(TestCase):
+    def test_uri_round_trip(self):
+        uri = URI(path='/a/', title='a')
+        row = uri_to_row(uri)
+        self.assertEqual(row, ('/a/', 'a', None, None))
+        self.assertEqual(row_to_uri(row), uri)
+
+    def test_model_uri_round_trip(self):
+        uri = ModelURI(path='/a/', title='a', content_type_id=1,
+                       object_pk=2)
+        row = uri_to_row(uri)
+        self.assertEqual(row, ('/a/', 'a', 1, '2'))
+        self.assertEqual(row_to_uri(row).object_pk, '2')
+        self.assertIsInstance(row_to_uri(row), ModelURI)
+
+    def test_unique_rows(self):
+        urls = (URI(path='/A/', title='a'), URI(path='/a/', title='b'),
+                URI(path='/b/', title='b'))
+        self.assertEqual([x[0] for x in unique_rows(urls)], ['/A/', '/b/'])
+
+
+class IncrementalMenuItems(ModelMenuItemGroup):
+    model = MenuItem
+    updated_field = 'modified'
+
+
+class CollectUrlsTestCase(TestCaseWithDB):
+    def setUp(self):
+        site = Site.objects.get_current()
+        MenuItem.add_root(uri='/one/', title='one', site=site)
+        MenuItem.add_root(uri='/two/', title='two', site=site)
+        self.menus = (CollectedMenu(path='menuhin.tests.IncrementalMenuItems',
+                                    instance=IncrementalMenuItems(),
+                                    name='incremental'),)
+        self.othersite = Site(domain='x.com', name='y.com')
+        self.othersite.full_clean()
+        self.othersite.save()
+
+    def test_first_run_is_full(self):
+        collected = collect_urls(self.menus, site_id=self.othersite.pk)
+        self.assertFalse(collected.partial)
+        self.assertEqual(len(collected.urls), 2)
+        self.assertEqual(collected.watermarked,
+                         ('menuhin.tests.IncrementalMenuItems',))
+
+    def test_incremental(self):
+        collected = collect_urls(self.menus, site_id=self.othersite.pk)
+        record_watermarks(collected, site_id=self.othersite.pk)
+        self.assertEqual(
+            SyncWatermark.get_for(handler='menuhin.tests.IncrementalMenuItems',
+                                  site_id=self.othersite.pk),
+            collected.started)
+        MenuItem.objects.filter(uri='/one/').update(
+            modified=collected.started + timedelta(seconds=1))
+        MenuItem.objects.filter(uri='/two/').update(
+            modified=collected.started - timedelta(days=1))
+
+        changed = collect_urls(self.menus, site_id=self.othersite.pk)
+        self.assertTrue(changed.partial)
+        self.assertEqual([x.path for x in changed.urls], ['/one/'])
+
+        everything = collect_urls(self.menus, site_id=self.othersite.pk,
+                                  full=True)
+        self.assertFalse(everything.partial)
+        self.assertEqual(len(everything.urls), 2)
+
+    def test_sync_handlers(self):
+        result = sync_handlers(MenuItem, menus=self.menus,
+                               site_id=self.othersite.pk)
+        self.assertEqual(result.counts()['inserted'], 2)
+        self.assertIsNotNone(SyncWatermark.get_for(
+            handler='menuhin.tests.IncrementalMenuItems',
+            site_id=self.othersite.pk))
+
+
+class GetValidatorsTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.site = Site.objects.get_current()
+        self.obj = MenuItem.add_root(uri='/a/', title='a', site=self.site)
+
+    def test_changes(self):
+        with self.assertNumQueries(1):
+            before = get_validators(MenuItem.objects.all())
+        self.assertEqual(before.count, 1)
+        self.assertEqual(before, get_validators(MenuItem.objects.all()))
+        self.assertNotEqual(before.etag, get_validators(
+            MenuItem.objects.all(), extra=('x',)).etag)
+        MenuItem.add_root(uri='/b/', title='b', site=self.site)
+        after = get_validators(MenuItem.objects.all())
+        self.assertNotEqual(before.etag, after.etag)
+        self.assertEqual(after.count, 2)
+
+    def test_tree_versions(self):
+        before = get_validators(MenuItem.objects.all(),
+                                site_ids=(self.site.pk,))
+        self.assertNotEqual(before.etag,
+                            get_validators(MenuItem.objects.all()).etag)
+        bump_tree_versions((self.site.pk,))
+        after = get_validators(MenuItem.objects.all(),
+                               site_ids=(self.site.pk,))
+        self.assertNotEqual(before.etag, after.etag)
+        self.assertEqual(before.last_modified, after.last_modified)
+
+    def test_move_updates_modified(self):
+        child = self.obj.add_child(uri='/a/b/', title='b', site=self.site)
+        other = MenuItem.add_root(uri='/c/', title='c', site=self.site)
+        unmoved = MenuItem.add_root(uri='/d/', title='d', site=self.site)
+        yesterday = self.obj.modified - timedelta(days=1)
+        MenuItem.objects.update(modified=yesterday)
+        MenuItem.objects.get(pk=child.pk).move(other, pos='last-child')
+        touched = (MenuItem.objects.filter(modified__gt=yesterday)
+                   .values_list('title', flat=True))
+        self.assertEqual(sorted(touched), ['a', 'b', 'c'])
+        self.assertEqual(MenuItem.objects.get(pk=unmoved.pk).modified,
+                         yesterday)
+
+    def test_empty(self):
+        validators = get_validators(MenuItem.objects.none())
+        self.assertEqual(validators.count, 0)
+        self.assertIsNone(validators.last_modified)
+
+    def test_not_modified(self):
+        validators = get_validators(MenuItem.objects.all())
+        rf = RequestFactory()
+        self.assertFalse(validators.not_modified(rf.get('/')))
+        self.assertTrue(validators.not_modified(rf.get(
+            '/', HTTP_IF_NONE_MATCH='"{0}"'.format(validators.etag))))
+        self.assertFalse(validators.not_modified(rf.get(
+            '/', HTTP_IF_NONE_MATCH='"nope"')))
+        self.assertTrue(validators.not_modified(rf.get(
+            '/', HTTP_IF_MODIFIED_SINCE=http_date(validators.last_modified))))
+        self.assertFalse(validators.not_modified(rf.get(
+            '/', HTTP_IF_MODIFIED_SINCE=http_date(
+                validators.last_modified - 1))))
+
+
+class SearchMenuItemsTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+
+    def test_title_or_uri(self):
+        found = search_menu_items(MenuItem, term='2')
+        self.assertEqual([x['title'] for x in found],
+                         ['2', '21', '22', '23', '231', '24'])
+        found = search_menu_items(MenuItem, term='/a/')
+        self.assertEqual([x['uri'] for x in found], ['/a/', '/a/b/c/'])
+        found = search_menu_items(MenuItem, term='HOT')
+        self.assertEqual([x['uri'] for x in found], ['/hotdog/'])
+
+    def test_published(self):
+        MenuItem.objects.filter(title='41').update(is_published=False)
+        self.assertEqual(len(search_menu_items(MenuItem, term='hot')), 0)
+        self.assertEqual(len(search_menu_items(MenuItem, term='hot',
+                                               published=False)), 1)
+
+    def test_depth_label(self):
+        self.assertEqual(depth_label('x', 3), '--- x')
+
+
+class RequestCacheTestCase(TestCase):
+    def test_outside_request(self):
+        cache = RequestCache()
+        self.assertEqual(cache.get_or_set('a', lambda: 1), 1)
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 2)
+
+    def test_within_request(self):
+        cache = RequestCache()
+        cache.start()
+        self.assertEqual(cache.get_or_set('a', lambda: 1), 1)
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 1)
+        cache.finish()
+        cache.start()
+        self.assertEqual(cache.get_or_set('a', lambda: 3), 3)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class GetCurrentSiteTestCase(TestCaseWithDB):
+    def setUp(self):
+        forget_sites(sender=None)
+        self.other = Site.objects.create(domain='other.example.com',
+                                         name='other')
+
+    def tearDown(self):
+        request_cache.finish()
+
+    def test_default(self):
+        request = RequestFactory().get('/', HTTP_HOST='other.example.com')
+        self.assertEqual(get_current_site(request),
+                         Site.objects.get_current())
+
+    @override_settings(MENUHIN_SITE_FROM_HOST=True)
+    def test_from_host(self):
+        request = RequestFactory().get('/', HTTP_HOST='Other.example.com:80')
+        self.assertEqual(get_current_site(request), self.other)
+
+    @override_settings(MENUHIN_SITE_FROM_HOST=True)
+    def test_unknown_host(self):
+        request = RequestFactory().get('/', HTTP_HOST='nope.example.com')
+        self.assertEqual(get_current_site(request),
+                         Site.objects.get_current())
+
+    @override_settings(MENUHIN_SITE_FROM_HOST=True)
+    def test_unknown_hosts_not_remembered(self):
+        Site.objects.get_current()
+        get_current_site(RequestFactory().get('/',
+                                              HTTP_HOST='other.example.com'))
+        with self.assertNumQueries(0):
+            for x in range(3):
+                request = RequestFactory().get(
+                    '/', HTTP_HOST='nope{0}.example.com'.format(x))
+                self.assertEqual(get_current_site(request),
+                                 Site.objects.get_current())
+        self.assertEqual(len(_sites_by_domain), Site.objects.count())
+
+    @override_settings(MENUHIN_SITE_FROM_HOST=True)
+    def test_remembered_for_request(self):
+        request = RequestFactory().get('/', HTTP_HOST='other.example.com')
+        request_cache.start()
+        get_current_site(request)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_site(request), self.other)
+            self.assertEqual(get_current_site(), self.other)
+        request_cache.finish()
+        self.assertEqual(get_current_site(), Site.objects.get_current())
+
+    @override_settings(MENUHIN_SITE_FROM_HOST=True)
+    def test_site_changes_forgotten(self):
+        request = RequestFactory().get('/', HTTP_HOST='new.example.com')
+        self.assertEqual(get_current_site(request),
+                         Site.objects.get_current())
+        self.other.domain = 'new.example.com'
+        self.other.save()
+        self.assertEqual(get_current_site(request), self.other)
+
+
+class EnsureDefaultExistsTestCase(TestCaseWithDB):
+    def setUp(self):
+        forget_sites(sender=None)
+
+    def test_only_queries_once(self):
+        self.assertTrue(ensure_default_exists(model=MenuItem))
+        with self.assertNumQueries(0):
+            self.assertFalse(ensure_default_exists(model=MenuItem))
+
+    def test_deleted_root_recreated(self):
+        ensure_default_exists(model=MenuItem)
+        MenuItem.objects.get(menu_slug='default').delete()
+        self.assertTrue(ensure_default_exists(model=MenuItem))
+        self.assertEqual(
+            MenuItem.objects.filter(menu_slug='default').count(), 1)
+
+
 class GetRelationsForRequestTestCase(TestCaseWithDB):
     def test_middleware_is_not_none(self):
         rf = RequestFactory()
@@ -235,12 +636,64 @@ class ChangePublishedStatusTestCase(TestCaseWithDB):
                           site=Site.objects.get_current())
         MenuItem.add_root(title='y', is_published=False,
                           site=Site.objects.get_current())
+        # the UPDATE, the SELECT of the sites it touches, and the UPDATE
+        # and re-read of their tree version.
         with self.assertNumQueries(4):
             change_published_status(queryset=MenuItem.objects.all(),
                                     modeladmin=None, request=None)
         self.assertFalse(MenuItem.objects.get(title='x').is_published)
         self.assertTrue(MenuItem.objects.get(title='y').is_published)
 
+    def test_filtered(self):
+        MenuItem.add_root(title='x', is_published=True,
+                          site=Site.objects.get_current())
+        MenuItem.add_root(title='y', is_published=False,
+                          site=Site.objects.get_current())
+        self.assertEqual(
+            toggle_published(MenuItem.objects.filter(title='y')), 1)
+        self.assertEqual(
+            sorted(MenuItem.objects.filter(is_published=True)
+                   .values_list('title', flat=True)), ['x', 'y'])
+
+
+class SetSubtreePublishedTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+
+    def published(self):
+        return sorted(MenuItem.objects.filter(is_published=True)
+                      .values_list('title', flat=True))
+
+    def test_unpublish(self):
+        selected = MenuItem.objects.filter(title__in=('23', '4'))
+        # the paths, an UPDATE (and its sites) per subtree, then one bump
+        # of the tree version.
+        with self.assertNumQueries(7):
+            updated = set_subtree_published(selected, published=False)
+        self.assertEqual(updated, 4)
+        self.assertEqual(self.published(),
+                         ['1', '2', '21', '22', '24', '3'])
+
+    def test_nested_selection(self):
+        selected = MenuItem.objects.filter(title__in=('2', '23', '231'))
+        with self.assertNumQueries(5):
+            updated = set_subtree_published(selected, published=False)
+        self.assertEqual(updated, 6)
+        self.assertEqual(self.published(), ['1', '3', '4', '41'])
+
+    def test_publish(self):
+        MenuItem.objects.update(is_published=False)
+        publish_subtree(modeladmin=None, request=None,
+                        queryset=MenuItem.objects.filter(title='4'))
+        self.assertEqual(self.published(), ['4', '41'])
+
+    def test_subtree_range(self):
+        node = MenuItem.objects.get(title='23')
+        paths = (MenuItem.objects.filter(
+            path__range=MenuItem.get_subtree_range(node.path))
+            .values_list('title', flat=True))
+        self.assertEqual(sorted(paths), ['23', '231'])
+
 
 class MarkedAnnotatedListTestCase(TestCaseWithDB):
     def setUp(self):
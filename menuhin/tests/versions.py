@@ -0,0 +1,173 @@
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import TestCase as TestCaseWithDB, TransactionTestCase
+from django.test.client import RequestFactory
+from django.contrib.sites.models import Site
+from menuhin.models import MenuItem, TreeVersion
+from menuhin.signals import tree_changed
+from menuhin.utils import atomic
+from menuhin.versions import (get_tree_version, bump_tree_versions,
+                              defer_version_bumps, tree_version_key_prefix,
+                              cache_page_for_menus, tree_version_cache_key,
+                              publish_pending, discard_pending)
+from .data import get_bulk_data
+
+
+class TreeVersionTestCase(TestCaseWithDB):
+    def setUp(self):
+        # anything left over from other tests, which never commit.
+        discard_pending()
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.othersite = Site.objects.create(domain='x.com', name='x')
+
+    def tearDown(self):
+        discard_pending()
+
+    def version(self):
+        return get_tree_version(self.site.pk)
+
+    def test_starts_at_zero(self):
+        self.assertEqual(self.version(), 0)
+
+    def test_save_and_delete(self):
+        node = MenuItem.add_root(uri='/a/', title='a', site=self.site)
+        self.assertEqual(self.version(), 1)
+        node.title = 'b'
+        node.save()
+        self.assertEqual(self.version(), 2)
+        node.delete()
+        self.assertEqual(self.version(), 3)
+        self.assertEqual(get_tree_version(self.othersite.pk), 0)
+
+    def test_bulk_update(self):
+        MenuItem.load_bulk(get_bulk_data())
+        version = self.version()
+        MenuItem.objects.filter(site=self.site).update(title='x')
+        self.assertEqual(self.version(), version + 1)
+
+    def test_bulk_update_of_nothing(self):
+        MenuItem.objects.filter(site=self.site).update(title='x')
+        self.assertEqual(self.version(), 0)
+
+    def test_bookkeeping_update(self):
+        MenuItem.load_bulk(get_bulk_data())
+        version = self.version()
+        MenuItem.objects.filter(site=self.site).update(numchild=0)
+        self.assertEqual(self.version(), version)
+
+    def test_load_bulk_bumps_once(self):
+        MenuItem.load_bulk(get_bulk_data())
+        self.assertEqual(self.version(), 1)
+
+    def test_move(self):
+        MenuItem.load_bulk(get_bulk_data())
+        version = self.version()
+        MenuItem.objects.get(title='23').move(
+            MenuItem.objects.get(title='4'), pos='last-child')
+        self.assertEqual(self.version(), version + 1)
+
+    def test_deferred(self):
+        with defer_version_bumps():
+            bump_tree_versions((self.site.pk,))
+            bump_tree_versions((self.site.pk, self.othersite.pk))
+            self.assertEqual(self.version(), 0)
+        self.assertEqual(self.version(), 1)
+        self.assertEqual(get_tree_version(self.othersite.pk), 1)
+
+    def test_database_fallback(self):
+        bump_tree_versions((self.site.pk,))
+        bump_tree_versions((self.site.pk,))
+        publish_pending()
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.version(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.version(), 2)
+        self.assertEqual(TreeVersion.objects.get(site=self.site).version, 2)
+
+    def test_published_after_transaction(self):
+        changed = []
+
+        def listener(sender, site_ids, **kwargs):
+            changed.append(site_ids)
+        tree_changed.connect(listener)
+        try:
+            with atomic():
+                bump_tree_versions((self.site.pk,))
+            # still inside the test's own transaction.
+            self.assertEqual(changed, [])
+            key = tree_version_cache_key(self.site.pk)
+            self.assertIsNone(cache.get(key))
+            # but this thread sees its own changes.
+            self.assertEqual(self.version(), 1)
+            self.assertIsNone(cache.get(key))
+            publish_pending()
+        finally:
+            tree_changed.disconnect(listener)
+        self.assertEqual(changed, [(self.site.pk,)])
+        self.assertEqual(cache.get(key), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.version(), 1)
+
+
+class PublishAfterAtomicTestCase(TransactionTestCase):
+    def setUp(self):
+        discard_pending()
+        cache.clear()
+        self.site = Site.objects.get_current()
+
+    def test_published_when_outermost_block_exits(self):
+        changed = []
+
+        def listener(sender, site_ids, **kwargs):
+            changed.append(site_ids)
+        tree_changed.connect(listener)
+        try:
+            with atomic():
+                with atomic():
+                    bump_tree_versions((self.site.pk,))
+                self.assertEqual(changed, [])
+            self.assertEqual(changed, [(self.site.pk,)])
+        finally:
+            tree_changed.disconnect(listener)
+        self.assertEqual(cache.get(tree_version_cache_key(self.site.pk)), 1)
+
+    def test_rolled_back(self):
+        try:
+            with atomic():
+                bump_tree_versions((self.site.pk,))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(cache.get(tree_version_cache_key(self.site.pk)), 0)
+        self.assertEqual(get_tree_version(self.site.pk), 0)
+
+
+class CachePageForMenusTestCase(TestCaseWithDB):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.get_current()
+        self.calls = []
+
+        @cache_page_for_menus(60)
+        def view(request):
+            self.calls.append(request)
+            return HttpResponse('ok')
+        self.view = view
+
+    def test_key_prefix(self):
+        request = RequestFactory().get('/')
+        before = tree_version_key_prefix(request, prefix='x.')
+        self.assertTrue(before.startswith('x.menuhin.'))
+        bump_tree_versions((self.site.pk,))
+        self.assertNotEqual(tree_version_key_prefix(request, prefix='x.'),
+                            before)
+
+    def test_cached_until_menus_change(self):
+        self.view(RequestFactory().get('/'))
+        self.view(RequestFactory().get('/'))
+        self.assertEqual(len(self.calls), 1)
+        MenuItem.add_root(uri='/a/', title='a', site=self.site)
+        self.view(RequestFactory().get('/'))
+        self.assertEqual(len(self.calls), 2)
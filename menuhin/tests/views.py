@@ -0,0 +1,126 @@
+from django.test import TestCase as TestCaseWithDB
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.http import Http404
+from django.utils.http import int_to_base36
+from menuhin.models import MenuItem
+from menuhin.shorturls import HitBuffer, hit_buffer
+from menuhin.signals import shorturl_hits, shorturl_redirect
+from menuhin.views import menu_shorturl_redirect
+
+
+class ShortUrlRedirectTestCase(TestCaseWithDB):
+    def setUp(self):
+        cache.clear()
+        hit_buffer.flush()
+        self.obj = MenuItem.add_root(uri='/a/', title='a',
+                                     site=Site.objects.get_current())
+        self.request = RequestFactory().get('/')
+
+    def tearDown(self):
+        hit_buffer.flush()
+
+    def redirect(self, pk):
+        return menu_shorturl_redirect(self.request,
+                                      b36_int=int_to_base36(pk))
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            response = self.redirect(self.obj.pk)
+        self.assertEqual(response['Location'], '/a/')
+        with self.assertNumQueries(0):
+            response = self.redirect(self.obj.pk)
+        self.assertEqual(response['Location'], '/a/')
+
+    def test_missing_is_cached(self):
+        with self.assertNumQueries(1):
+            self.assertRaises(Http404, self.redirect, self.obj.pk + 1)
+        with self.assertNumQueries(0):
+            self.assertRaises(Http404, self.redirect, self.obj.pk + 1)
+
+    def test_invalid(self):
+        with self.assertNumQueries(0):
+            self.assertRaises(Http404, menu_shorturl_redirect, self.request,
+                              b36_int='!!')
+
+    def test_forgotten_on_change(self):
+        self.redirect(self.obj.pk)
+        self.obj.uri = '/b/'
+        self.obj.save()
+        self.assertEqual(self.redirect(self.obj.pk)['Location'], '/b/')
+        self.obj.delete()
+        self.assertRaises(Http404, self.redirect, self.obj.pk)
+
+    def test_forgotten_on_bulk_update(self):
+        self.redirect(self.obj.pk)
+        MenuItem.objects.filter(pk=self.obj.pk).update(uri='/b/')
+        self.assertEqual(self.redirect(self.obj.pk)['Location'], '/b/')
+
+    def test_redirect_signal(self):
+        seen = []
+
+        def listener(sender, instance, user, **kwargs):
+            seen.append(instance)
+        shorturl_redirect.connect(listener)
+        try:
+            self.redirect(self.obj.pk)
+            with self.assertNumQueries(0):
+                self.redirect(self.obj.pk)
+        finally:
+            shorturl_redirect.disconnect(listener)
+        self.assertEqual(len(seen), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(seen[0].pk, self.obj.pk)
+
+    def test_hits_are_batched(self):
+        seen = []
+
+        def listener(sender, hits, **kwargs):
+            seen.append((sender, hits))
+        shorturl_hits.connect(listener)
+        try:
+            for x in range(3):
+                self.redirect(self.obj.pk)
+            self.assertEqual(seen, [])
+            self.assertEqual(hit_buffer.flush(), 3)
+        finally:
+            shorturl_hits.disconnect(listener)
+        self.assertEqual(seen, [(MenuItem, {self.obj.pk: 3})])
+
+
+class HitBufferTestCase(TestCaseWithDB):
+    @override_settings(MENUHIN_SHORTURL_HITS_BATCH=2)
+    def test_flushes_when_full(self):
+        seen = []
+
+        def listener(sender, hits, **kwargs):
+            seen.append(hits)
+        shorturl_hits.connect(listener)
+        buffer = HitBuffer()
+        try:
+            buffer.record(sender=MenuItem, pk=1)
+            self.assertEqual(seen, [])
+            buffer.record(sender=MenuItem, pk=1)
+        finally:
+            shorturl_hits.disconnect(listener)
+        self.assertEqual(seen, [{1: 2}])
+        self.assertIsNone(buffer.timer)
+
+    @override_settings(MENUHIN_SHORTURL_HITS_INTERVAL=0.01)
+    def test_flushes_after_interval(self):
+        seen = []
+
+        def listener(sender, hits, **kwargs):
+            seen.append(hits)
+        shorturl_hits.connect(listener)
+        buffer = HitBuffer()
+        try:
+            buffer.record(sender=MenuItem, pk=1)
+            timer = buffer.timer
+            timer.join(5)
+        finally:
+            shorturl_hits.disconnect(listener)
+        self.assertEqual(seen, [{1: 1}])
+        self.assertIsNone(buffer.timer)
@@ -0,0 +1,149 @@
+from collections import namedtuple
+try:
+    from django.utils.unittest import TestCase, skipIf
+except ImportError:  # pragma: no cover
+    from unittest import TestCase, skipIf
+from django.conf.urls import patterns, url, include
+from django.core.cache import cache
+from django.test import TestCase as TestCaseWithDB
+from menuhin.models import MenuItem
+from .data import get_bulk_data
+try:
+    from rest_framework.routers import DefaultRouter
+    from menuhin.views_drf import ReadOnlyMenuItemViewSet, nest_tree
+except ImportError:  # pragma: no cover
+    DefaultRouter = None
+
+urlpatterns = []
+if DefaultRouter is not None:
+    router = DefaultRouter()
+    router.register(r'menus', ReadOnlyMenuItemViewSet)
+    urlpatterns = patterns('', url(r'^api/', include(router.urls)))
+
+Node = namedtuple('Node', ('title', 'depth'))
+
+
+@skipIf(DefaultRouter is None, "djangorestframework is not installed")
+class NestTreeTestCase(TestCase):
+    def nest(self, *nodes):
+        nodes = [Node(title, depth) for title, depth in nodes]
+        return nest_tree(nodes, [{'title': x.title} for x in nodes])
+
+    def titles(self, items):
+        return [(x['title'], self.titles(x['children'])) for x in items]
+
+    def test_order(self):
+        top = self.nest(('a', 1), ('b', 2), ('c', 3), ('d', 2), ('e', 1),
+                        ('f', 2))
+        self.assertEqual(self.titles(top), [
+            ('a', [('b', [('c', [])]), ('d', [])]),
+            ('e', [('f', [])]),
+        ])
+
+    def test_relative_depths(self):
+        # a subtree, which needn't start at the top of the tree.
+        top = self.nest(('b', 2), ('c', 3), ('d', 4), ('e', 3))
+        self.assertEqual(self.titles(top),
+                         [('b', [('c', [('d', [])]), ('e', [])])])
+
+    def test_empty(self):
+        self.assertEqual(nest_tree([], []), [])
+
+
+@skipIf(DefaultRouter is None, "djangorestframework is not installed")
+class MenuItemViewSetTestCase(TestCaseWithDB):
+    urls = 'menuhin.tests.views_drf'
+
+    def setUp(self):
+        cache.clear()
+        MenuItem.load_bulk(get_bulk_data())
+
+    def get(self, url, **kwargs):
+        return self.client.get(url, HTTP_ACCEPT='application/json', **kwargs)
+
+    def titles(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [x['title'] for x in response.data['results']]
+
+    def test_cursor_pagination(self):
+        response = self.get('/api/menus/?page=3')
+        self.assertEqual(self.titles(response), ['1', '2', '21'])
+        seen = self.titles(response)
+        while response.data['next'] is not None:
+            response = self.get(response.data['next'])
+            seen.extend(self.titles(response))
+        self.assertEqual(seen, list(MenuItem.objects.order_by('path')
+                                    .values_list('title', flat=True)))
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.get('/api/menus/?cursor=!').status_code, 400)
+
+    def test_depth_filters(self):
+        self.assertEqual(self.titles(self.get('/api/menus/?max_depth=1')),
+                         ['1', '2', '3', '4'])
+        self.assertEqual(self.titles(self.get(
+            '/api/menus/?min_depth=2&max_depth=2')),
+            ['21', '22', '23', '24', '41'])
+        self.assertEqual(self.get('/api/menus/?min_depth=0').status_code,
+                         400)
+
+    def test_subtree_filter(self):
+        self.assertEqual(self.titles(self.get('/api/menus/?subtree=default')),
+                         ['2', '21', '22', '23', '231', '24'])
+        self.assertEqual(self.titles(self.get(
+            '/api/menus/?subtree=default&min_depth=3')), ['231'])
+        self.assertEqual(self.titles(self.get('/api/menus/?subtree=nope')),
+                         [])
+
+    def test_not_modified(self):
+        response = self.get('/api/menus/?subtree=default')
+        etag = response['ETag']
+        # items leaving a page needn't change the latest time on it.
+        self.assertFalse(response.has_header('Last-Modified'))
+        response = self.get('/api/menus/?subtree=default',
+                            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_page_validators(self):
+        etag = self.get('/api/menus/?page=3')['ETag']
+        self.assertEqual(self.get('/api/menus/?page=3',
+                                  HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # not on the page, but below an item which is.
+        MenuItem.objects.filter(title='231').update(title='changed')
+        self.assertEqual(self.get('/api/menus/?page=3',
+                                  HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_modified_by_move(self):
+        url = '/api/menus/default/'
+        etag = self.get(url)['ETag']
+        MenuItem.objects.get(title='41').move(
+            MenuItem.objects.get(title='2'), pos='last-child')
+        response = self.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['descendants'], 6)
+
+    def test_tree(self):
+        tree = self.get('/api/menus/default/tree/').data
+        self.assertEqual(tree['title'], '2')
+        self.assertEqual([x['title'] for x in tree['children']],
+                         ['21', '22', '23', '24'])
+        self.assertEqual(tree['descendants'], 5)
+        third = tree['children'][2]
+        self.assertEqual(third['descendants'], 1)
+        self.assertEqual([x['title'] for x in third['children']], ['231'])
+
+    def test_tree_depth(self):
+        tree = self.get('/api/menus/default/tree/?depth=1').data
+        third = tree['children'][2]
+        self.assertEqual(third['children'], [])
+        # the cut off descendants are still counted.
+        self.assertEqual(third['descendants'], 1)
+        self.assertEqual(tree['descendants'], 5)
+
+    def test_tree_fields(self):
+        tree = self.get('/api/menus/default/tree/?fields=title').data
+        self.assertEqual(sorted(tree), ['children', 'title'])
+        self.assertEqual(self.get('/api/menus/default/tree/?fields=x')
+                         .status_code, 400)
@@ -0,0 +1,124 @@
+import json
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.test import TestCase as TestCaseWithDB
+from django.test.utils import override_settings
+from django.contrib.sites.models import Site
+from django.utils.six import StringIO
+try:
+    from django.core.cache.utils import make_template_fragment_key
+except ImportError:  # pragma: no cover (Django < 1.6)
+    make_template_fragment_key = None
+try:
+    from unittest import skipIf
+except ImportError:  # pragma: no cover
+    from django.utils.unittest import skipIf
+from menuhin import warming
+from menuhin.models import MenuItem
+from menuhin.snapshots import menu_snapshots
+from menuhin.versions import get_tree_version
+from menuhin.warming import (warm_menus, get_warm_urls, make_warm_request,
+                             warm_on_startup, WarmJob)
+from .data import get_bulk_data
+
+
+class WarmMenusTestCase(TestCaseWithDB):
+    def setUp(self):
+        cache.clear()
+        MenuItem.load_bulk(get_bulk_data())
+        self.site = Site.objects.get_current()
+        self.root = MenuItem.objects.filter(site=self.site, depth=1)[0]
+        menu_snapshots.snapshots.clear()
+
+    def test_urls_from_menu_items(self):
+        urls = get_warm_urls(self.site)
+        self.assertTrue(urls)
+        self.assertTrue(all(x.startswith('/') for x in urls))
+        with self.settings(MENUHIN_WARM_URL_LIMIT=2):
+            self.assertEqual(len(get_warm_urls(self.site)), 2)
+
+    def test_urls_from_setting(self):
+        with self.settings(MENUHIN_WARM_URLS=('/a/',)):
+            self.assertEqual(get_warm_urls(self.site), ('/a/',))
+
+    def test_renders_each_url(self):
+        report = warm_menus(urls=('/', '/1/'), threads=1)
+        self.assertEqual(report.errors(), ())
+        self.assertEqual([x.job for x in report.results], [
+            WarmJob(kind='render', site=self.site, target='/'),
+            WarmJob(kind='render', site=self.site, target='/1/'),
+        ])
+        self.assertEqual(report.counts()['pages'], 2)
+
+    @override_settings(MENUHIN_SNAPSHOTS=True,
+                       MENUHIN_SNAPSHOT_REFRESH='inline')
+    def test_preloads_snapshots(self):
+        menus = ((self.root.pk, 0, 100),)
+        with self.settings(MENUHIN_WARM_MENUS=menus):
+            report = warm_menus(urls=(), threads=1)
+        self.assertEqual(report.counts()['snapshots'], 1)
+        self.assertEqual(report.errors(), ())
+        with self.assertNumQueries(0):
+            menu_snapshots.get(MenuItem, site=self.site, parent=self.root,
+                               from_depth=0, to_depth=100)
+
+    @override_settings(MENUHIN_SNAPSHOTS=True,
+                       MENUHIN_WARM_MENUS=(('missing', 0, 100),))
+    def test_errors_reported(self):
+        report = warm_menus(urls=(), threads=1)
+        self.assertEqual(len(report.errors()), 1)
+        self.assertIn('DoesNotExist', report.errors()[0].error)
+
+    def test_request(self):
+        request = make_warm_request(self.site, '/a/?b=1')
+        self.assertEqual(request.path, '/a/')
+        self.assertEqual(request.GET['b'], '1')
+        self.assertEqual(request.META['HTTP_HOST'], self.site.domain)
+        self.assertFalse(request.user.is_authenticated())
+
+    @skipIf(make_template_fragment_key is None,
+            "make_template_fragment_key needs Django 1.6+")
+    def test_fragments_cached(self):
+        menus = ((self.root.pk, 0, 100),)
+        with self.settings(MENUHIN_WARM_MENUS=menus):
+            report = warm_menus(urls=('/',), threads=1)
+        self.assertEqual(report.errors(), ())
+        key = make_template_fragment_key('menuhin_menu', (
+            get_tree_version(self.site.pk), self.site.domain, '/', False,
+            self.root.pk, 0, 100))
+        self.assertIsNotNone(cache.get(key))
+
+    def test_command(self):
+        out = StringIO()
+        call_command('warm_menus', urls=['/'], threads=1, as_json=True,
+                     stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['counts']['pages'], 1)
+        self.assertEqual(report['results'][0]['target'], '/')
+
+    def test_command_unknown_site(self):
+        out = StringIO()
+        call_command('warm_menus', site_ids=['1000'], stdout=out)
+        self.assertIn("don't exist", out.getvalue())
+
+
+class WarmOnStartupTestCase(TestCaseWithDB):
+    def setUp(self):
+        self.started = []
+        self.original = warming.warm_in_background
+        warming.warm_in_background = lambda: self.started.append(True)
+        warming._warmed_pids.clear()
+
+    def tearDown(self):
+        warming.warm_in_background = self.original
+        warming._warmed_pids.clear()
+        request_started.disconnect(
+            dispatch_uid='menuhin_warm_at_first_request')
+
+    def test_first_request_only(self):
+        warm_on_startup()
+        self.assertEqual(self.started, [])
+        request_started.send(sender=self.__class__)
+        request_started.send(sender=self.__class__)
+        self.assertEqual(self.started, [True])
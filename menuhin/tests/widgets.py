@@ -0,0 +1,103 @@
+import json
+from django.test import TestCase as TestCaseWithDB
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from menuhin.admin import MenuItemAdmin
+from menuhin.models import MenuItem
+from menuhin.utils import request_cache
+from menuhin.widgets import MenuItemSelect
+from .data import get_bulk_data
+
+
+class MenuItemSelectTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+        Site.objects.get_current()
+
+    def tearDown(self):
+        request_cache.finish()
+
+    def test_all_options(self):
+        html = MenuItemSelect().render(name='x', value='/sup')
+        self.assertEqual(html.count('<option'), 11)
+        self.assertIn('value="/sup" selected="selected"', html)
+
+    def test_shared_per_request(self):
+        widget = MenuItemSelect()
+        request_cache.start()
+        with self.assertNumQueries(1):
+            widget.render(name='x', value='')
+            widget.render(name='y', value='')
+            MenuItemSelect().render(name='z', value='')
+
+    def test_not_shared_outside_request(self):
+        widget = MenuItemSelect()
+        with self.assertNumQueries(2):
+            widget.render(name='x', value='')
+            widget.render(name='y', value='')
+
+    def test_remote(self):
+        widget = MenuItemSelect(remote=True, search_url='/search/')
+        with self.assertNumQueries(1):
+            html = widget.render(name='x', value='/hotdog/')
+        self.assertEqual(html.count('<option'), 2)
+        self.assertIn('data-menuhin-search="/search/"', html)
+        self.assertIn('value="/hotdog/" selected="selected">-- 41<', html)
+
+    def test_remote_unknown_value(self):
+        widget = MenuItemSelect(remote=True, search_url='/search/')
+        html = widget.render(name='x', value='/nope/')
+        self.assertIn('value="/nope/" selected="selected">/nope/<', html)
+
+    @override_settings(MENUHIN_WIDGET_REMOTE=True)
+    def test_remote_setting(self):
+        self.assertTrue(MenuItemSelect().remote)
+        self.assertFalse(MenuItemSelect(remote=False).remote)
+
+
+class SearchViewTestCase(TestCaseWithDB):
+    def setUp(self):
+        MenuItem.load_bulk(get_bulk_data())
+        self.modeladmin = MenuItemAdmin(MenuItem, admin.site)
+        self.user = User.objects.create_superuser(
+            username='admin', password='admin', email='admin@example.com')
+
+    def search(self, **params):
+        request = RequestFactory().get('/', params)
+        request.user = self.user
+        response = self.modeladmin.search_view(request)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_url(self):
+        self.assertTrue(reverse('admin:menuhin_menuitem_search'))
+
+    def test_prefix(self):
+        data = self.search(q='h')
+        self.assertEqual([x['value'] for x in data['results']],
+                         ['/HI', '/hotdog/'])
+        self.assertEqual(data['results'][1]['label'], '-- 41')
+        self.assertFalse(data['more'])
+
+    @override_settings(MENUHIN_WIDGET_PAGE_SIZE=4)
+    def test_pages(self):
+        first = self.search(q='', page=1)
+        self.assertEqual(len(first['results']), 4)
+        self.assertTrue(first['more'])
+        last = self.search(q='', page=3)
+        self.assertEqual(len(last['results']), 2)
+        self.assertFalse(last['more'])
+
+    def test_requires_permission(self):
+        self.user = User.objects.create_user(username='staff',
+                                             password='staff',
+                                             email='staff@example.com')
+        self.user.is_staff = True
+        self.user.save()
+        with self.assertRaises(PermissionDenied):
+            self.search(q='h')
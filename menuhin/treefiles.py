@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from django.conf import settings
+from django.db import connection
+from .codec import HEADER, CodecError, TreeReader, encode_tree
+
+
+logger = logging.getLogger(__name__)
+
+_trees = {}
+_trees_lock = threading.Lock()
+#: the sites whose tree files are being written in the background.
+_writing = set()
+
+
+class MappedTree(TreeReader):
+    """
+    A tree file (an uncompressed `menuhin.codec` encoded tree), mapped
+    read-only, so that every process reading it shares the same physical
+    pages. Nodes are only decoded when asked for.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            self.stat = os.fstat(handle.fileno())
+            if self.stat.st_size < HEADER.size:
+                raise CodecError("{0} is truncated".format(path))
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        super(MappedTree, self).__init__(data)
+
+    def _bisect(self, before, low=0):
+        """
+        The first index from `low` for which `before(path)` is False.
+        """
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if before(self.get_path(middle)):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def index(self, path):
+        found = self._bisect(lambda x: x < path)
+        if found < self.count and self.get_path(found) == path:
+            return found
+        raise KeyError(path)
+
+    def subtree_range(self, path):
+        """
+        The (start, stop) indexes of the node at `path` and its descendants.
+        """
+        start = self.index(path)
+        stop = self._bisect(lambda x: x.startswith(path), low=start + 1)
+        return start, stop
+
+    def iter_annotated(self, parent_path=None, from_depth=None,
+                       to_depth=None):
+        """
+        The same (node, info) pairs as `MenuItem.iter_published_annotated`,
+        with depths relative to the node at `parent_path` if given.
+        """
+        from .models import MenuItem
+        start, stop, base_depth = 0, self.count, 0
+        if parent_path is not None:
+            start, stop = self.subtree_range(parent_path)
+            base_depth = self[start].depth
+        nodes = (self[x] for x in range(start, stop))
+        if from_depth is not None:
+            nodes = (x for x in nodes if x.depth >= from_depth + base_depth)
+        if to_depth is not None:
+            nodes = (x for x in nodes if x.depth <= to_depth + base_depth)
+        return MenuItem._annotate_published(nodes)
+
+
+def get_tree_files_dir():
+    return getattr(settings, 'MENUHIN_TREE_FILES_DIR', None)
+
+
+def get_tree_files_write():
+    """
+    'thread' (the default) writes tree files in the background, so that no
+    request waits on one, or 'inline' writes them as soon as they're needed.
+    """
+    return getattr(settings, 'MENUHIN_TREE_FILES_WRITE', 'thread')
+
+
+def get_tree_file_path(site_id, directory=None):
+    if directory is None:
+        directory = get_tree_files_dir()
+    return os.path.join(directory, 'menuhin-tree-{0}.bin'.format(site_id))
+
+
+def write_tree_file(site_id, directory=None):
+    """
+    Compiles the site's published tree, then renames the file into place,
+    so that processes reading it only ever see a complete one.
+    """
+    from .models import MenuItem
+    from .versions import get_tree_version
+    path = get_tree_file_path(site_id, directory=directory)
+    version = get_tree_version(site_id)
+    rows = (MenuItem.objects.filter(site=site_id, is_published=True)
+            .order_by('path')
+            .values_list('pk', 'depth', 'numchild', 'is_published', 'path',
+                         'uri', 'title', 'menu_slug').iterator())
+    data = encode_tree(rows, site_id=site_id, version=version)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix='.menuhin-tree-')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temporary, 0o644)
+        getattr(os, 'replace', os.rename)(temporary, path)
+    except Exception:
+        os.unlink(temporary)
+        raise
+    return path
+
+
+def write_in_background(site_id):
+    """
+    `write_tree_file` in a daemon thread, unless one is already writing the
+    site's file; if that turns out to be out of date, `get_mapped_tree`
+    asks for another.
+    """
+    with _trees_lock:
+        if site_id in _writing:
+            return None
+        _writing.add(site_id)
+
+    def run():
+        try:
+            write_tree_file(site_id)
+        except Exception:
+            logger.exception("Couldn't write the tree file for site "
+                             "{0}".format(site_id))
+        finally:
+            with _trees_lock:
+                _writing.discard(site_id)
+            connection.close()
+    thread = threading.Thread(target=run,
+                              name='menuhin-tree-file-{0}'.format(site_id))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def request_write(site_id):
+    """
+    Has the site's tree file written, as MENUHIN_TREE_FILES_WRITE says.
+    True if it has been by the time this returns.
+    """
+    if get_tree_files_write() == 'inline':
+        write_tree_file(site_id)
+        return True
+    write_in_background(site_id)
+    return False
+
+
+def _load(path):
+    """
+    The tree file at `path`, mapped again only if it's been replaced, or
+    None if it's missing or unreadable (eg: from an older version of the
+    format).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with _trees_lock:
+        tree = _trees.get(path)
+    if tree is not None and (tree.stat.st_ino, tree.stat.st_mtime) == (
+            stat.st_ino, stat.st_mtime):
+        return tree
+    try:
+        return MappedTree(path)
+    except CodecError:
+        logger.warning("{0} is unreadable, so will be rewritten".format(path))
+    except (IOError, OSError):
+        # replaced since the stat() above.
+        pass
+    return None
+
+
+def get_mapped_tree(site_id):
+    """
+    The site's tree file, mapped, or None if MENUHIN_TREE_FILES_DIR isn't
+    set, or the file isn't ready. The file is (re)written if it's missing,
+    unreadable or older than the site's tree version; in the background,
+    unless MENUHIN_TREE_FILES_WRITE is 'inline', during which time this
+    gives None so that callers go to the database instead.
+    """
+    from .versions import get_tree_version
+    if get_tree_files_dir() is None:
+        return None
+    path = get_tree_file_path(site_id)
+    tree = _load(path)
+    if tree is None or tree.version < get_tree_version(site_id):
+        if not request_write(site_id):
+            return None
+        tree = _load(path)
+        if tree is None:
+            return None
+    with _trees_lock:
+        _trees[path] = tree
+    return tree
+
+
+def as_instance(model, node, site):
+    """
+    An unsaved `model` instance for a node of a tree file, as a template
+    would get it from the database (lacking `created` and `modified`, which
+    tree files don't keep).
+    """
+    instance = model(site=site, **node._asdict())
+    instance._state.adding = False
+    return instance
+
+
+def get_published_annotated_list(model, site, parent=None, from_depth=None,
+                                 to_depth=None):
+    """
+    `model.get_published_annotated_list`, read from the site's tree file if
+    there's an up to date one, so without going to the database.
+    """
+    tree = get_mapped_tree(site.pk)
+    if tree is not None:
+        try:
+            annotated = tree.iter_annotated(
+                parent_path=getattr(parent, 'path', None),
+                from_depth=from_depth, to_depth=to_depth)
+        except KeyError:
+            # an unpublished parent isn't in the file.
+            pass
+        else:
+            return [(as_instance(model, node, site), info)
+                    for node, info in annotated]
+    tree_kwargs = {'site': site}
+    if from_depth is not None:
+        tree_kwargs.update(from_depth=from_depth)
+    if to_depth is not None:
+        tree_kwargs.update(to_depth=to_depth)
+    return model.get_published_annotated_list(parent=parent, **tree_kwargs)
+
+
+def rewrite_tree_files(sender, site_ids, **kwargs):
+    """
+    `menuhin.signals.tree_changed` listener to have the changed sites' tree
+    files written (in the background, by default) once the changes are
+    committed.
+    """
+    if get_tree_files_dir() is None:
+        return None
+    for site_id in site_ids:
+        try:
+            request_write(site_id)
+        except Exception:
+            # get_mapped_tree will notice it's out of date.
+            logger.exception("Couldn't write the tree file for site "
+                             "{0}".format(site_id))
@@ -1,8 +1,11 @@
+import calendar
+import hashlib
 import logging
-from collections import namedtuple
+import threading
+from contextlib import contextmanager
+from collections import namedtuple, defaultdict
 import functools
 import operator
-from django.contrib.contenttypes.models import ContentType
 from django.utils.html import strip_tags
 from django.utils.functional import SimpleLazyObject, new_method_proxy
 from django.core.urlresolvers import resolve, Resolver404
@@ -18,21 +21,57 @@ except ImportError:  # pragma: no cover
     from django.utils.encoding import force_unicode as force_text
 
 from django.core.exceptions import ImproperlyConfigured
-from django.db.models import Q
+from django.db.models import Q, Max, Count, BooleanField
+from django.db import connections, transaction
+
+try:
+    from django.db.models import Case, When, Value
+except ImportError:  # pragma: no cover (Django < 1.8)
+    Case = When = Value = None
+from django.utils import timezone
+from django.utils.http import parse_etags, parse_http_date_safe
+
+try:
+    from django.db.transaction import atomic as _atomic
+except ImportError:  # pragma: no cover (Django < 1.6)
+    from django.db.transaction import commit_on_success as _atomic
 
 try:
     from django.utils.text import slugify
 except ImportError:  # pragma: no cover
     from django.template.defaultfilters import slugify
 
+from django.core.signals import request_started, request_finished
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:  # pragma: no cover (Django < 1.8)
+    from django.test.signals import setting_changed
+
 from django.contrib.sites.models import Site
 from .signals import default_for_site_created, default_for_site_needed
+from .versions import (bump_tree_versions, defer_version_bumps,
+                       get_tree_version, publish_committed)
 from django.conf import settings
 
 
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def atomic(*args, **kwargs):
+    """
+    Django's `atomic` (or `commit_on_success`), which also publishes the
+    tree versions bumped within once the outermost block is over, rather
+    than leaving them for the end of the request (see `menuhin.versions`).
+    """
+    try:
+        with _atomic(*args, **kwargs):
+            yield
+    finally:
+        publish_committed()
+
+
 class RequestRelations(namedtuple('RequestRelations', ('relations', 'obj',
                        'requested', 'path'))):
     def has_relations(self):
@@ -93,7 +132,7 @@ DefaultForSite = namedtuple('DefaultForSite', ('obj', 'created'))
 
 def ensure_default_for_site(model, site_id=None):
     if site_id is None:
-        site_id = Site.objects.get_current()
+        site_id = get_current_site()
     kwargs = {'menu_slug': 'default', 'site': site_id}
     try:
         obj = model.objects.get(**kwargs)
@@ -113,7 +152,7 @@ def ensure_default_for_site(model, site_id=None):
 
 
 def get_menuitem_or_none(model, uri):
-    lookup = {'site': Site.objects.get_current(),
+    lookup = {'site': get_current_site(),
               'uri__iexact': uri,
               'is_published': True}
     try:
@@ -129,7 +168,7 @@ def get_menuitem_or_none(model, uri):
 CollectedMenu = namedtuple('CollectedMenu', ('path', 'instance', 'name'))
 
 
-def _collect_menus():
+def _load_menus():
     MENUHIN_MENU_HANDLERS = getattr(settings, 'MENUHIN_MENU_HANDLERS', None)
     if MENUHIN_MENU_HANDLERS is None:
         raise ImproperlyConfigured("MENUHIN_MENU_HANDLERS not found in "
@@ -158,21 +197,278 @@ def _collect_menus():
                             name=menu_itself.title)
 
 
+class MenuRegistry(object):
+    """
+    Holds a single, shared instance of each of the MENUHIN_MENU_HANDLERS,
+    so that the setting is parsed and the handlers imported and
+    instantiated only once, rather than every time they are asked for.
+    """
+    def __init__(self):
+        self._menus = None
+        self._lock = threading.Lock()
+
+    def populate(self):
+        menus = tuple(_load_menus())
+        self._menus = menus
+        return menus
+
+    def clear(self):
+        self._menus = None
+
+    def reload(self):
+        with self._lock:
+            return self.populate()
+
+    def menus(self):
+        menus = self._menus
+        if menus is None:
+            with self._lock:
+                menus = self._menus
+                if menus is None:
+                    menus = self.populate()
+        return menus
+
+    def get(self, path):
+        for menu in self.menus():
+            if menu.path == path:
+                return menu
+        raise KeyError(path)
+
+    def __iter__(self):
+        return iter(self.menus())
+
+    def __len__(self):
+        return len(self.menus())
+
+
+menu_registry = MenuRegistry()
+
+
+def _reset_menu_registry(sender, setting, **kwargs):
+    if setting == 'MENUHIN_MENU_HANDLERS':
+        menu_registry.clear()
+
+
+setting_changed.connect(_reset_menu_registry,
+                        dispatch_uid='menuhin_reset_menu_registry')
+
+
+def _collect_menus():
+    return iter(menu_registry.menus())
+
+
+class RequestCache(threading.local):
+    """
+    Values remembered for the rest of the request being handled by this
+    thread. Outside of a request (eg: management commands, tests) nothing
+    is remembered, as nothing would clear it.
+    """
+    def __init__(self):
+        self.active = False
+        self.values = {}
+
+    def start(self):
+        self.active = True
+        self.values = {}
+
+    def finish(self):
+        self.active = False
+        self.values = {}
+
+    def get_or_set(self, key, factory):
+        if not self.active:
+            return factory()
+        if key not in self.values:
+            self.values[key] = factory()
+        return self.values[key]
+
+    def set(self, key, value):
+        if self.active:
+            self.values[key] = value
+        return value
+
+
+request_cache = RequestCache()
+
+
+def _start_request_cache(sender, **kwargs):
+    request_cache.start()
+
+
+request_started.connect(_start_request_cache,
+                        dispatch_uid='menuhin_start_request_cache')
+
+
+def _finish_request_cache(sender, **kwargs):
+    request_cache.finish()
+
+
+request_finished.connect(_finish_request_cache,
+                         dispatch_uid='menuhin_finish_request_cache')
+
+
+CURRENT_SITE_KEY = ('menuhin.site',)
+
+#: Sites by their lowercased domains, for `get_current_site`. Every site is
+#: loaded at once, and hosts matching none of them aren't remembered, so it
+#: never holds more than there are sites, whatever Host headers are sent.
+_sites_by_domain = {}
+#: (model, site pk) pairs known to have a default root, for
+#: `ensure_default_exists`.
+_default_roots = set()
+
+
+def get_request_host(request):
+    return request.get_host().rsplit(':', 1)[0].lower()
+
+
+def _get_site_for_host(host):
+    if not _sites_by_domain:
+        found = {}
+        for site in Site.objects.order_by('pk'):
+            found.setdefault(site.domain.lower(), site)
+        _sites_by_domain.update(found)
+    site = _sites_by_domain.get(host)
+    if site is None:
+        site = Site.objects.get_current()
+    return site
+
+
+def get_current_site(request=None):
+    """
+    The Site being served, looked up once per request rather than on every
+    call.
+
+    If MENUHIN_SITE_FROM_HOST is True, the site whose domain is the
+    request's host is used (or SITE_ID's, if none match), and calls without
+    a request get whichever site the request was last resolved to, as
+    `menuhin.middleware.RequestTreeMiddleware` does at the start of each.
+    """
+    if request is not None and getattr(settings, 'MENUHIN_SITE_FROM_HOST',
+                                       False):
+        site = _get_site_for_host(get_request_host(request))
+        return request_cache.set(CURRENT_SITE_KEY, site)
+    return request_cache.get_or_set(CURRENT_SITE_KEY,
+                                    Site.objects.get_current)
+
+
+def ensure_default_exists(model, site_id=None):
+    """
+    `ensure_default_for_site`, remembering for the life of the process
+    which sites have one so that only the first call for each queries.
+    Returns whether the default root had to be created.
+    """
+    if site_id is None:
+        site_id = get_current_site()
+    key = (model, getattr(site_id, 'pk', site_id))
+    if key in _default_roots:
+        return False
+    created = ensure_default_for_site(model=model, site_id=site_id).created
+    _default_roots.add(key)
+    return created
+
+
+def forget_default_roots(sender, **kwargs):
+    """
+    Any change to a menu item may have removed, or moved, a default root.
+    """
+    _default_roots.clear()
+
+
+def forget_sites(sender, **kwargs):
+    _sites_by_domain.clear()
+    _default_roots.clear()
+
+
+def _reset_sites(sender, setting, **kwargs):
+    if setting in ('SITE_ID', 'MENUHIN_SITE_FROM_HOST'):
+        forget_sites(sender=sender)
+
+
+setting_changed.connect(_reset_sites, dispatch_uid='menuhin_reset_sites')
+
+
+def toggle_published(queryset):
+    """
+    Flip `is_published` for everything in the queryset, in one UPDATE,
+    returning how many rows were changed.
+    """
+    now = timezone.now()
+    if Case is not None:
+        flipped = Case(When(is_published=True, then=Value(False)),
+                       default=Value(True), output_field=BooleanField())
+        return queryset.update(is_published=flipped, modified=now)
+
+    # no conditional expressions, so the same UPDATE by hand; the subquery
+    # is wrapped in a derived table because MySQL won't select from the
+    # table being updated otherwise.
+    model = queryset.model
+    site_ids = frozenset(queryset.order_by().values_list('site', flat=True)
+                         .distinct())
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    published = model._meta.get_field_by_name('is_published')[0]
+    modified = model._meta.get_field_by_name('modified')[0]
+    inner, params = (queryset.order_by().values('pk')
+                     .query.sql_with_params())
+    sql = ('UPDATE {table} SET {published} = CASE WHEN {published} = %s '
+           'THEN %s ELSE %s END, {modified} = %s WHERE {pk} IN '
+           '(SELECT {pk} FROM ({inner}) AS menuhin_toggled)').format(
+        table=qn(model._meta.db_table), published=qn(published.column),
+        modified=qn(modified.column), pk=qn(model._meta.pk.column),
+        inner=inner)
+    now = modified.get_db_prep_value(now, connection=connection)
+    cursor = connection.cursor()
+    cursor.execute(sql, (True, False, True, now) + tuple(params))
+    if hasattr(transaction, 'commit_unless_managed'):  # Django < 1.6
+        transaction.commit_unless_managed(using=queryset.db)
+    bump_tree_versions(site_ids)
+    return cursor.rowcount
+
+
+def set_subtree_published(queryset, published):
+    """
+    Publish (or unpublish) everything in the queryset along with all of
+    their descendants, by one UPDATE of a path range per subtree. Nodes
+    below another selected node are covered by its subtree, so don't get
+    an UPDATE of their own.
+    """
+    model = queryset.model
+    roots = []
+    for path in sorted(queryset.values_list('path', flat=True)):
+        if roots and path.startswith(roots[-1]):
+            continue
+        roots.append(path)
+    items = model.objects.using(queryset.db)
+    updated = 0
+    with defer_version_bumps():
+        for path in roots:
+            updated += items.filter(
+                path__range=model.get_subtree_range(path)).update(
+                is_published=published, modified=timezone.now())
+    return updated
+
+
 def change_published_status(modeladmin, request, queryset):
-    unpublish = queryset.filter(is_published=True)
-    unpublish_pks = tuple(unpublish.values_list('pk', flat=True))
-    publish = queryset.filter(is_published=False)
-    publish_pks = tuple(publish.values_list('pk', flat=True))
-    unpublish.filter(pk__in=unpublish_pks).update(is_published=False)
-    publish.filter(pk__in=publish_pks).update(is_published=True)
+    toggle_published(queryset)
 change_published_status.short_description = "Toggle published"
 
 
+def publish_subtree(modeladmin, request, queryset):
+    set_subtree_published(queryset, published=True)
+publish_subtree.short_description = "Publish, along with descendants"
+
+
+def unpublish_subtree(modeladmin, request, queryset):
+    set_subtree_published(queryset, published=False)
+unpublish_subtree.short_description = "Unpublish, along with descendants"
+
+
 # MissingURI = namedtuple('MissingURI', ('uri',))
 
 def find_missing(model, urls, site_id=None):
     if site_id is None:
-        site_id = Site.objects.get_current()
+        site_id = get_current_site()
 
     url_count = len(urls)
     if url_count == 0:
@@ -196,7 +492,7 @@ MenuItemURI = namedtuple('MenuItemURI', ('instance', 'uri'))
 
 def add_urls(model, urls, site_id=None):
     if site_id is None:
-        site_id = Site.objects.get_current().pk
+        site_id = get_current_site().pk
     for url in urls:
         kwargs = {
             'uri': url.path,
@@ -205,11 +501,11 @@ def add_urls(model, urls, site_id=None):
             'site_id': site_id,
             'menu_slug': set_menu_slug(url.path)
         }
-        original_obj = getattr(url, 'model_instance', None)
-        if original_obj is not None:
+        content_type_id = getattr(url, 'content_type_id', None)
+        if content_type_id is not None:
             kwargs.update({
-                '_original_content_type': ContentType.objects.get_for_model(original_obj),
-                '_original_content_id': original_obj.pk
+                '_original_content_type_id': content_type_id,
+                '_original_content_id': url.object_pk
             })
 
         instance = model.add_root(**kwargs)
@@ -224,6 +520,397 @@ def update_all_urls(model, possible_urls, site_id=None):
     return None
 
 
+def chunked(iterable, size):
+    """
+    Split an iterable into tuples of at most `size` items, so that large
+    syncs can be written in bounded transactions.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield tuple(chunk)
+            chunk = []
+    if chunk:
+        yield tuple(chunk)
+
+
+def get_sync_chunk_size():
+    return getattr(settings, 'MENUHIN_SYNC_CHUNK_SIZE', 500)
+
+
+def normalize_uri(uri):
+    """
+    The key used to compare handler output against stored rows, matching
+    the case-insensitive `uri__iexact` lookups used everywhere else.
+    """
+    return force_text(uri).strip().lower()
+
+
+#: pk, uri and is_published describe the existing row; title is the title
+#: the row should have, old_title the one it currently has.
+SyncItem = namedtuple('SyncItem', ('pk', 'uri', 'title', 'old_title',
+                                   'is_published'))
+
+
+class SyncDiff(namedtuple('SyncDiff', ('site_id', 'added', 'retitled',
+                                       'unchanged', 'orphaned'))):
+    """
+    The result of comparing handler output against the stored tree for a
+    site. `added` holds URI instances; everything else holds SyncItems.
+    """
+    def counts(self):
+        return {
+            'added': len(self.added),
+            'retitled': len(self.retitled),
+            'unchanged': len(self.unchanged),
+            'orphaned': len(self.orphaned),
+        }
+
+    def has_changes(self):
+        return (len(self.added) > 0 or len(self.retitled) > 0 or
+                len(self.orphaned) > 0)
+
+    def as_dict(self):
+        # unchanged rows are only counted, as there's nothing to act on.
+        return {
+            'site': self.site_id,
+            'counts': self.counts(),
+            'added': [{'uri': x.path, 'title': force_text(x.title)}
+                      for x in self.added],
+            'retitled': [dict(x._asdict()) for x in self.retitled],
+            'orphaned': [dict(x._asdict()) for x in self.orphaned],
+        }
+
+
+class SyncResult(namedtuple('SyncResult', ('diff', 'inserted', 'retitled',
+                                           'unpublished'))):
+    """
+    What `apply_diff` actually wrote. `inserted` is a tuple of MenuItemURI
+    instances, the others are the number of rows updated.
+    """
+    def counts(self):
+        return {
+            'inserted': len(self.inserted),
+            'retitled': self.retitled,
+            'unpublished': self.unpublished,
+        }
+
+    def as_dict(self):
+        return {
+            'site': self.diff.site_id,
+            'applied': self.counts(),
+            'diff': self.diff.as_dict(),
+        }
+
+
+def _existing_rows(model, site_id, keys):
+    queryset = (model.objects.filter(site_id=site_id)
+                .values_list('pk', 'uri', 'title', 'is_published',
+                             '_original_content_type'))
+    if keys is None:
+        return queryset.iterator()
+    # only look up the rows which were asked about, a chunk at a time, to
+    # avoid enormous OR clauses.
+    lookups = (
+        functools.reduce(operator.or_, (Q(uri__iexact=x) for x in chunk))
+        for chunk in chunked(keys, 100)
+    )
+    return (row for lookup in lookups
+            for row in queryset.filter(lookup).iterator())
+
+
+def diff_urls(model, urls, site_id=None, partial=False):
+    """
+    Classify every stored row for the site as retitled, unchanged or
+    orphaned (no longer emitted by any handler), and every handler URL
+    without a row as added. Only rows which a handler created for a model
+    instance can be orphaned; those added by hand, or for plain URIs, can't
+    be told apart from each other, so are left alone.
+
+    If `partial` is True, `urls` is taken to be a subset of the handlers'
+    output (eg: an incremental sync), so only those rows are looked up and
+    nothing is ever considered orphaned.
+    """
+    if site_id is None:
+        site_id = get_current_site().pk
+    site_id = getattr(site_id, 'pk', site_id)
+    max_length = model._meta.get_field_by_name('title')[0].max_length
+
+    wanted = {}
+    ordering = []
+    for url in urls:
+        key = normalize_uri(url.path)
+        if key not in wanted:
+            wanted[key] = url
+            ordering.append(key)
+
+    seen = set()
+    retitled, unchanged, orphaned = [], [], []
+    lookup_keys = ordering if partial else None
+    for pk, uri, title, is_published, content_type_id in _existing_rows(
+            model, site_id, lookup_keys):
+        key = normalize_uri(uri)
+        if key not in wanted:
+            if not partial and content_type_id is not None:
+                orphaned.append(SyncItem(pk=pk, uri=uri, title=title,
+                                         old_title=title,
+                                         is_published=is_published))
+            continue
+        seen.add(key)
+        new_title = force_text(wanted[key].title)[:max_length]
+        item = SyncItem(pk=pk, uri=uri, title=new_title, old_title=title,
+                        is_published=is_published)
+        if new_title != title:
+            retitled.append(item)
+        else:
+            unchanged.append(item)
+
+    added = tuple(wanted[key] for key in ordering if key not in seen)
+    return SyncDiff(site_id=site_id, added=added, retitled=tuple(retitled),
+                    unchanged=tuple(unchanged), orphaned=tuple(orphaned))
+
+
+def apply_diff(model, diff, unpublish=False, update_titles=False,
+               chunk_size=None):
+    """
+    Write a SyncDiff to the database: inserts for added URLs and, if asked
+    for, title updates (grouped so that rows sharing a title take one
+    UPDATE) and unpublishing of orphaned rows. Each chunk is its own
+    transaction.
+    """
+    if chunk_size is None:
+        chunk_size = get_sync_chunk_size()
+
+    # one bump of the tree version at the end, rather than per chunk.
+    with defer_version_bumps():
+        inserted = []
+        for chunk in chunked(diff.added, chunk_size):
+            with atomic():
+                inserted.extend(add_urls(model, urls=chunk,
+                                         site_id=diff.site_id))
+
+        retitled = 0
+        if update_titles:
+            for chunk in chunked(diff.retitled, chunk_size):
+                by_title = defaultdict(list)
+                for item in chunk:
+                    by_title[item.title].append(item.pk)
+                with atomic():
+                    for title, pks in by_title.items():
+                        retitled += model.objects.filter(pk__in=pks).update(
+                            title=title, modified=timezone.now())
+
+        unpublished = 0
+        if unpublish:
+            stale = (x.pk for x in diff.orphaned if x.is_published)
+            for chunk in chunked(stale, chunk_size):
+                with atomic():
+                    unpublished += model.objects.filter(pk__in=chunk).update(
+                        is_published=False, modified=timezone.now())
+
+    return SyncResult(diff=diff, inserted=tuple(inserted),
+                      retitled=retitled, unpublished=unpublished)
+
+
+def sync_urls(model, urls, site_id=None, unpublish=False,
+              update_titles=False, partial=False, chunk_size=None):
+    diff = diff_urls(model, urls=urls, site_id=site_id, partial=partial)
+    return apply_diff(model, diff=diff, unpublish=unpublish,
+                      update_titles=update_titles, chunk_size=chunk_size)
+
+
+def uri_to_row(uri):
+    """
+    Flatten a URI or ModelURI into a (path, title, content_type_id,
+    object_pk) tuple of plain values, suitable for task messages.
+    """
+    content_type_id = getattr(uri, 'content_type_id', None)
+    object_pk = getattr(uri, 'object_pk', None)
+    if object_pk is not None:
+        object_pk = force_text(object_pk)
+    return (force_text(uri.path), force_text(uri.title), content_type_id,
+            object_pk)
+
+
+def row_to_uri(row):
+    from .models import URI, ModelURI
+    path, title, content_type_id, object_pk = row
+    if content_type_id is None:
+        return URI(path=path, title=title)
+    return ModelURI(path=path, title=title, content_type_id=content_type_id,
+                    object_pk=object_pk)
+
+
+def unique_rows(urls):
+    """
+    Rows for the given URIs, keeping only the first of any which normalize
+    to the same URI, so that chunks of them never overlap.
+    """
+    seen = set()
+    for uri in urls:
+        key = normalize_uri(uri.path)
+        if key not in seen:
+            seen.add(key)
+            yield uri_to_row(uri)
+
+
+#: urls is every URI collected, partial is True if any handler only gave
+#: back what changed since its watermark, watermarked are the handler paths
+#: whose watermark should move to started once the sync succeeds.
+CollectedURLs = namedtuple('CollectedURLs', ('urls', 'partial',
+                                             'watermarked', 'started'))
+
+
+def collect_urls(menus, site_id, full=False):
+    """
+    Ask each CollectedMenu for its URLs; those with an `updated_field` are
+    asked only for what changed since their last successful sync for the
+    site, unless `full` is True.
+
+    `site_id` may also be a sequence of sites, in which case handlers
+    resume from the oldest of their watermarks, so that every site sees
+    everything it missed.
+    """
+    from .models import SyncWatermark
+    if isinstance(site_id, (list, tuple)):
+        site_ids = tuple(getattr(x, 'pk', x) for x in site_id)
+    else:
+        site_ids = (getattr(site_id, 'pk', site_id),)
+    started = timezone.now()
+    urls = []
+    partial = False
+    watermarked = []
+    for menu in menus:
+        if getattr(menu.instance, 'updated_field', None) is None:
+            urls.extend(menu.instance.get_urls())
+            continue
+        watermarked.append(menu.path)
+        since = None
+        if not full:
+            since = SyncWatermark.get_oldest(handler=menu.path,
+                                             site_ids=site_ids)
+        if since is not None:
+            partial = True
+        urls.extend(menu.instance.get_urls(since=since))
+    return CollectedURLs(urls=tuple(urls), partial=partial,
+                         watermarked=tuple(watermarked), started=started)
+
+
+def record_watermarks(collected, site_id):
+    from .models import SyncWatermark
+    site_id = getattr(site_id, 'pk', site_id)
+    for path in collected.watermarked:
+        SyncWatermark.record(handler=path, site_id=site_id,
+                             watermark=collected.started)
+
+
+def sync_handlers(model, menus, site_id=None, full=False, unpublish=False,
+                  update_titles=False, chunk_size=None):
+    """
+    Sync the output of the given CollectedMenus into the site's tree.
+    Orphaned items can only be found (and unpublished) when every handler
+    returned its complete output, which `full` forces.
+    """
+    if site_id is None:
+        site_id = get_current_site().pk
+    collected = collect_urls(menus, site_id=site_id, full=full)
+    result = sync_urls(model, urls=collected.urls, site_id=site_id,
+                       unpublish=unpublish, update_titles=update_titles,
+                       partial=collected.partial, chunk_size=chunk_size)
+    record_watermarks(collected, site_id=site_id)
+    return result
+
+
+class Validators(namedtuple('Validators', ('etag', 'last_modified',
+                                           'count'))):
+    """
+    What a response for some menu items may be conditional on; the
+    `last_modified` time is in seconds since the epoch, as used by
+    `django.utils.http.http_date`.
+    """
+    def not_modified(self, request):
+        """
+        Whether the request's If-None-Match or If-Modified-Since headers
+        mean the client already has the current version.
+        """
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return self.etag in etags or '*' in etags
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+        if if_modified_since is None or self.last_modified is None:
+            return False
+        return self.last_modified <= if_modified_since
+
+
+def get_validators(queryset, extra=(), site_ids=()):
+    """
+    An ETag and Last-Modified time for the given items, from one aggregate
+    query over their `modified` times and number, so that deletions change
+    the ETag too. The tree versions of `site_ids` go into the ETag, for
+    changes which don't touch `modified`. Anything else the response varies
+    on should be given as `extra`.
+    """
+    stats = queryset.order_by().aggregate(latest=Max('modified'),
+                                          count=Count('pk'))
+    latest = stats['latest']
+    parts = [stats['count'], latest.isoformat() if latest else '']
+    last_modified = None
+    if latest is not None:
+        last_modified = calendar.timegm(latest.utctimetuple())
+    return Validators(etag=_make_etag(parts, extra, site_ids),
+                      last_modified=last_modified, count=stats['count'])
+
+
+def get_page_validators(items, extra=(), site_ids=()):
+    """
+    An ETag for a page of items already fetched, from their paths and
+    `modified` times and the tree versions of `site_ids`, without querying
+    for everything else in scope. There's no Last-Modified time, as items
+    leaving the page needn't make the latest of those on it any later.
+    """
+    parts = [len(items)]
+    parts.extend('{0}@{1}'.format(x.path, x.modified.isoformat())
+                 for x in items)
+    return Validators(etag=_make_etag(parts, extra, site_ids),
+                      last_modified=None, count=len(items))
+
+
+def _make_etag(parts, extra, site_ids):
+    parts = list(parts)
+    parts.extend(get_tree_version(x) for x in sorted(site_ids))
+    parts.extend(extra)
+    return hashlib.md5(':'.join(force_text(x) for x in parts)
+                       .encode('utf-8')).hexdigest()
+
+
+def search_menu_items(model, term, site_id=None, published=True):
+    """
+    Menu items whose title or URL start with the given term, in tree order,
+    with only the values needed to label them.
+    """
+    if site_id is None:
+        site_id = get_current_site().pk
+    term = term.strip()
+    lookups = Q(title__istartswith=term) | Q(uri__istartswith=term)
+    if term and not term.startswith('/'):
+        lookups |= Q(uri__istartswith='/' + term)
+    items = model.objects.filter(lookups, site=site_id)
+    if published:
+        items = items.filter(is_published=True)
+    return items.order_by('path').values('pk', 'uri', 'title', 'depth')
+
+
+def depth_label(title, depth, value='-'):
+    """
+    How a menu item is labelled in a list of choices; see
+    MenuItem.depth_ascii.
+    """
+    return ''.ljust(depth, value) + ' ' + force_text(title)
+
+
 def set_menu_slug(uri, model=None):
     path, split, qs = uri.partition('?')
     menu_slug = slugify(force_text(path.replace('/', ' ')))
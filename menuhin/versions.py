@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.views.decorators.cache import cache_page
+from .signals import tree_changed
+
+
+_state = threading.local()
+
+
+def tree_version_cache_key(site_id):
+    return 'menuhin:tree_version:{0}'.format(site_id)
+
+
+def get_tree_version_timeout():
+    return getattr(settings, 'MENUHIN_TREE_VERSION_CACHE_TIMEOUT', 3600)
+
+
+def _read_tree_version(site_id):
+    from .models import TreeVersion
+    found = tuple(TreeVersion.objects.filter(site=site_id)
+                  .values_list('version', flat=True)[:1])
+    return found[0] if found else 0
+
+
+def get_tree_version(site_id):
+    """
+    A number which goes up whenever any of the site's menu items change,
+    going to the database only when the cache doesn't know it.
+    """
+    pending = getattr(_state, 'pending', None)
+    if pending and not _in_transaction():
+        publish_pending()
+    elif pending and site_id in pending:
+        # bumped in a transaction which hasn't finished, so only this
+        # thread can see the new version.
+        return _read_tree_version(site_id)
+    key = tree_version_cache_key(site_id)
+    version = cache.get(key)
+    if version is None:
+        version = _read_tree_version(site_id)
+        # add, rather than set, so that a version bumped since the query
+        # above isn't overwritten with this older one.
+        cache.add(key, version, get_tree_version_timeout())
+        version = cache.get(key, version)
+    return version
+
+
+def _in_transaction():
+    from .models import TreeVersion
+    connection = connections[router.db_for_write(TreeVersion)]
+    try:
+        return connection.in_atomic_block
+    except AttributeError:  # pragma: no cover (Django < 1.6)
+        return transaction.is_managed(using=connection.alias)
+
+
+def _bump(site_ids):
+    from .models import TreeVersion
+    bumped = {}
+    for site_id in frozenset(site_ids):
+        versions = TreeVersion.objects.filter(site=site_id)
+        if not versions.update(version=F('version') + 1):
+            TreeVersion.objects.create(site_id=site_id, version=1)
+        bumped[site_id] = versions.values_list('version', flat=True)[0]
+    if not bumped:
+        return
+    if not _in_transaction():
+        _publish(bumped)
+        return
+    # until the changes are committed, other processes would only rebuild
+    # the old menus under the new version.
+    pending = getattr(_state, 'pending', None)
+    if pending is None:
+        pending = _state.pending = set()
+    pending.update(bumped)
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:  # pragma: no cover (Django 1.9+)
+        on_commit(publish_pending)
+
+
+def publish_pending():
+    """
+    Publish the versions of sites bumped inside transactions, as they are
+    now in the database, so a rolled back bump is published as it was
+    before. Called at the end of every request, by which point its
+    transactions are over, and whenever a version is asked for outside of
+    one.
+    """
+    from .models import TreeVersion
+    pending = getattr(_state, 'pending', None)
+    if not pending:
+        return
+    _state.pending = set()
+    versions = dict(TreeVersion.objects.filter(site__in=pending)
+                    .values_list('site', 'version'))
+    _publish(dict((x, versions.get(x, 0)) for x in pending))
+
+
+def discard_pending():
+    """
+    Forget the versions bumped inside transactions without publishing them,
+    eg: between tests, whose transactions are always rolled back.
+    """
+    _state.pending = set()
+
+
+def publish_committed():
+    """
+    `publish_pending`, unless still inside a transaction.
+    """
+    if getattr(_state, 'pending', None) and not _in_transaction():
+        publish_pending()
+
+
+def publish_at_request_end(sender, **kwargs):
+    """
+    request_finished listener to publish any versions still pending.
+    """
+    publish_pending()
+
+
+def _publish(bumped):
+    for site_id, version in bumped.items():
+        cache.set(tree_version_cache_key(site_id), version,
+                  get_tree_version_timeout())
+    tree_changed.send(sender=bump_tree_versions, site_ids=tuple(bumped))
+
+
+def bump_tree_versions(site_ids):
+    """
+    Increment the tree version of each of the given sites, or inside
+    `defer_version_bumps`, once the block exits.
+    """
+    deferred = getattr(_state, 'deferred', None)
+    if deferred is not None:
+        deferred.update(site_ids)
+        return None
+    return _bump(site_ids)
+
+
+@contextmanager
+def defer_version_bumps():
+    """
+    Bump the tree version of every site changed within the block once, when
+    it exits, rather than for every write.
+    """
+    if getattr(_state, 'deferred', None) is not None:
+        # already deferring; the outermost block does the work.
+        yield
+        return
+    _state.deferred = set()
+    try:
+        yield
+    finally:
+        deferred, _state.deferred = _state.deferred, None
+    _bump(deferred)
+
+
+def bump_for_instance(sender, instance, **kwargs):
+    """
+    post_save and post_delete listener to bump the tree version of a
+    MenuItem's site.
+    """
+    bump_tree_versions((instance.site_id,))
+
+
+def tree_version_key_prefix(request=None, prefix=''):
+    """
+    A `key_prefix` for Django's page caching which changes whenever the
+    current site's menus do.
+    """
+    from .utils import get_current_site
+    site_id = get_current_site(request).pk
+    return '{prefix}menuhin.{site}.{version}'.format(
+        prefix=prefix, site=site_id, version=get_tree_version(site_id))
+
+
+def cache_page_for_menus(timeout, key_prefix='', cache=None):
+    """
+    `cache_page`, with the current site's tree version in the key prefix, so
+    that pages embedding menus are cached until the menus change::
+
+        @cache_page_for_menus(60 * 60)
+        def my_view(request):
+            ...
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            prefix = tree_version_key_prefix(request, prefix=key_prefix)
+            cached_view = cache_page(timeout, cache=cache,
+                                     key_prefix=prefix)(view_func)
+            return cached_view(request, *args, **kwargs)
+        return wrapped
+    return decorator
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
-from django.shortcuts import get_object_or_404
+from django.http import Http404
 from django.utils.http import base36_to_int
 from django.views.generic import RedirectView
 from django.views.decorators.http import require_http_methods
 from django.shortcuts import redirect
+from django.utils.functional import SimpleLazyObject
 from menuhin.models import MenuItem
+from menuhin.shorturls import get_shorturl, hit_buffer
 from menuhin.signals import shorturl_redirect
 
 
 def _redirect_implementation(request, model, b36_encoded_pk):
     """
-    Signal sender once a model instance has been established.
+    Finds the URL for a primary key via the cache, counting the hit in
+    `hit_buffer`. The `shorturl_redirect` signal is still sent for every
+    redirect, but its instance is only fetched if a receiver uses it.
 
     :param request: the incoming request to redirect
     :type request: WSGIRequest
@@ -21,9 +25,18 @@ def _redirect_implementation(request, model, b36_encoded_pk):
     :return: the URL to forward to.
     :rtype: string
     """
-    endpoint = get_object_or_404(model, pk=base36_to_int(b36_encoded_pk))
-    shorturl_redirect.send(sender=model, instance=endpoint, user=request.user)
-    return endpoint.url
+    try:
+        pk = base36_to_int(b36_encoded_pk)
+    except ValueError:
+        raise Http404("Invalid short URL")
+    url = get_shorturl(model=model, pk=pk)
+    if url is None:
+        raise Http404("No menu item for that short URL")
+    instance = SimpleLazyObject(lambda: model.objects.get(pk=pk))
+    shorturl_redirect.send(sender=model, instance=instance,
+                           user=getattr(request, 'user', None))
+    hit_buffer.record(sender=model, pk=pk)
+    return url
 
 
 class MenuShortUrlRedirect(RedirectView):
@@ -34,7 +47,8 @@ class MenuShortUrlRedirect(RedirectView):
     def get_redirect_url(self, b36_int):
         """
         Allows for anything in a menu to redirect from a short URL to a long
-        canonical URL, with signals for catching the redirection.
+        canonical URL, with the `shorturl_redirect` signal for catching
+        each redirection, and `shorturl_hits` for counting them in batches.
 
         The app itself does not do any listening to the signal, but it exists
         as a hook for others.
@@ -53,7 +67,8 @@ class MenuShortUrlRedirect(RedirectView):
 def menu_shorturl_redirect(request, b36_int, model=MenuItem):
     """
     Allows for anything in a menu to redirect from a short URL to a long
-    canonical URL, with signals for catching the redirection.
+    canonical URL, with the `shorturl_redirect` signal for catching
+    each redirection, and `shorturl_hits` for counting them in batches.
 
     The app itself does not do any listening to the signal, but it exists
     as a hook for others.
@@ -1,15 +1,240 @@
+import base64
+from django.contrib.sites.models import Site
+from django.utils.http import http_date, quote_etag
 from rest_framework import viewsets
 from rest_framework import mixins
+from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
 from rest_framework.settings import api_settings
+from rest_framework.templatetags.rest_framework import replace_query_param
+try:
+    from rest_framework.decorators import detail_route
+except ImportError:  # pragma: no cover (DRF < 2.4)
+    from rest_framework.decorators import link as detail_route
 from .serializers import MenuItemSerializer
 from .models import MenuItem
+from .utils import get_validators, get_page_validators
+
+
+def nest_tree(nodes, data):
+    """
+    Given path ordered nodes and their serialized data, puts each item into
+    the `children` of its parent, returning the top level items.
+    """
+    top = []
+    parents = []
+    for node, item in zip(nodes, data):
+        item['children'] = []
+        while parents and parents[-1][0] >= node.depth:
+            parents.pop()
+        if parents:
+            parents[-1][1].append(item)
+        else:
+            top.append(item)
+        parents.append((node.depth, item['children']))
+    return top
+
+
+def encode_cursor(path):
+    return base64.urlsafe_b64encode(path.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        path = base64.urlsafe_b64decode(str(cursor)).decode('ascii')
+    except (TypeError, ValueError):
+        raise ParseError("Invalid cursor")
+    # Python 2 quietly skips characters which aren't base64, so only a
+    # cursor we'd have made ourselves is accepted.
+    if encode_cursor(path) != cursor:
+        raise ParseError("Invalid cursor")
+    return path
 
 
 class ReadOnlyMenuItemViewSet(mixins.RetrieveModelMixin,
                               mixins.ListModelMixin,
                               viewsets.GenericViewSet):
+    """
+    Lists are ordered by `path` and paginated by cursor rather than page
+    number, so that deep pages are as quick as the first, and may be
+    filtered with `?site=<pk>`, `?min_depth=N`, `?max_depth=N` and
+    `?subtree=<menu_slug>`.
+
+    Responses carry an ETag based on the items' `modified` times and their
+    sites' tree versions (so moves change it too), and a Last-Modified time
+    (except for lists), and are 304 Not Modified if the client's copy is
+    current.
+    """
     queryset = MenuItem.objects.select_related('site')
     lookup_field = 'menu_slug'
     serializer_class = MenuItemSerializer
     paginate_by = api_settings.PAGINATE_BY or 10
     paginate_by_param = api_settings.PAGINATE_BY_PARAM or 'page'
+    cursor_param = 'cursor'
+    site_param = 'site'
+    min_depth_param = 'min_depth'
+    max_depth_param = 'max_depth'
+    subtree_param = 'subtree'
+    tree_depth_param = 'depth'
+    tree_fields_param = 'fields'
+
+    def get_int_param(self, name, minimum=0):
+        value = self.request.QUERY_PARAMS.get(name)
+        if value is None or value == '':
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            value = minimum - 1
+        if value < minimum:
+            raise ParseError("{param} must be a number of at least "
+                             "{minimum}".format(param=name, minimum=minimum))
+        return value
+
+    def filter_scope(self, queryset):
+        """
+        Limits the items to a site and/or subtree.
+        """
+        site = self.get_int_param(self.site_param, minimum=1)
+        if site is not None:
+            queryset = queryset.filter(site=site)
+        subtree = self.request.QUERY_PARAMS.get(self.subtree_param)
+        if subtree:
+            paths = tuple(queryset.filter(menu_slug=subtree)
+                          .values_list('path', flat=True)[:2])
+            if len(paths) > 1:
+                raise ParseError("{param} is ambiguous without {site}".format(
+                    param=self.subtree_param, site=self.site_param))
+            if not paths:
+                return queryset.none()
+            queryset = queryset.filter(path__startswith=paths[0])
+        return queryset
+
+    def filter_depth(self, queryset):
+        min_depth = self.get_int_param(self.min_depth_param, minimum=1)
+        if min_depth is not None:
+            queryset = queryset.filter(depth__gte=min_depth)
+        max_depth = self.get_int_param(self.max_depth_param, minimum=1)
+        if max_depth is not None:
+            queryset = queryset.filter(depth__lte=max_depth)
+        return queryset
+
+    def get_site_ids(self):
+        """
+        The sites a list may include items from.
+        """
+        site = self.get_int_param(self.site_param, minimum=1)
+        if site is not None:
+            return (site,)
+        return tuple(Site.objects.values_list('pk', flat=True))
+
+    def check_not_modified(self, queryset, *extra, **kwargs):
+        """
+        Works out the validators for the response, which finalize_response
+        puts into the headers, returning them. `site_ids` are the sites the
+        items are from, if not those of `get_site_ids`. If a `page` of items
+        already fetched is given, the validators are for just those, rather
+        than everything in `queryset`.
+        """
+        site_ids = kwargs.pop('site_ids', None)
+        if site_ids is None:
+            site_ids = self.get_site_ids()
+        page = kwargs.pop('page', None)
+        params = sorted(self.request.QUERY_PARAMS.lists())
+        extra = extra + (params, self.request.accepted_renderer.format)
+        if page is not None:
+            self.validators = get_page_validators(page, extra=extra,
+                                                  site_ids=site_ids)
+        else:
+            self.validators = get_validators(queryset, extra=extra,
+                                             site_ids=site_ids)
+        return self.validators
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ReadOnlyMenuItemViewSet, self).finalize_response(
+            request, response, *args, **kwargs)
+        validators = getattr(self, 'validators', None)
+        ok = (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED)
+        if validators is not None and response.status_code in ok:
+            response['ETag'] = quote_etag(validators.etag)
+            if validators.last_modified is not None:
+                response['Last-Modified'] = http_date(
+                    validators.last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        scope = self.filter_scope(self.filter_queryset(self.get_queryset()))
+        queryset = self.filter_depth(scope)
+        cursor = request.QUERY_PARAMS.get(self.cursor_param)
+        if cursor:
+            queryset = queryset.filter(path__gt=decode_cursor(cursor))
+        page_size = self.get_paginate_by() or self.paginate_by
+        items = list(queryset.order_by('path')[:page_size + 1])
+        # only the page (and whether there's another) is looked at, so that
+        # deep pages are as quick as the first; changes to anything else
+        # the page's descendant counts depend on bump the tree version.
+        if self.check_not_modified(None, page=items).not_modified(request):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        next_url = None
+        if len(items) > page_size:
+            items = items[:page_size]
+            next_url = replace_query_param(request.build_absolute_uri(),
+                                           self.cursor_param,
+                                           encode_cursor(items[-1].path))
+        MenuItem.annotate_descendant_counts(items)
+        serializer = self.get_serializer(items, many=True)
+        return Response({'next': next_url, 'results': serializer.data})
+
+    def retrieve(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        subtree = self.get_queryset().filter(path__startswith=self.object.path)
+        validators = self.check_not_modified(
+            subtree, self.object.pk, site_ids=(self.object.site_id,))
+        if validators.not_modified(request):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        # everything in the subtree but the item itself.
+        self.object.descendant_count = validators.count - 1
+        serializer = self.get_serializer(self.object)
+        return Response(serializer.data)
+
+    def get_tree_fields(self):
+        fields = self.request.QUERY_PARAMS.get(self.tree_fields_param)
+        if not fields:
+            return None
+        fields = tuple(x.strip() for x in fields.split(',') if x.strip())
+        unknown = set(fields) - set(self.serializer_class.Meta.fields)
+        if unknown:
+            raise ParseError("Unknown fields: {0}".format(
+                ', '.join(sorted(unknown))))
+        return fields
+
+    @detail_route()
+    def tree(self, request, *args, **kwargs):
+        """
+        The item and everything below it, nested under `children`, fetched
+        in one query. `?depth=N` stops N levels below the item, and
+        `?fields=title,path` outputs only the given fields.
+        """
+        root = self.get_object()
+        depth = self.get_int_param(self.tree_depth_param)
+        fields = self.get_tree_fields()
+        subtree = self.get_queryset().filter(path__startswith=root.path,
+                                             depth__gte=root.depth)
+        validators = self.check_not_modified(subtree, root.pk,
+                                             site_ids=(root.site_id,))
+        if validators.not_modified(request):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        nodes = subtree
+        if depth is not None:
+            nodes = nodes.filter(depth__lte=root.depth + depth)
+        nodes = list(nodes.order_by('path'))
+        if fields is None or 'descendants' in fields:
+            # a depth limit cuts off the deepest nodes' descendants, which
+            # then need counting separately.
+            MenuItem.annotate_descendant_counts(nodes,
+                                                complete=depth is None)
+        serializer = self.serializer_class(
+            nodes, many=True, fields=fields,
+            context=self.get_serializer_context())
+        return Response(nest_tree(nodes, serializer.data)[0])
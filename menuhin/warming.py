@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.signals import request_started
+from django.db import connection
+from django.http import HttpRequest, QueryDict
+from django.template import RequestContext
+from django.template.loader import render_to_string
+from .models import MenuItem
+from .snapshots import menu_snapshots
+from .utils import request_cache, CURRENT_SITE_KEY
+from .versions import get_tree_version
+
+
+logger = logging.getLogger(__name__)
+
+#: `kind` is 'snapshot', with a (menu root, from_depth, to_depth) `target`,
+#: or 'render', with a URL.
+WarmJob = namedtuple('WarmJob', ('kind', 'site', 'target'))
+WarmResult = namedtuple('WarmResult', ('job', 'seconds', 'error'))
+
+
+class WarmReport(namedtuple('WarmReport', ('results', 'seconds'))):
+    def errors(self):
+        return tuple(x for x in self.results if x.error is not None)
+
+    def slowest(self, count=5):
+        return tuple(sorted(self.results, key=lambda x: x.seconds,
+                            reverse=True)[:count])
+
+    def counts(self):
+        return {
+            'snapshots': sum(1 for x in self.results
+                             if x.job.kind == 'snapshot'),
+            'pages': sum(1 for x in self.results if x.job.kind == 'render'),
+            'errors': len(self.errors()),
+            'seconds': self.seconds,
+        }
+
+
+def get_warm_menus():
+    """
+    The (menu root, from_depth, to_depth) variants of `show_menu` to warm;
+    roots are given as they would be to the tag.
+    """
+    return tuple(getattr(settings, 'MENUHIN_WARM_MENUS',
+                         (('default', 0, 100),)))
+
+
+def get_warm_templates():
+    return tuple(getattr(settings, 'MENUHIN_WARM_TEMPLATES',
+                         ('menuhin/warm.html',)))
+
+
+def get_warm_urls(site):
+    """
+    MENUHIN_WARM_URLS, or otherwise the site's published local menu items in
+    tree order (as the sitemap lists them), up to MENUHIN_WARM_URL_LIMIT.
+    """
+    urls = getattr(settings, 'MENUHIN_WARM_URLS', None)
+    if urls is not None:
+        return tuple(urls)
+    limit = getattr(settings, 'MENUHIN_WARM_URL_LIMIT', 100)
+    return tuple(MenuItem.objects.filter(site=site, is_published=True,
+                                         uri__startswith='/')
+                 .order_by('path').values_list('uri', flat=True)[:limit])
+
+
+def get_warm_threads():
+    return getattr(settings, 'MENUHIN_WARM_THREADS', 4)
+
+
+def get_warm_cache_timeout():
+    return getattr(settings, 'MENUHIN_WARM_CACHE_TIMEOUT', 3600)
+
+
+def get_menu_root(site, root):
+    root = str(root)
+    lookup = {'pk': int(root)} if root.isdigit() else {'menu_slug': root}
+    return MenuItem.objects.get(site=site, is_published=True, **lookup)
+
+
+def warm_snapshot(site, target):
+    root, from_depth, to_depth = target
+    menu_snapshots.get(MenuItem, site=site, parent=get_menu_root(site, root),
+                       from_depth=from_depth, to_depth=to_depth)
+
+
+def make_warm_request(site, url):
+    """
+    An anonymous GET of `url` on `site`, built by hand rather than with the
+    test client's RequestFactory.
+    """
+    path, _, query = url.partition('?')
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = path
+    request.GET = QueryDict(query)
+    request.META = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'HTTP_HOST': site.domain,
+        'SERVER_NAME': site.domain,
+        'SERVER_PORT': '80',
+    }
+    request.user = AnonymousUser()
+    return request
+
+
+def warm_render(site, url):
+    """
+    Renders each of MENUHIN_WARM_TEMPLATES as though requested at `url` on
+    `site`, so that the fragments they cache under the tree version (as
+    ``menuhin/warm.html`` does) are ready.
+    """
+    request = make_warm_request(site, url)
+    request_cache.start()
+    try:
+        request_cache.set(CURRENT_SITE_KEY, site)
+        context = {
+            'request': request,
+            'MENUHIN_TREE_VERSION': get_tree_version(site.pk),
+            'menuhin_warm_menus': get_warm_menus(),
+            'menuhin_warm_cache_timeout': get_warm_cache_timeout(),
+        }
+        for template in get_warm_templates():
+            render_to_string(template, context,
+                             context_instance=RequestContext(request))
+    finally:
+        request_cache.finish()
+
+
+def run_warm_job(job):
+    started = time.time()
+    error = None
+    try:
+        if job.kind == 'snapshot':
+            warm_snapshot(job.site, job.target)
+        else:
+            warm_render(job.site, job.target)
+    except Exception as e:
+        logger.exception("Couldn't warm {0!r}".format(job))
+        error = '{0}: {1}'.format(e.__class__.__name__, e)
+    return WarmResult(job=job, seconds=time.time() - started, error=error)
+
+
+def _run_in_thread(job):
+    try:
+        return run_warm_job(job)
+    finally:
+        # each pool thread has a connection of its own.
+        connection.close()
+
+
+def get_warm_jobs(sites, urls=None):
+    for site in sites:
+        if getattr(settings, 'MENUHIN_SNAPSHOTS', False):
+            for target in get_warm_menus():
+                yield WarmJob(kind='snapshot', site=site, target=target)
+        site_urls = get_warm_urls(site) if urls is None else urls
+        for url in site_urls:
+            yield WarmJob(kind='render', site=site, target=url)
+
+
+def warm_menus(sites=None, urls=None, threads=None):
+    """
+    Preloads the menu snapshots (if MENUHIN_SNAPSHOTS is on) and renders
+    the warming templates for each of the given sites (by default, the
+    current one), over a pool of `threads` threads.
+    """
+    started = time.time()
+    if sites is None:
+        sites = (Site.objects.get_current(),)
+    if threads is None:
+        threads = get_warm_threads()
+    jobs = tuple(get_warm_jobs(sites, urls=urls))
+    if threads > 1 and len(jobs) > 1:
+        pool = ThreadPool(processes=min(threads, len(jobs)))
+        try:
+            results = pool.map(_run_in_thread, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_warm_job(job) for job in jobs]
+    return WarmReport(results=tuple(results), seconds=time.time() - started)
+
+
+def warm_in_background(**kwargs):
+    """
+    `warm_menus` in a daemon thread, as on startup with
+    MENUHIN_WARM_ON_STARTUP, so the process isn't held up.
+    """
+    def run():
+        try:
+            report = warm_menus(**kwargs)
+        except Exception:
+            logger.exception("Couldn't warm the menus")
+        else:
+            logger.info("Warmed {snapshots} menus and {pages} pages in "
+                        "{seconds:.2f}s, with {errors} errors".format(
+                            **report.counts()))
+        finally:
+            connection.close()
+    thread = threading.Thread(target=run, name='menuhin-warm')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+_warm_lock = threading.Lock()
+_warmed_pids = set()
+
+
+def warm_at_first_request(sender, **kwargs):
+    """
+    Connected to request_started with MENUHIN_WARM_ON_STARTUP, so that each
+    process (including those forked from one which loaded the app) warms
+    itself once it's serving, and management commands never do.
+    """
+    with _warm_lock:
+        pid = os.getpid()
+        if pid in _warmed_pids:
+            return None
+        _warmed_pids.add(pid)
+    return warm_in_background()
+
+
+def warm_on_startup():
+    request_started.connect(warm_at_first_request,
+                            dispatch_uid='menuhin_warm_at_first_request')
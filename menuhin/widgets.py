@@ -1,21 +1,81 @@
 # -*- coding: utf-8 -*-
+import logging
+from django.conf import settings
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.db.models import BLANK_CHOICE_DASH
 from django.forms import Select
 from django.template.loader import render_to_string
 from django.utils.encoding import force_text
 from menuhin.models import MenuItem
+from menuhin.utils import request_cache, depth_label, get_current_site
+
+
+logger = logging.getLogger(__name__)
 
 
 class MenuItemSelect(Select):
+    """
+    Renders every published menu item as an option, unless `remote` is True
+    (by default, the MENUHIN_WIDGET_REMOTE setting), in which case only the
+    selected item is rendered, and the rest are searched for via
+    `search_url` (by default, the admin's search view) as the user types.
+    """
+    class Media:
+        js = ('admin/js/menuhin_widget.js',)
+
+    def __init__(self, attrs=None, choices=(), remote=None, search_url=None):
+        super(MenuItemSelect, self).__init__(attrs=attrs, choices=choices)
+        if remote is None:
+            remote = getattr(settings, 'MENUHIN_WIDGET_REMOTE', False)
+        self.remote = remote
+        self.search_url = search_url
+
+    def get_search_url(self):
+        if self.search_url is not None:
+            return force_text(self.search_url)
+        return reverse('admin:menuhin_menuitem_search')
+
+    def get_options(self):
+        """
+        The published tree, fetched once per request however many of these
+        widgets are rendered.
+        """
+        site = get_current_site()
+        return request_cache.get_or_set(
+            ('menuhin.widgets', site.pk),
+            lambda: MenuItem.get_published_annotated_list(site=site))
+
+    def get_selected_option(self, value):
+        if not value:
+            return None
+        site = get_current_site()
+        selected = (MenuItem.objects.filter(site=site, uri=value)
+                    .order_by('path').values('uri', 'title', 'depth')[:1])
+        for item in selected:
+            return {'value': item['uri'],
+                    'label': depth_label(item['title'], item['depth'])}
+        return {'value': value, 'label': value}
+
     def render(self, name, value, attrs=None, choices=()):
         if value is None:
             value = ''
         value = force_text(value)
         widget_attrs = self.build_attrs(attrs, name=name)
-        options = MenuItem.get_published_annotated_list()
-        return render_to_string('menuhin/widget.html', {
+        context = {
             'widget_attrs': widget_attrs,
-            'options': options,
             'value': value,
             'empty_label': BLANK_CHOICE_DASH[0][1]
-        })
+        }
+        if self.remote:
+            try:
+                search_url = self.get_search_url()
+            except NoReverseMatch:
+                logger.warning("No URL to search for menu items with, "
+                               "rendering all of them instead", exc_info=1)
+            else:
+                widget_attrs.update({'data-menuhin-search': search_url})
+                context.update(selected=self.get_selected_option(value))
+                return render_to_string('menuhin/widget_remote.html',
+                                        context)
+        context.update(options=self.get_options())
+        return render_to_string('menuhin/widget.html', context)